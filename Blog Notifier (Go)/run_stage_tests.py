@@ -0,0 +1,152 @@
+"""Runs the test suites of the stages in parallel and reports how long every test took.
+
+    python run_stage_tests.py [-j JOBS] [--report FILE] [stage ...]
+
+Every job runs ``tests.py`` of a stage in a private copy of the stage directory,
+so ``credentials.yaml`` and ``blogs.sqlite3`` written by one job are never seen
+by another.  Stages whose tests use the ``dynamic_test`` of ``test.runner`` are
+split into one job per test, selected through $BLOG_NOTIFIER_TESTS, the others
+run as a single job.  The Go binary the tests drive directly is built once per
+source hash and shared by all jobs through $BLOG_NOTIFIER_BUILD_CACHE.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+COURSE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_TEST = re.compile(r'^    def (test\d+_\w+)\(', re.M)
+_SHARDED = re.compile(r'^from test\.runner import .*\bdynamic_test\b', re.M)
+# what hstest prints when a test does not pass
+_FAILED = re.compile(r'^(Wrong answer|Exception|Error|Fatal error|Unexpected error) in test #\d+', re.M)
+
+
+class Job:
+    def __init__(self, stage, tests=None):
+        self.stage = stage
+        self.tests = tests
+        self.passed = False
+        self.seconds = 0.0
+        self.output = ''
+        self.timings = []
+
+    @property
+    def name(self):
+        return f"{self.stage}:{','.join(self.tests)}" if self.tests else self.stage
+
+
+def list_stages():
+    return sorted((name for name in os.listdir(COURSE_DIR)
+                   if re.fullmatch(r'stage\d+', name) and os.path.isdir(os.path.join(COURSE_DIR, name))),
+                  key=lambda name: int(name[len('stage'):]))
+
+
+def plan_jobs(stage):
+    with open(os.path.join(COURSE_DIR, stage, 'test', 'tests.py')) as file:
+        source = file.read()
+    if not _SHARDED.search(source):
+        return [Job(stage)]
+    return [Job(stage, [test]) for test in _TEST.findall(source)]
+
+
+def run_job(job, env, timeout):
+    scratch = tempfile.mkdtemp(prefix=f'blognotifier-{job.stage}-')
+    work_dir = os.path.join(scratch, job.stage)
+    timings_file = os.path.join(scratch, 'timings.jsonl')
+    try:
+        shutil.copytree(os.path.join(COURSE_DIR, job.stage), work_dir,
+                        ignore=shutil.ignore_patterns('__pycache__', '*.sqlite3*', 'credentials.yaml'))
+        env = dict(env, BLOG_NOTIFIER_TIMINGS_FILE=timings_file)
+        if job.tests:
+            env['BLOG_NOTIFIER_TESTS'] = ','.join(job.tests)
+        start = time.perf_counter()
+        try:
+            proc = subprocess.run([sys.executable, 'tests.py'], cwd=work_dir, env=env, timeout=timeout,
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
+            job.output = proc.stdout
+            job.passed = proc.returncode == 0 and not _FAILED.search(proc.stdout)
+        except subprocess.TimeoutExpired as err:
+            job.output = f'{err.output or ""}\ntimed out after {timeout}s'
+        job.seconds = time.perf_counter() - start
+        if os.path.exists(timings_file):
+            with open(timings_file) as file:
+                job.timings = [json.loads(line) for line in file if line.strip()]
+        # a selected test that is misspelled or was never registered leaves no timing
+        missing = set(job.tests or ()) - {timing['test'] for timing in job.timings}
+        if missing:
+            job.passed = False
+            job.output += f"\nselected tests did not run: {', '.join(sorted(missing))}"
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return job
+
+
+def report(jobs, wall_seconds):
+    """Prints the timing of every test and every stage and returns them for --report."""
+    tests, stages = [], {}
+    for job in jobs:
+        stage = stages.setdefault(job.stage, {'stage': job.stage, 'jobs': 0, 'failed': 0,
+                                              'busy_seconds': 0.0, 'longest_job_seconds': 0.0})
+        stage['jobs'] += 1
+        stage['failed'] += not job.passed
+        stage['busy_seconds'] += job.seconds
+        stage['longest_job_seconds'] = max(stage['longest_job_seconds'], job.seconds)
+        for timing in job.timings:
+            tests.append({'stage': job.stage, **timing})
+
+    if tests:
+        print(f"{'stage':<8} {'test':<48} {'seconds':>9}  result")
+        for test in sorted(tests, key=lambda t: -t['seconds']):
+            name = test['test'] + (f"[{','.join(test['data'])}]" if test['data'] else '')
+            print(f"{test['stage']:<8} {name:<48} {test['seconds']:>9.2f}  {'ok' if test['passed'] else 'FAILED'}")
+        print()
+    print(f"{'stage':<8} {'jobs':>5} {'failed':>7} {'busy s':>9} {'longest s':>10}")
+    for stage in stages.values():
+        print(f"{stage['stage']:<8} {stage['jobs']:>5} {stage['failed']:>7} "
+              f"{stage['busy_seconds']:>9.2f} {stage['longest_job_seconds']:>10.2f}")
+    print(f"\nwall time {wall_seconds:.2f}s")
+    return {'wall_seconds': round(wall_seconds, 4), 'stages': list(stages.values()), 'tests': tests}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the stage test suites in parallel.')
+    parser.add_argument('stages', nargs='*', help='the stages to test, all of them by default')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='jobs to run at a time')
+    parser.add_argument('--timeout', type=int, default=1800, help='seconds a single job may take')
+    parser.add_argument('--report', help='also write the timings to this file as JSON')
+    args = parser.parse_args()
+
+    stages = args.stages or list_stages()
+    jobs = [job for stage in stages for job in plan_jobs(stage)]
+    env = dict(os.environ)
+    env.setdefault('BLOG_NOTIFIER_BUILD_CACHE', os.path.join(tempfile.gettempdir(), 'blognotifier-builds'))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+        futures = [pool.submit(run_job, job, env, args.timeout) for job in jobs]
+        for future in as_completed(futures):
+            job = future.result()
+            print(f"{'ok' if job.passed else 'FAILED':<7} {job.name} ({job.seconds:.2f}s)", flush=True)
+    wall_seconds = time.perf_counter() - start
+
+    failed = [job for job in jobs if not job.passed]
+    for job in failed:
+        print(f'\n===== {job.name} =====\n{job.output}')
+    print()
+    timings = report(jobs, wall_seconds)
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(timings, file, indent=2)
+            file.write('\n')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
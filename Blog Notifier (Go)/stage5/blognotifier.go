@@ -1,68 +1,319 @@
 package main
 
 import (
+	"context"
+	"crypto/sha256"
 	"database/sql"
-	"flag"
+	"encoding/hex"
 	"fmt"
+	"io"
 	"log"
 	"net/http"
-	"net/smtp"
+	"net/url"
 	"os"
+	"sort"
 	"strings"
 	"sync"
+	"time"
 
 	"gopkg.in/yaml.v3"
 
-	"github.com/PuerkitoBio/goquery"
 	_ "github.com/mattn/go-sqlite3"
 )
 
 const (
 	CONFIG_FILE        = "./credentials.yml"
 	BLOGS_DB           = "./blogs.sqlite3"
+	BLOGS_DSN          = "file:" + BLOGS_DB + "?_foreign_keys=on&_journal_mode=WAL&_synchronous=NORMAL&_busy_timeout=5000&_txlock=immediate"
+	POSTS_BATCH_SIZE   = 5000
+	CRAWL_CHUNK_SIZE   = 1000
 	MAIL_MESSAGE       = `New blog post %s on blog %s`
+	MAIL_SUBJECT       = `New blog post`
 	CREATE_BLOGS_TABLE = `CREATE TABLE IF NOT EXISTS blogs (
 		site                    VARCHAR(256) PRIMARY KEY,
-		last_link               VARCHAR(256)
+		last_link               VARCHAR(256),
+		feed                    VARCHAR(256) DEFAULT ''
 	)`
+	// a post is stored with the title of its page or feed entry, if the crawl read one,
+	// and the unix time in milliseconds the crawl discovered it
 	CREATE_POSTS_TABLE = `CREATE TABLE IF NOT EXISTS posts (
-		site    VARCHAR(256),
-		link    VARCHAR(256),
+		site          VARCHAR(256),
+		link          VARCHAR(256),
+		title         TEXT DEFAULT '',
+		discovered_at INTEGER DEFAULT 0,
 		FOREIGN KEY (site) REFERENCES blogs(site) ON DELETE CASCADE
 	)`
+	// mails is the outbox: a mail is claimed by a notify run until claimed_until, and when
+	// its delivery fails it is retried from next_attempt on, both in unix milliseconds
 	CREATE_MAILS_TABLE = `CREATE TABLE IF NOT EXISTS mails (
-		id      INTEGER PRIMARY KEY AUTOINCREMENT,
-		mail    TEXT,
-		is_sent INTEGER DEFAULT 0
+		id            INTEGER PRIMARY KEY AUTOINCREMENT,
+		mail          TEXT,
+		is_sent       INTEGER DEFAULT 0,
+		attempts      INTEGER DEFAULT 0,
+		next_attempt  INTEGER DEFAULT 0,
+		claimed_until INTEGER DEFAULT 0,
+		last_error    TEXT DEFAULT ''
+	)`
+	CREATE_MAILS_INDEX = `CREATE INDEX IF NOT EXISTS mails_outbox ON mails (is_sent, next_attempt)`
+	CREATE_PAGES_TABLE = `CREATE TABLE IF NOT EXISTS pages (
+		link          VARCHAR(256) PRIMARY KEY,
+		site          VARCHAR(256),
+		etag          TEXT DEFAULT '',
+		last_modified TEXT DEFAULT '',
+		content_hash  TEXT DEFAULT '',
+		links_hash    TEXT DEFAULT '',
+		FOREIGN KEY (site) REFERENCES blogs(site) ON DELETE CASCADE
+	)`
+	// the SimHash fingerprints of the posts, one row per band of a fingerprint so that
+	// the near duplicates of a post are looked up through the index, see fingerprintBands
+	CREATE_FINGERPRINTS_TABLE = `CREATE TABLE IF NOT EXISTS fingerprints (
+		band        INTEGER,
+		value       INTEGER,
+		fingerprint INTEGER,
+		site        VARCHAR(256),
+		link        VARCHAR(256),
+		FOREIGN KEY (site) REFERENCES blogs(site) ON DELETE CASCADE
+	)`
+	CREATE_FINGERPRINTS_INDEX = `CREATE INDEX IF NOT EXISTS fingerprints_band ON fingerprints (band, value)`
+	ADD_FINGERPRINT           = `INSERT INTO fingerprints (band, value, fingerprint, site, link) VALUES(?, ?, ?, ?, ?)`
+	FIND_MIRRORS              = `SELECT link, fingerprint FROM fingerprints
+		WHERE (band = 0 AND value = ?) OR (band = 1 AND value = ?) OR (band = 2 AND value = ?) OR (band = 3 AND value = ?)`
+	// posts discovered before the unique index existed may be stored more than once,
+	// keep the first copy of every (site, link) pair
+	DEDUP_POSTS = `DELETE FROM posts WHERE rowid NOT IN (
+		SELECT MIN(rowid) FROM posts GROUP BY site, link
+	)`
+	CREATE_POSTS_INDEX = `CREATE UNIQUE INDEX IF NOT EXISTS posts_site_link ON posts (site, link)`
+	// the newest posts, of all the blogs or of one, are read off these indexes, see queryPosts
+	CREATE_POSTS_TIME_INDEX      = `CREATE INDEX IF NOT EXISTS posts_discovered ON posts (discovered_at)`
+	CREATE_POSTS_SITE_TIME_INDEX = `CREATE INDEX IF NOT EXISTS posts_site_discovered ON posts (site, discovered_at)`
+	// the full-text index of the titles and links of the posts. It holds its own copy of
+	// the site and time of every post, the rowids of posts are not stable across a VACUUM
+	// to refer to. A trigger adds every new post, one on blogs drops the posts of a removed
+	// site. Needs an SQLite built with FTS5, go build -tags sqlite_fts5
+	CREATE_POSTS_FTS = `CREATE VIRTUAL TABLE posts_fts USING fts5(
+		title, link, site UNINDEXED, discovered_at UNINDEXED
 	)`
-	REMOVE_SITE          = `DELETE from blogs WHERE site = ?`
-	ADD_NEW_BLOG         = `INSERT INTO blogs (site, last_link) VALUES(?, ?)`
-	UPDATE_BLOG          = `UPDATE blogs SET last_link = ? WHERE site = ?`
-	UPDATE_MAIL          = `UPDATE mails SET is_sent = 1 WHERE id = ?`
-	ADD_NEW_POST         = `INSERT INTO posts (site, link) VALUES(?, ?)`
-	ADD_NEW_MAIL         = `INSERT INTO mails (mail) VALUES(?)`
-	FETCH_BLOGS          = `SELECT * FROM blogs`
-	FETCH_POSTS          = `SELECT * FROM posts`
-	FETCH_MAILS          = `SELECT id, mail FROM mails WHERE is_sent = 0`
+	FILL_POSTS_FTS       = `INSERT INTO posts_fts (title, link, site, discovered_at) SELECT title, link, site, discovered_at FROM posts`
+	CREATE_POSTS_FTS_ADD = `CREATE TRIGGER IF NOT EXISTS posts_fts_add AFTER INSERT ON posts BEGIN
+		INSERT INTO posts_fts (title, link, site, discovered_at) VALUES (new.title, new.link, new.site, new.discovered_at);
+	END`
+	CREATE_POSTS_FTS_REMOVE = `CREATE TRIGGER IF NOT EXISTS posts_fts_remove AFTER DELETE ON blogs BEGIN
+		DELETE FROM posts_fts WHERE site = old.site;
+	END`
+	HAS_TABLE = `SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?`
+	// the posts matching the conditions of a postFilter, the newest first
+	QUERY_POSTS      = `SELECT site, link, title, discovered_at FROM %s WHERE %s ORDER BY discovered_at DESC LIMIT ?`
+	REMOVE_SITE      = `DELETE from blogs WHERE site = ?`
+	ADD_NEW_BLOG     = `INSERT INTO blogs (site, last_link) VALUES(?, ?)`
+	UPDATE_BLOG      = `UPDATE blogs SET last_link = ? WHERE site = ?`
+	UPDATE_BLOG_FEED = `UPDATE blogs SET feed = ? WHERE site = ?`
+	ADD_NEW_POST     = `INSERT INTO posts (site, link, title, discovered_at) VALUES(?, ?, ?, ?) ON CONFLICT(site, link) DO NOTHING`
+	ADD_NEW_MAIL     = `INSERT INTO mails (mail) VALUES(?)`
+	IMPORT_BLOG      = `INSERT INTO blogs (site, last_link, feed) VALUES(?, ?, ?) ON CONFLICT(site) DO NOTHING`
+	EXPORT_BLOGS     = `SELECT site, feed, last_link FROM blogs ORDER BY site`
+	// pages of --list and listPosts, each one starts after the last row of the previous
+	// one, which the primary key and the unique index on posts find without a scan
+	FETCH_BLOGS_PAGE = `SELECT site, last_link FROM blogs WHERE site > ? ORDER BY site LIMIT ?`
+	FETCH_POSTS_PAGE = `SELECT link FROM posts WHERE site = ? AND link > ? ORDER BY link LIMIT ?`
+	FETCH_BLOG_FEEDS = `SELECT site, feed, last_link FROM blogs`
+	HAS_COLUMN       = `SELECT COUNT(*) FROM pragma_table_info(?) WHERE name = ?`
+	// claims the oldest mails that are due, in a single statement so that two runs
+	// never claim the same mail
+	CLAIM_MAILS = `UPDATE mails SET claimed_until = ? WHERE id IN (
+		SELECT id FROM mails
+		WHERE is_sent = 0 AND attempts < ? AND next_attempt <= ? AND claimed_until <= ?
+		ORDER BY id LIMIT ?
+	) RETURNING id, mail, attempts`
+	MARK_MAIL_SENT       = `UPDATE mails SET is_sent = 1, attempts = attempts + 1, last_error = '', claimed_until = 0 WHERE id = ?`
+	MARK_MAIL_FAILED     = `UPDATE mails SET attempts = attempts + 1, last_error = ?, next_attempt = ?, claimed_until = 0 WHERE id = ?`
 	IS_BLOG              = `SELECT 1 FROM blogs WHERE site = ?`
 	IS_POST              = `SELECT 1 FROM posts WHERE site = ? and link = ?`
-	FETCH_POSTS_FOR_BLOG = `SELECT link FROM posts WHERE site = ?`
+	FETCH_KNOWN_POSTS    = `SELECT link FROM posts WHERE site = ? AND link IN (%s)`
+	FETCH_PAGES_FOR_BLOG = `SELECT link, etag, last_modified, content_hash, links_hash FROM pages WHERE site = ?`
+	UPSERT_PAGE          = `INSERT INTO pages (link, site, etag, last_modified, content_hash, links_hash) VALUES(?, ?, ?, ?, ?, ?)
+		ON CONFLICT(link) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified,
+		content_hash = excluded.content_hash, links_hash = excluded.links_hash`
+	// the checkpoint of the crawls that did not complete: crawl_sites holds the newest
+	// post a crawl found so far and the unix time in milliseconds it started, and
+	// crawl_frontier the pages it queued, in the order it queued them, marking those it
+	// fetched. Both are written in the transactions that store the posts, see
+	// checkpointStmts.save, and dropped along with the site
+	CREATE_CRAWL_SITES_TABLE = `CREATE TABLE IF NOT EXISTS crawl_sites (
+		site       VARCHAR(256) PRIMARY KEY,
+		first_link VARCHAR(256) DEFAULT '',
+		started_at INTEGER DEFAULT 0,
+		FOREIGN KEY (site) REFERENCES blogs(site) ON DELETE CASCADE
+	)`
+	CREATE_CRAWL_FRONTIER_TABLE = `CREATE TABLE IF NOT EXISTS crawl_frontier (
+		site    VARCHAR(256),
+		link    VARCHAR(256),
+		depth   INTEGER,
+		fetched INTEGER DEFAULT 0,
+		PRIMARY KEY (site, link),
+		FOREIGN KEY (site) REFERENCES blogs(site) ON DELETE CASCADE
+	)`
+	START_CRAWL = `INSERT INTO crawl_sites (site, first_link, started_at) VALUES(?, ?, ?)
+		ON CONFLICT(site) DO UPDATE SET first_link = excluded.first_link WHERE excluded.first_link != ''`
+	QUEUE_CRAWL_PAGE   = `INSERT INTO crawl_frontier (site, link, depth) VALUES(?, ?, ?) ON CONFLICT(site, link) DO NOTHING`
+	MARK_CRAWL_FETCHED = `INSERT INTO crawl_frontier (site, link, depth, fetched) VALUES(?, ?, ?, 1)
+		ON CONFLICT(site, link) DO UPDATE SET fetched = 1`
+	FETCH_CRAWL_SITE     = `SELECT first_link, started_at FROM crawl_sites WHERE site = ?`
+	FETCH_CRAWL_FRONTIER = `SELECT link, depth, fetched FROM crawl_frontier WHERE site = ? ORDER BY rowid`
+	CLEAR_CRAWL_FRONTIER = `DELETE FROM crawl_frontier WHERE site = ?`
+	CLEAR_CRAWL_SITE     = `DELETE FROM crawl_sites WHERE site = ?`
+	// a site narrows down what its crawl fetches with include and exclude patterns, which
+	// add to those of the config file, and replaces the budgets of the config file with
+	// max_pages and max_bytes when they are set, see sitePolicy
+	FETCH_BLOG_POLICY  = `SELECT include_patterns, exclude_patterns, max_pages, max_bytes FROM blogs WHERE site = ?`
+	UPDATE_BLOG_POLICY = `UPDATE blogs SET include_patterns = ?, exclude_patterns = ?, max_pages = ?, max_bytes = ?
+		WHERE site = ?`
+	// the robots.txt of every origin crawled as fetched at fetched_at, in unix milliseconds,
+	// empty for an origin without one
+	CREATE_ROBOTS_TABLE = `CREATE TABLE IF NOT EXISTS robots (
+		origin     VARCHAR(256) PRIMARY KEY,
+		body       TEXT DEFAULT '',
+		fetched_at INTEGER DEFAULT 0
+	)`
+	FETCH_ROBOTS = `SELECT body, fetched_at FROM robots WHERE origin = ?`
+	SAVE_ROBOTS  = `INSERT INTO robots (origin, body, fetched_at) VALUES(?, ?, ?)
+		ON CONFLICT(origin) DO UPDATE SET body = excluded.body, fetched_at = excluded.fetched_at`
+	// the watch scheduler keeps, per blog, the current poll interval in milliseconds, the
+	// number of consecutive failed polls and the unix time in milliseconds of the next poll
+	FETCH_DUE_BLOGS = `SELECT site, feed, last_link, poll_interval, poll_errors FROM blogs
+		WHERE next_poll <= ? AND lease_until <= ? ORDER BY next_poll`
+	// a leased blog is due again once its lease is over at the earliest
+	FETCH_NEXT_POLL      = `SELECT MIN(MAX(next_poll, lease_until)) FROM blogs`
+	UPDATE_BLOG_SCHEDULE = `UPDATE blogs SET poll_interval = ?, poll_errors = ?, next_poll = ?, lease_owner = '', lease_until = 0
+		WHERE site = ?`
+	// sharded runs lease the blogs they work on, lease_owner names the process holding the
+	// lease until lease_until and synced_at is when a sharded sync last released the blog,
+	// both in unix milliseconds. A blog is claimed in a single statement, so that two
+	// processes never hold the same blog
+	CLAIM_SYNC_BLOGS = `UPDATE blogs SET lease_owner = ?, lease_until = ? WHERE site IN (
+		SELECT site FROM blogs WHERE lease_until <= ? AND synced_at < ? ORDER BY site LIMIT ?
+	) RETURNING site, feed, last_link, poll_interval, poll_errors`
+	CLAIM_DUE_BLOGS = `UPDATE blogs SET lease_owner = ?, lease_until = ? WHERE site IN (
+		SELECT site FROM blogs WHERE lease_until <= ? AND next_poll <= ? ORDER BY next_poll LIMIT ?
+	) RETURNING site, feed, last_link, poll_interval, poll_errors`
+	RENEW_BLOG_LEASES = `UPDATE blogs SET lease_until = ? WHERE lease_owner = ? AND lease_until > 0`
+	RELEASE_BLOG      = `UPDATE blogs SET lease_owner = '', lease_until = 0, synced_at = ? WHERE site = ? AND lease_owner = ?`
+	DROP_BLOG_LEASES  = `UPDATE blogs SET lease_owner = '', lease_until = 0 WHERE lease_owner = ?`
+)
+
+// crawler and mail delivery limits used when the config file does not set them
+const (
+	DEFAULT_MAX_DEPTH        = 5
+	DEFAULT_MAX_PAGES        = 1000
+	DEFAULT_MAX_PAGE_BYTES   = 5 << 20
+	DEFAULT_MAX_SITE_BYTES   = 64 << 20
+	DEFAULT_CRAWL_WORKERS    = 8
+	DEFAULT_PER_HOST         = 2
+	DEFAULT_SMTP_CONNECTIONS = 4
+	DEFAULT_MAILS_PER_CONN   = 100
+	DEFAULT_MAIL_ATTEMPTS    = 10
+	KNOWN_POSTS_BATCH_SIZE   = 500
+	LIST_PAGE_SIZE           = 1000
+)
+
+// delays of the mail outbox. A claim that is neither marked sent nor failed, because the
+// run died while delivering, expires after MAIL_CLAIM_TIMEOUT and the mail is retried
+const (
+	DEFAULT_MAIL_RETRY_DELAY     = time.Minute
+	DEFAULT_MAX_MAIL_RETRY_DELAY = 6 * time.Hour
+	MAIL_CLAIM_TIMEOUT           = 10 * time.Minute
+)
+
+// limits of the HTTP client used when the config file does not set them
+const (
+	DEFAULT_CONNECT_TIMEOUT = 10 * time.Second
+	DEFAULT_READ_TIMEOUT    = 30 * time.Second
+	DEFAULT_REQUEST_TIMEOUT = 2 * time.Minute
+	DEFAULT_MAX_REDIRECTS   = 10
+)
+
+// leases of sharded runs used when the config file does not set them
+const (
+	DEFAULT_SHARD_LEASE = 2 * time.Minute
+	DEFAULT_SHARD_BATCH = 20
+	DEFAULT_SHARD_ROUND = 5 * time.Minute
+)
+
+// poll intervals of the watch command used when the config file does not set them
+const (
+	DEFAULT_POLL_INTERVAL     = time.Hour
+	DEFAULT_MIN_POLL_INTERVAL = 10 * time.Minute
+	DEFAULT_MAX_POLL_INTERVAL = 24 * time.Hour
 )
 
 type emailServer struct {
-	Host string
-	Port int
+	Host                  string
+	Port                  int
+	Connections           int
+	MessagesPerConnection int           `yaml:"messages_per_connection"`
+	MaxAttempts           int           `yaml:"max_attempts"`
+	RetryDelay            time.Duration `yaml:"retry_delay"`
+	MaxRetryDelay         time.Duration `yaml:"max_retry_delay"`
 }
 
 type emailClient struct {
 	Email    string
 	Password string
 	SendTo   string `yaml:"send_to"`
+	Digest   bool
 }
 
+// the Bot API endpoint, which defaults to Telegram's, how many posts a message packs and
+// how many messages per second, with bursts of burst, are sent to the channel
 type telegramConfig struct {
-	Channel  string
-	BotToken string `yaml:"bot_token"`
+	Channel         string
+	BotToken        string  `yaml:"bot_token"`
+	APIURL          string  `yaml:"api_url"`
+	PostsPerMessage int     `yaml:"posts_per_message"`
+	Rate            float64 `yaml:"rate"`
+	Burst           int     `yaml:"burst"`
+}
+
+// max_site_bytes is the byte budget of the crawl of a site, include and exclude the
+// patterns of the links every crawl fetches or skips, see sitePolicy
+type crawlerConfig struct {
+	MaxDepth     int           `yaml:"max_depth"`
+	MaxPages     int           `yaml:"max_pages"`
+	MaxPageBytes int           `yaml:"max_page_bytes"`
+	MaxSiteBytes int64         `yaml:"max_site_bytes"`
+	Workers      int           `yaml:"workers"`
+	PerHost      int           `yaml:"per_host"`
+	Delay        time.Duration `yaml:"delay"`
+	Incremental  bool          `yaml:"incremental"`
+	Include      []string      `yaml:"include"`
+	Exclude      []string      `yaml:"exclude"`
+	IgnoreRobots bool          `yaml:"ignore_robots"`
+}
+
+// timeouts of the HTTP client: connecting, waiting for the response headers or for
+// the next bytes of the body, and the whole request including the body
+type httpConfig struct {
+	ConnectTimeout     time.Duration `yaml:"connect_timeout"`
+	ReadTimeout        time.Duration `yaml:"read_timeout"`
+	Timeout            time.Duration `yaml:"timeout"`
+	MaxRedirects       int           `yaml:"max_redirects"`
+	IdleConnections    int           `yaml:"idle_connections"`
+	DisableCompression bool          `yaml:"disable_compression"`
+}
+
+// a sharded run claims batch blogs at a time and holds them for lease, renewing it while
+// it works on them. Sharded syncs started within round of each other make one pass over
+// the watchlist together, a blog synced less than round ago is not synced again
+type shardConfig struct {
+	Lease time.Duration `yaml:"lease"`
+	Batch int           `yaml:"batch"`
+	Round time.Duration `yaml:"round"`
+}
+
+type watchConfig struct {
+	Interval    time.Duration `yaml:"interval"`
+	MinInterval time.Duration `yaml:"min_interval"`
+	MaxInterval time.Duration `yaml:"max_interval"`
 }
 
 type blogNotifierConfig struct {
@@ -70,19 +321,54 @@ type blogNotifierConfig struct {
 	Server   emailServer
 	Client   emailClient
 	Telegram telegramConfig
+	Crawler  crawlerConfig
+	HTTP     httpConfig `yaml:"http"`
+	Watch    watchConfig
+	Shard    shardConfig
+}
+
+// a blog site to crawl, feed is the url of its feed or sitemap if it has one and
+// lastLink the newest post found by the previous crawl
+type blogSite struct {
+	site     string
+	feed     string
+	lastLink string
 }
 
 type blogPostsLink struct {
-	site string
-	link string
+	site        string
+	link        string
+	title       string // of the page or the feed entry of the post, if the crawl read one
+	fingerprint uint64 // of the text of the post, 0 when its page was not read
+}
+
+// a page waiting in the crawl frontier along with its distance from the site root
+type crawlItem struct {
+	link  string
+	depth int
+}
+
+// validators of a page as seen on its last successful fetch
+type pageMeta struct {
+	etag         string
+	lastModified string
+	contentHash  string
+	linksHash    string // fingerprint of the set of links on the page
 }
 
 type mailStruct struct {
-	id  int
-	msg string
+	id       int
+	msg      string
+	attempts int
 }
 
 var conf blogNotifierConfig
+var limiter *hostLimiter
+var (
+	dbConn *sql.DB
+	dbErr  error
+	dbOnce sync.Once
+)
 var (
 	mailAddr, sender, recipient, password string
 )
@@ -103,28 +389,48 @@ func parseConfig(configFile string) error {
 	}
 	mailAddr = fmt.Sprintf("%s:%d", conf.Server.Host, conf.Server.Port)
 	sender, password, recipient = conf.Client.Email, conf.Client.Password, conf.Client.SendTo
+	return nil
+}
+
+// prints the settings of the parsed config file, for --config only: they include the
+// passwords, the commands that run with a config file do not print them
+func printConfig() {
 	fmt.Printf("mode: %s\n", conf.Mode)
 	fmt.Printf("email_server: %s\n", mailAddr)
 	fmt.Printf("client: %s %s %s\n", sender, password, recipient)
 	fmt.Printf("telegram: %s@%s\n", conf.Telegram.BotToken, conf.Telegram.Channel)
-	return nil
 }
 
-// Getting database connection, It is important to note that To enable foreign key support in SQLite,
-// you need to ensure that the foreign key constraints are enabled for each database connection.
-// This must be done after opening a database connection using SQLite.
+// Getting database connection. The handle is opened once and shared by all helpers,
+// database/sql pools the underlying connection, so it must not be closed by the callers.
+// It is important to note that to enable foreign key support in SQLite, the foreign key
+// constraints need to be enabled for each database connection, so they are set through
+// the DSN together with the WAL journal, the synchronous level and the busy timeout,
+// which go-sqlite3 applies to every connection it opens.
 func getDBConnection() (*sql.DB, error) {
-	// os.Remove(BLOGS_DB)
-	db, err := sql.Open("sqlite3", BLOGS_DB)
-	if err != nil {
-		return nil, err
-	}
-	_, err = db.Exec("PRAGMA foreign_keys = ON;")
-	if err != nil {
-		fmt.Println("Error enabling foreign key constraints:", err)
-		return nil, err
+	dbOnce.Do(func() {
+		db, err := sql.Open("sqlite3", BLOGS_DSN)
+		if err == nil {
+			err = db.Ping()
+		}
+		if err != nil {
+			fmt.Println("Error opening the database:", err)
+			dbErr = err
+			return
+		}
+		// SQLite allows a single writer at a time, a single connection serializes the
+		// writes of the crawl workers instead of failing them with SQLITE_BUSY
+		db.SetMaxOpenConns(1)
+		dbConn = db
+	})
+	return dbConn, dbErr
+}
+
+// closes the shared database handle, if it was ever opened
+func closeDB() {
+	if dbConn != nil {
+		dbConn.Close()
 	}
-	return db, nil
 }
 
 // Creating Database tables //
@@ -133,34 +439,196 @@ func migrate() error {
 	if err != nil {
 		return err
 	}
-	defer db.Close()
 	_, err = db.Exec(CREATE_BLOGS_TABLE)
 	if err != nil {
 		fmt.Println("error creating blogs table")
 		return err
 	}
+	err = addColumnIfMissing(db, "blogs", "feed", "VARCHAR(256) DEFAULT ''")
+	if err != nil {
+		fmt.Println("error adding feed column to blogs table")
+		return err
+	}
+	for _, column := range []string{"poll_interval", "poll_errors", "next_poll", "lease_until", "synced_at", "max_pages", "max_bytes"} {
+		err = addColumnIfMissing(db, "blogs", column, "INTEGER DEFAULT 0")
+		if err != nil {
+			fmt.Printf("error adding %s column to blogs table\n", column)
+			return err
+		}
+	}
+	for _, column := range []string{"lease_owner", "include_patterns", "exclude_patterns"} {
+		err = addColumnIfMissing(db, "blogs", column, "TEXT DEFAULT ''")
+		if err != nil {
+			fmt.Printf("error adding %s column to blogs table\n", column)
+			return err
+		}
+	}
 
 	_, err = db.Exec(CREATE_POSTS_TABLE)
 	if err != nil {
 		fmt.Println("error creating posts table")
 		return err
 	}
+	err = addColumnIfMissing(db, "posts", "title", "TEXT DEFAULT ''")
+	if err != nil {
+		fmt.Println("error adding title column to posts table")
+		return err
+	}
+	err = addColumnIfMissing(db, "posts", "discovered_at", "INTEGER DEFAULT 0")
+	if err != nil {
+		fmt.Println("error adding discovered_at column to posts table")
+		return err
+	}
 
 	_, err = db.Exec(CREATE_MAILS_TABLE)
 	if err != nil {
 		fmt.Println("error creating mails table")
 		return err
 	}
+	for _, column := range []string{"attempts", "next_attempt", "claimed_until"} {
+		err = addColumnIfMissing(db, "mails", column, "INTEGER DEFAULT 0")
+		if err != nil {
+			fmt.Printf("error adding %s column to mails table\n", column)
+			return err
+		}
+	}
+	err = addColumnIfMissing(db, "mails", "last_error", "TEXT DEFAULT ''")
+	if err != nil {
+		fmt.Println("error adding last_error column to mails table")
+		return err
+	}
+	_, err = db.Exec(CREATE_MAILS_INDEX)
+	if err != nil {
+		fmt.Println("error creating index on mails table")
+		return err
+	}
+
+	_, err = db.Exec(CREATE_PAGES_TABLE)
+	if err != nil {
+		fmt.Println("error creating pages table")
+		return err
+	}
+	err = addColumnIfMissing(db, "pages", "links_hash", "TEXT DEFAULT ''")
+	if err != nil {
+		fmt.Println("error adding links_hash column to pages table")
+		return err
+	}
+
+	for _, table := range []string{CREATE_CRAWL_SITES_TABLE, CREATE_CRAWL_FRONTIER_TABLE} {
+		if _, err = db.Exec(table); err != nil {
+			fmt.Println("error creating crawl checkpoint tables")
+			return err
+		}
+	}
+	_, err = db.Exec(CREATE_ROBOTS_TABLE)
+	if err != nil {
+		fmt.Println("error creating robots table")
+		return err
+	}
+
+	_, err = db.Exec(CREATE_FINGERPRINTS_TABLE)
+	if err != nil {
+		fmt.Println("error creating fingerprints table")
+		return err
+	}
+	_, err = db.Exec(CREATE_FINGERPRINTS_INDEX)
+	if err != nil {
+		fmt.Println("error creating index on fingerprints table")
+		return err
+	}
+
+	err = migratePostsIndex(db)
+	if err != nil {
+		fmt.Println("error creating unique index on posts table")
+		return err
+	}
+	for _, index := range []string{CREATE_POSTS_TIME_INDEX, CREATE_POSTS_SITE_TIME_INDEX} {
+		if _, err = db.Exec(index); err != nil {
+			fmt.Println("error creating time index on posts table")
+			return err
+		}
+	}
+	err = migratePostsFTS(db)
+	if err != nil {
+		fmt.Println("error creating full-text index on posts table")
+		return err
+	}
 	return nil
 }
 
+// creates the full-text index of the posts and fills it with the posts stored so far.
+// An SQLite without FTS5 gets no index, searches then scan the posts instead
+func migratePostsFTS(db *sql.DB) error {
+	exists, err := hasTable(db, "posts_fts")
+	if err != nil || exists {
+		return err
+	}
+	tx, err := db.Begin()
+	if err != nil {
+		return err
+	}
+	defer tx.Rollback()
+	if _, err = tx.Exec(CREATE_POSTS_FTS); err != nil {
+		if strings.Contains(err.Error(), "no such module") {
+			fmt.Println("sqlite3 built without fts5, searching posts without a full-text index")
+			return nil
+		}
+		return err
+	}
+	for _, stmt := range []string{FILL_POSTS_FTS, CREATE_POSTS_FTS_ADD, CREATE_POSTS_FTS_REMOVE} {
+		if _, err = tx.Exec(stmt); err != nil {
+			return err
+		}
+	}
+	return tx.Commit()
+}
+
+// reports whether the database has the named table
+func hasTable(db *sql.DB, name string) (bool, error) {
+	n := 0
+	err := db.QueryRow(HAS_TABLE, name).Scan(&n)
+	return n > 0, err
+}
+
+// adds a column to a table created by an older version of migrate
+func addColumnIfMissing(db *sql.DB, table, column, decl string) error {
+	n := 0
+	err := db.QueryRow(HAS_COLUMN, table, column).Scan(&n)
+	if err != nil || n > 0 {
+		return err
+	}
+	_, err = db.Exec(fmt.Sprintf("ALTER TABLE %s ADD COLUMN %s %s", table, column, decl))
+	return err
+}
+
+// removes duplicate posts and adds the unique index on (site, link) in one transaction,
+// it is a no-op once the index exists
+func migratePostsIndex(db *sql.DB) error {
+	tx, err := db.Begin()
+	if err != nil {
+		return err
+	}
+	defer tx.Rollback()
+	res, err := tx.Exec(DEDUP_POSTS)
+	if err != nil {
+		return err
+	}
+	if n, err := res.RowsAffected(); err == nil && n > 0 {
+		fmt.Printf("removed %d duplicate posts\n", n)
+	}
+	_, err = tx.Exec(CREATE_POSTS_INDEX)
+	if err != nil {
+		return err
+	}
+	return tx.Commit()
+}
+
 func entityExists(query string, args ...any) (bool, error) {
 	// does the blog with name 'site' exists
 	db, err := getDBConnection()
 	if err != nil {
 		return false, err
 	}
-	defer db.Close()
 	row := db.QueryRow(query, args...)
 	i := -1
 	err = row.Scan(&i)
@@ -182,13 +650,47 @@ func postExists(site, post string) (bool, error) {
 	return entityExists(IS_POST, site, post)
 }
 
+// returns which of links are stored as posts of site, looking them up in batches
+func knownPosts(site string, links []string) (map[string]bool, error) {
+	known := make(map[string]bool)
+	db, err := getDBConnection()
+	if err != nil {
+		return known, err
+	}
+	for lo := 0; lo < len(links); lo += KNOWN_POSTS_BATCH_SIZE {
+		batch := links[lo:min(lo+KNOWN_POSTS_BATCH_SIZE, len(links))]
+		args := make([]any, 0, len(batch)+1)
+		args = append(args, site)
+		for _, link := range batch {
+			args = append(args, link)
+		}
+		query := fmt.Sprintf(FETCH_KNOWN_POSTS, strings.TrimSuffix(strings.Repeat("?, ", len(batch)), ", "))
+		rows, err := db.Query(query, args...)
+		if err != nil {
+			return known, err
+		}
+		for rows.Next() {
+			link := ""
+			if err := rows.Scan(&link); err != nil {
+				rows.Close()
+				return known, err
+			}
+			known[link] = true
+		}
+		rows.Close()
+		if err = rows.Err(); err != nil {
+			return known, err
+		}
+	}
+	return known, nil
+}
+
 // function to add a new site
 func addNewSite(site, link string) error {
 	db, err := getDBConnection()
 	if err != nil {
 		return err
 	}
-	defer db.Close()
 	_, err = db.Exec(ADD_NEW_BLOG, site, link)
 	if err != nil {
 		return err
@@ -196,127 +698,223 @@ func addNewSite(site, link string) error {
 	return nil
 }
 
-// first check if the post already exists in the database, if not insert a new entry
-func addNewPostIfNotExist(site, link string) (bool, error) {
-	db, err := getDBConnection()
+// inserts the posts of the chunks in a single transaction, along with the checkpoints of
+// their crawls, so that a checkpoint never gets ahead of the posts stored. The unique
+// index on posts makes the insert a no-op for posts that are already known, so a post is
+// new exactly when its insert affected a row and there is no separate lookup per link. A
+// new post that is a near duplicate of a stored one, the same article mirrored by another
+// blog or under another url, is stored but not mailed. Returns the number of new posts,
+// which are also counted per site into added once the batch is committed
+func addNewPostsBatch(db *sql.DB, chunks []crawlChunk, withMails bool, added map[string]int) (int, error) {
+	tx, err := db.Begin()
 	if err != nil {
-		return false, err
+		return 0, err
 	}
-	defer db.Close()
-	row := db.QueryRow(IS_POST, site, link)
-	i := -1
-	err = row.Scan(&i)
-
+	defer tx.Rollback()
+	addPostStmt, err := tx.Prepare(ADD_NEW_POST)
 	if err != nil {
-		if err == sql.ErrNoRows {
-			_, err = db.Exec(ADD_NEW_POST, site, link)
-			if err == nil {
-				return true, err
+		return 0, fmt.Errorf("%w (the posts table needs its unique index, run --migrate)", err)
+	}
+	defer addPostStmt.Close()
+	addMailStmt, err := tx.Prepare(ADD_NEW_MAIL)
+	if err != nil {
+		return 0, err
+	}
+	defer addMailStmt.Close()
+	findMirrorsStmt, err := tx.Prepare(FIND_MIRRORS)
+	if err != nil {
+		return 0, err
+	}
+	defer findMirrorsStmt.Close()
+	addFingerprintStmt, err := tx.Prepare(ADD_FINGERPRINT)
+	if err != nil {
+		return 0, err
+	}
+	defer addFingerprintStmt.Close()
+	checkpoint, err := prepareCheckpoint(tx)
+	if err != nil {
+		return 0, err
+	}
+	defer checkpoint.close()
+
+	newPosts := make([]string, 0)
+	now := time.Now().UnixMilli()
+	for _, chunk := range chunks {
+		for _, post := range chunk.posts {
+			res, err := addPostStmt.Exec(post.site, post.link, post.title, now)
+			if err != nil {
+				return 0, err
+			}
+			if n, err := res.RowsAffected(); err != nil || n == 0 {
+				continue
 			}
+			mirrorOf := ""
+			if post.fingerprint != 0 {
+				if mirrorOf, err = findMirror(findMirrorsStmt, post.fingerprint); err != nil {
+					return 0, err
+				}
+				if err = addFingerprint(addFingerprintStmt, post); err != nil {
+					return 0, err
+				}
+			}
+			if mirrorOf != "" {
+				fmt.Printf("%s is a mirror of %s, not notifying\n", post.link, mirrorOf)
+			} else if withMails {
+				if _, err = addMailStmt.Exec(fmt.Sprintf(MAIL_MESSAGE, post.link, post.site)); err != nil {
+					return 0, err
+				}
+			}
+			newPosts = append(newPosts, post.site)
+		}
+		if err = checkpoint.save(chunk, now); err != nil {
+			return 0, err
 		}
-		return false, err
 	}
-
-	return false, nil
+	if err = tx.Commit(); err != nil {
+		return 0, err
+	}
+	for _, site := range newPosts {
+		added[site]++
+	}
+	return len(newPosts), nil
 }
 
-// list all the the sites the user is subscribing to
-func listAllSites() (map[string]string, error) {
-	// list all the sites that are saved to the database
+// lists the sites to crawl along with their feeds
+func listBlogs() ([]blogSite, error) {
 	db, err := getDBConnection()
 	if err != nil {
 		return nil, err
 	}
-	defer db.Close()
-	rows, err := db.Query(FETCH_BLOGS)
+	rows, err := db.Query(FETCH_BLOG_FEEDS)
 	if err != nil {
 		return nil, err
 	}
-	blogAndLastLink := make(map[string]string, 0)
+	defer rows.Close()
+	blogs := make([]blogSite, 0)
 	for rows.Next() {
-		_site, last_link := "", ""
-		rows.Scan(&_site, &last_link)
-
-		// postLinks = append(postLinks, _site)
-		blogAndLastLink[_site] = last_link
-		fmt.Printf("retrieved site: %s, last_link: %s\n", _site, last_link)
+		blog := blogSite{}
+		lastLink := sql.NullString{}
+		if err := rows.Scan(&blog.site, &blog.feed, &lastLink); err != nil {
+			return nil, err
+		}
+		blog.lastLink = lastLink.String
+		blogs = append(blogs, blog)
 	}
-	return blogAndLastLink, nil
+	return blogs, rows.Err()
 }
 
-// list all blog-posts given blog-site
-func getPostsForSite(site string) ([]string, error) {
+// stores the feed or sitemap url of a blog site
+func updateBlogFeed(site, feed string) error {
 	db, err := getDBConnection()
 	if err != nil {
-		return nil, err
+		return err
 	}
-	defer db.Close()
-	rows, err := db.Query(FETCH_POSTS_FOR_BLOG, site)
+	_, err = db.Exec(UPDATE_BLOG_FEED, feed, site)
 	if err != nil {
-		return nil, err
-	}
-	existingPosts := make([]string, 0)
-	for rows.Next() {
-		_l := ""
-		err := rows.Scan(&_l)
-		if err == nil {
-			existingPosts = append(existingPosts, _l)
-		}
+		fmt.Printf("error updating feed %s for blog %s in the blogs table\n", feed, site)
+		return err
 	}
-	return existingPosts, nil
+	return nil
 }
 
-// fetches all the mails that are not yet sent to the user
-func fetchMails() ([]mailStruct, error) {
+// claims at most limit mails that are due for delivery at now, oldest first
+func claimMails(now time.Time, limit int) ([]mailStruct, error) {
+	defer metrics.dbWriteSince(time.Now())
 	db, err := getDBConnection()
-	defer db.Close()
 	if err != nil {
 		return nil, err
 	}
-	rows, err := db.Query(FETCH_MAILS)
+	rows, err := db.Query(CLAIM_MAILS, now.Add(MAIL_CLAIM_TIMEOUT).UnixMilli(),
+		orDefault(conf.Server.MaxAttempts, DEFAULT_MAIL_ATTEMPTS), now.UnixMilli(), now.UnixMilli(), limit)
 	if err != nil {
 		return nil, err
 	}
-	mails := make([]mailStruct, 0)
+	defer rows.Close()
+	mails := make([]mailStruct, 0, limit)
 	for rows.Next() {
-		_id, _mail := 0, ""
-		err := rows.Scan(&_id, &_mail)
-		if err == nil {
-			mails = append(mails, mailStruct{
-				id:  _id,
-				msg: _mail,
-			})
-		} else {
+		mail := mailStruct{}
+		if err := rows.Scan(&mail.id, &mail.msg, &mail.attempts); err != nil {
 			return nil, err
 		}
+		mails = append(mails, mail)
+	}
+	if err = rows.Err(); err != nil {
+		return nil, err
 	}
+	// RETURNING does not keep the order of the subquery
+	sort.Slice(mails, func(i, j int) bool { return mails[i].id < mails[j].id })
 	return mails, nil
 }
 
-// fetches posts that are already existing in the database
-func getExistingPosts() (map[string][]string, error) {
+// claims every mail that is due at now, in batches of batchSize
+func claimDueMails(now time.Time, batchSize int) ([][]mailStruct, error) {
+	batches := make([][]mailStruct, 0)
+	for {
+		batch, err := claimMails(now, batchSize)
+		if err != nil || len(batch) == 0 {
+			return batches, err
+		}
+		batches = append(batches, batch)
+	}
+}
+
+// the delay before a mail is retried after its attempts-th failed delivery, doubling
+// with every failure up to max_retry_delay
+func mailRetryDelay(attempts int) time.Duration {
+	delay, hi := conf.Server.RetryDelay, conf.Server.MaxRetryDelay
+	if delay <= 0 {
+		delay = DEFAULT_MAIL_RETRY_DELAY
+	}
+	if hi <= 0 {
+		hi = DEFAULT_MAX_MAIL_RETRY_DELAY
+	}
+	for i := 1; i < attempts && delay < hi; i++ {
+		delay *= 2
+	}
+	return min(delay, hi)
+}
+
+// records the outcome of a delivery in one transaction: the mails in sent are marked as
+// sent, the ones in failed get their error and the time of their next attempt
+func markMails(sent []mailStruct, failed []mailStruct, errs []error) error {
+	defer metrics.dbWriteSince(time.Now())
 	db, err := getDBConnection()
 	if err != nil {
-		return nil, err
+		return err
 	}
-	defer db.Close()
-	rows, err := db.Query(FETCH_POSTS)
+	tx, err := db.Begin()
 	if err != nil {
-		return nil, err
+		return err
 	}
-	existingPosts := make(map[string][]string)
-	for rows.Next() {
-		_s, _l := "", ""
-		err := rows.Scan(&_s, &_l)
-		if err == nil {
-			_, ok := existingPosts[_s]
-			if !ok {
-				existingPosts[_s] = make([]string, 0)
-			}
-			existingPosts[_s] = append(existingPosts[_s], _l)
+	defer tx.Rollback()
+	sentStmt, err := tx.Prepare(MARK_MAIL_SENT)
+	if err != nil {
+		return err
+	}
+	defer sentStmt.Close()
+	failedStmt, err := tx.Prepare(MARK_MAIL_FAILED)
+	if err != nil {
+		return err
+	}
+	defer failedStmt.Close()
+
+	for _, mail := range sent {
+		if _, err = sentStmt.Exec(mail.id); err != nil {
+			return err
+		}
+	}
+	now := time.Now()
+	for i, mail := range failed {
+		next := now.Add(mailRetryDelay(mail.attempts + 1))
+		if _, err = failedStmt.Exec(errs[i].Error(), next.UnixMilli(), mail.id); err != nil {
+			return err
 		}
 	}
-	return existingPosts, nil
+	if err = tx.Commit(); err != nil {
+		fmt.Println("error updating the delivery state in the mails table")
+		return err
+	}
+	return nil
 }
 
 // implements a functionality to remove a site
@@ -326,7 +924,6 @@ func removeSite(site string) error {
 	if err != nil {
 		return err
 	}
-	defer db.Close()
 	_, err = db.Exec(REMOVE_SITE, site)
 	if err != nil {
 		fmt.Printf("error deleting a site %s from the blogs table\n", site)
@@ -337,12 +934,12 @@ func removeSite(site string) error {
 
 // updates the last visited site if new post in the blog site
 func updateLastSiteVisited(site, link string) error {
+	defer metrics.dbWriteSince(time.Now())
 	// remove a site from the watch list
 	db, err := getDBConnection()
 	if err != nil {
 		return err
 	}
-	defer db.Close()
 	_, err = db.Exec(UPDATE_BLOG, link, site)
 	if err != nil {
 		fmt.Printf("error updating last_link %s for blog %s in the blogs table\n", link, site)
@@ -351,350 +948,729 @@ func updateLastSiteVisited(site, link string) error {
 	return nil
 }
 
-// functionality to add new mails, new mails containg info about new posts that users need to be notified about
-func addMail(site, link string) error {
+// fetches the validators stored for every page of a blog site
+func getPageMetas(site string) (map[string]pageMeta, error) {
 	db, err := getDBConnection()
 	if err != nil {
-		return err
+		return nil, err
 	}
-	defer db.Close()
-	_, err = db.Exec(ADD_NEW_MAIL, fmt.Sprintf(MAIL_MESSAGE, link, site))
+	rows, err := db.Query(FETCH_PAGES_FOR_BLOG, site)
 	if err != nil {
-		return err
+		return nil, err
 	}
-	return nil
+	defer rows.Close()
+	metas := make(map[string]pageMeta)
+	for rows.Next() {
+		link, meta := "", pageMeta{}
+		err := rows.Scan(&link, &meta.etag, &meta.lastModified, &meta.contentHash, &meta.linksHash)
+		if err != nil {
+			return nil, err
+		}
+		metas[link] = meta
+	}
+	return metas, rows.Err()
 }
 
-// after sending the mails mark the mails in the database as sent
-func updateMail(id int) error {
-	// remove a site from the watch list
-	db, err := getDBConnection()
+// fetches a document and parses it while it streams in. The request is made conditional
+// on the validators in meta, which are updated in place from the response. When the
+// server answers 304 Not Modified, or the body is the same as on the last fetch, the
+// document is reported as unchanged. At most max_page_bytes of the body are read.
+// What the fetch cost is recorded in st
+func fetchParsed[T any](link string, meta *pageMeta, parse func(io.Reader, string) (T, error), st *fetchStats) (T, bool, error) {
+	var doc T
+	req, err := http.NewRequest(http.MethodGet, link, nil)
 	if err != nil {
-		return err
+		return doc, false, err
 	}
-	defer db.Close()
-	_, err = db.Exec(UPDATE_MAIL, id)
-	if err != nil {
-		fmt.Printf("error updating is_sent id %d in the mails table\n", id)
-		return err
+	if meta.etag != "" {
+		req.Header.Set("If-None-Match", meta.etag)
 	}
-	return nil
-}
-
-// finds all the links in a blog post
-func findAllLinks(site string) ([]string, error) {
-	res, err := http.Get(site)
+	if meta.lastModified != "" {
+		req.Header.Set("If-Modified-Since", meta.lastModified)
+	}
+	start := time.Now()
+	res, err := getHTTPClient().Do(req)
+	st.latency = time.Since(start)
 	if err != nil {
-		return nil, err
+		return doc, false, err
+	}
+	defer func() {
+		// reading a short rest of the body keeps the connection reusable, a long one is
+		// not worth the wait and the connection is dropped instead
+		io.CopyN(io.Discard, res.Body, 4<<10)
+		res.Body.Close()
+	}()
+	st.status = res.StatusCode
+	if res.StatusCode == http.StatusNotModified {
+		return doc, true, nil
 	}
-	defer res.Body.Close()
 	if res.StatusCode != 200 {
-		return nil, err
+		return doc, false, fmt.Errorf("%s: unexpected status %s", link, res.Status)
 	}
 
-	// Load the HTML document
-	doc, err := goquery.NewDocumentFromReader(res.Body)
+	// hash the page while it is parsed, there is no copy of the whole body
+	hasher := sha256.New()
+	timed := &timedReader{r: io.LimitReader(res.Body, maxPageBytes())}
+	defer func() { st.bytes, st.read = timed.bytes, timed.wait }()
+	body := io.TeeReader(timed, hasher)
+	start = time.Now()
+	doc, err = parse(body, res.Header.Get("Content-Type"))
+	st.parse = time.Since(start) - timed.wait
 	if err != nil {
-		return nil, err
+		return doc, false, err
+	}
+	// the parser may stop before the end of the page, the hash has to cover all of it
+	if _, err = io.Copy(io.Discard, body); err != nil {
+		return doc, false, err
+	}
+
+	hash := hex.EncodeToString(hasher.Sum(nil))
+	unchanged := hash == meta.contentHash
+	meta.etag = res.Header.Get("ETag")
+	meta.lastModified = res.Header.Get("Last-Modified")
+	meta.contentHash = hash
+	if unchanged {
+		var none T
+		return none, true, nil
 	}
+	return doc, false, nil
+}
 
-	links := make([]string, 0)
+// extracts the links of an HTML page, responses that are not HTML are not parsed at all
+func parsePageLinks(r io.Reader, contentType string) ([]string, error) {
+	if !isHTML(contentType) {
+		return []string{}, nil
+	}
+	return extractLinks(r)
+}
 
-	// Find the review items
-	doc.Find("a").Each(func(i int, s *goquery.Selection) {
-		// For each item found, get the title
-		link, exists := s.Attr("href")
-		if exists {
-			links = append(links, link)
-		}
-	})
-	return links, nil
+// parses an html page for the crawl, documents of other types have neither links nor text
+func parsePage(r io.Reader, contentType string) (pageDoc, error) {
+	if !isHTML(contentType) {
+		return pageDoc{}, nil
+	}
+	return extractPage(r)
+}
+
+// finds all the links in a blog post, see fetchParsed for how unchanged pages are detected
+func findAllLinks(site string, meta *pageMeta) ([]string, bool, error) {
+	return fetchParsed(site, meta, parsePageLinks, &fetchStats{})
 }
 
-// fetches mails that need to be sent, sends the mails, updates the database if the mail is sent successfully
+// claims the mails that are due, sends them and records the outcome of every delivery.
+// The claimed mails come in batches that are each sent over one SMTP connection, at most
+// server.connections of them at a time, and each batch is marked in one transaction as
+// soon as its session is done. A mail that fails is retried on a later run after a
+// backoff, see mailRetryDelay. With client.digest set all the mails are rolled into one
+// message. With mode: telegram the posts go to the Telegram channel, see notifyTelegram
 func notify() error {
-	// fetching all the new messages or messages that are not sent
-	mails, err := fetchMails()
+	if conf.Mode == MODE_TELEGRAM {
+		return notifyTelegram()
+	}
+	perConn := orDefault(conf.Server.MessagesPerConnection, DEFAULT_MAILS_PER_CONN)
+	batches, err := claimDueMails(time.Now(), perConn)
 	if err != nil {
 		return err
 	}
-	deliveredCh := make(chan int)
-	errCh := make(chan error)
-	wg := &sync.WaitGroup{}
+	if len(batches) == 0 {
+		return nil
+	}
+	if conf.Client.Digest {
+		all := make([]mailStruct, 0, len(batches)*perConn)
+		for _, batch := range batches {
+			all = append(all, batch...)
+		}
+		batches = [][]mailStruct{all}
+	}
+
+	pool := newWorkerPool("notify", orDefault(conf.Server.Connections, DEFAULT_SMTP_CONNECTIONS))
+	stats := &mailerStats{}
+	start := time.Now()
 	// send email notification to the user
-	for _, mail := range mails {
-		wg.Add(1)
-		go func(_mail mailStruct) {
-			defer wg.Done()
-			err := smtp.SendMail(mailAddr, nil, sender, []string{recipient}, []byte(_mail.msg))
+	pool.run(len(batches), func(b int) {
+		batch := batches[b]
+		// one message per mail, or a single message covering all of them
+		msgs := make([][]byte, 0, len(batch))
+		covers := make([][]mailStruct, 0, len(batch))
+		if conf.Client.Digest {
+			msgs, covers = append(msgs, digestMail(batch)), append(covers, batch)
+		} else {
+			for _, mail := range batch {
+				msgs = append(msgs, formatMail(MAIL_SUBJECT, mail.msg))
+				covers = append(covers, []mailStruct{mail})
+			}
+		}
+
+		sent := make([]mailStruct, 0, len(batch))
+		failed := make([]mailStruct, 0)
+		errs := make([]error, 0)
+		err := deliverOnSession(msgs, stats, func(i int, err error) {
 			if err == nil {
-				deliveredCh <- _mail.id
-			} else {
-				errCh <- err
+				sent = append(sent, covers[i]...)
+				return
+			}
+			for _, mail := range covers[i] {
+				failed = append(failed, mail)
+				errs = append(errs, err)
 			}
-		}(mail)
+		})
+		if err != nil {
+			fmt.Println("error delivering mail")
+			fmt.Println(err)
+		}
+		if err = markMails(sent, failed, errs); err != nil {
+			fmt.Println(err)
+		}
+	})
+	fmt.Println(pool)
+	fmt.Printf("notify: %d messages sent, %d failed, over %d connections in %s\n",
+		stats.sent.Load(), stats.failed.Load(), stats.connections.Load(), time.Since(start))
+	metrics.observeMails(stats)
+	return nil
+}
+
+// returns the crawl limits from the config file, falling back to the defaults
+func crawlerLimits() (maxDepth, maxPages int) {
+	maxDepth, maxPages = conf.Crawler.MaxDepth, conf.Crawler.MaxPages
+	if maxDepth <= 0 {
+		maxDepth = DEFAULT_MAX_DEPTH
+	}
+	if maxPages <= 0 {
+		maxPages = DEFAULT_MAX_PAGES
 	}
+	return maxDepth, maxPages
+}
 
-	go func() {
-		wg.Wait()
-		close(deliveredCh)
-		close(errCh)
-	}()
+// returns the number of bytes read at most from a single page
+func maxPageBytes() int64 {
+	return int64(orDefault(conf.Crawler.MaxPageBytes, DEFAULT_MAX_PAGE_BYTES))
+}
 
-	for id := range deliveredCh {
-		err = updateMail(id)
+// returns a config value, or def when it is not set
+func orDefault(v, def int) int {
+	if v <= 0 {
+		return def
 	}
-	for err := range errCh {
-		fmt.Println("error delivering mail")
-		fmt.Println(err)
+	return v
+}
+
+// resolves href against the page it was found on and strips everything that does not
+// identify a distinct page, so that every page has exactly one key in the visited set.
+// Links that leave the host of the blog site are rejected.
+func normalizeLink(page *url.URL, href, host string) (string, bool) {
+	ref, err := url.Parse(strings.TrimSpace(href))
+	if err != nil {
+		return "", false
+	}
+	u := page.ResolveReference(ref)
+	u.Scheme = strings.ToLower(u.Scheme)
+	if u.Scheme != "http" && u.Scheme != "https" {
+		return "", false
+	}
+	u.Host = strings.ToLower(u.Host)
+	if u.Host != host {
+		return "", false
+	}
+	u.Fragment = ""
+	u.RawFragment = ""
+	if u.Path == "" {
+		u.Path = "/"
 	}
+	return u.String(), true
+}
 
-	return nil
+// state of the crawl of one blog site
+type siteCrawl struct {
+	ctx       context.Context // the crawl stops between two pages once it is done
+	site      string
+	host      string
+	emit      func(chunk crawlChunk) // receives the discovered links and the checkpoint in chunks
+	pending   crawlChunk             // discovered links and fetched pages not yet handed to emit
+	first     string                 // the first link discovered, the newest post
+	visited   map[string]bool
+	metas     map[string]pageMeta // validators stored by the previous crawl
+	changed   map[string]pageMeta // validators that changed during this crawl
+	watermark string              // newest post of the previous crawl, set in incremental mode
+	resumed   []frontierPage      // the checkpointed frontier of an interrupted crawl
+	left      []crawlItem         // the start and the frontier of a crawl that ran out of budget
+	policy    sitePolicy
+	robots    *robotsRules // of the host of the site, nil with ignore_robots
+	bytes     int64        // read from the site so far
 }
 
-// recursive crawl function
-func _crawl(site, link string, links *[]blogPostsLink) error {
-	_links, err := findAllLinks(link)
-	if err == nil {
-		for _, _link := range _links {
-			*links = append(*links, blogPostsLink{
-				site: site,
-				link: _link,
-			})
-			err := _crawl(site, _link, links)
-			if err != nil {
-				return fmt.Errorf("%s: error in recursive crawl", site)
-			}
+func newSiteCrawl(ctx context.Context, blog blogSite, emit func(chunk crawlChunk)) (*siteCrawl, string, error) {
+	site := blog.site
+	root, err := url.Parse(site)
+	if err != nil {
+		return nil, "", fmt.Errorf("%s: invalid site url", site)
+	}
+	host := strings.ToLower(root.Host)
+	start, ok := normalizeLink(root, site, host)
+	if !ok {
+		return nil, "", fmt.Errorf("%s: invalid site url", site)
+	}
+	policy, err := loadSitePolicy(site)
+	if err != nil {
+		fmt.Printf("%s: error reading the crawl policy of the site: %s\n", site, err)
+	}
+	metas, err := getPageMetas(site)
+	if err != nil {
+		// without stored validators every page is simply fetched in full
+		fmt.Printf("%s: error fetching page validators: %s\n", site, err)
+		metas = make(map[string]pageMeta)
+	}
+	c := &siteCrawl{
+		ctx:     ctx,
+		site:    site,
+		host:    host,
+		emit:    emit,
+		visited: map[string]bool{start: true},
+		metas:   metas,
+		changed: make(map[string]pageMeta),
+		policy:  policy,
+	}
+	if !conf.Crawler.IgnoreRobots {
+		c.robots = robots.rulesFor(strings.ToLower(root.Scheme)+"://"+host, host)
+	}
+	if err := c.loadCheckpoint(); err != nil {
+		fmt.Printf("%s: error reading the crawl checkpoint, crawling from the start: %s\n", site, err)
+		c.resumed, c.first = nil, ""
+	}
+	if conf.Crawler.Incremental {
+		// a site that was never crawled has the site url itself as last link
+		c.watermark = blog.lastLink
+		if c.watermark == "" {
+			c.watermark = start
 		}
-		return nil
-	} else {
-		return fmt.Errorf("%s: error in findAllLinks", site)
 	}
+	return c, start, nil
 }
 
-// implements the crawl functionality
-func crawl() (map[string][]string, error) {
-	// crawl the sites
-	// get the all the blogs
-	blogs, err := listAllSites()
-	if err != nil {
-		fmt.Printf("error fetching items from blogs table\n")
-		return nil, err
+// returns the normalized form of href found on page and whether the crawl may follow it:
+// it is on the host of the site, seen for the first time, allowed by robots.txt and
+// wanted by the policy of the site. Links that are not are neither stored nor fetched
+func (c *siteCrawl) follows(page *url.URL, href string) (string, bool) {
+	link, ok := normalizeLink(page, href, c.host)
+	if !ok || c.visited[link] {
+		return "", false
 	}
+	c.visited[link] = true
+	if u, err := url.Parse(link); err != nil || !c.robots.allows(u) || !c.policy.wants(u) {
+		return "", false
+	}
+	return link, true
+}
 
-	postsCh := make(chan []blogPostsLink)
-	errCh := make(chan error)
-	wg := &sync.WaitGroup{}
+// records href found on page as a post of the site, returns its normalized form and
+// whether the crawl follows it, see follows. The caller hands the post to emitPost
+func (c *siteCrawl) discover(page *url.URL, href string) (string, bool) {
+	link, ok := c.follows(page, href)
+	if !ok {
+		return "", false
+	}
+	if c.first == "" {
+		c.first = link
+	}
+	return link, true
+}
 
-	for _, blog := range blogs {
-		wg.Add(1)
-		go func(site string) {
-			defer wg.Done()
-			links := make([]blogPostsLink, 0)
-			err := _crawl(site, site, &links)
-			if err != nil {
-				errCh <- err
-			} else {
-				postsCh <- links
-			}
-			if n := len(links) - 1; n > 0 {
-				err = updateLastSiteVisited(site, links[n].link)
-				if err != nil {
-					errCh <- err
-				}
-			}
-		}(blog)
+// queues a discovered post for storing, along with its title and the fingerprint of its
+// text when its page or feed entry was read
+func (c *siteCrawl) emitPost(link, title string, fingerprint uint64) {
+	c.pending.posts = append(c.pending.posts, blogPostsLink{
+		site:        c.site,
+		link:        link,
+		title:       title,
+		fingerprint: fingerprint,
+	})
+	if len(c.pending.posts) >= CRAWL_CHUNK_SIZE {
+		c.flush()
 	}
+}
 
-	go func() {
-		wg.Wait()
-		close(postsCh)
-		close(errCh)
-	}()
+// records that the crawl is done with a page, after the posts found on it were emitted,
+// along with the pages it queued from there. The fetched pages go into the checkpoint
+// every CHECKPOINT_PAGES pages
+func (c *siteCrawl) fetchedPage(item crawlItem, queued []crawlItem) {
+	c.pending.fetched = append(c.pending.fetched, item)
+	c.pending.queued = append(c.pending.queued, queued...)
+	if len(c.pending.fetched) >= CHECKPOINT_PAGES {
+		c.flush()
+	}
+}
 
-	siteLinksMap := make(map[string][]string)
+// records the fingerprint of the set of links found on a page and reports whether it is
+// the one of the previous crawl. Such a page has nothing new to discover, even when
+// another part of it changed, and it is not diffed or expanded again
+func (c *siteCrawl) sameLinks(link string, links []string) bool {
+	fingerprint := linkSetFingerprint(links)
+	meta, ok := c.changed[link]
+	if !ok {
+		meta = c.metas[link]
+	}
+	if meta.linksHash != fingerprint {
+		meta.linksHash = fingerprint
+		c.changed[link] = meta
+	}
+	if fingerprint != c.metas[link].linksHash {
+		return false
+	}
+	metrics.observeUnchangedLinks(c.site)
+	return true
+}
 
-	for linksSlice := range postsCh {
-		blog := linksSlice[0].site
-		_, ok := siteLinksMap[blog]
-		if !ok {
-			siteLinksMap[blog] = make([]string, 0)
-		}
-		for _, link := range linksSlice {
-			siteLinksMap[blog] = append(siteLinksMap[blog], link.link)
+// hands the links discovered and the pages fetched since the last flush over to emit,
+// along with the validators of those pages
+func (c *siteCrawl) flush() {
+	chunk := c.pending
+	if len(chunk.posts) == 0 && len(chunk.fetched) == 0 && !chunk.done {
+		return
+	}
+	chunk.site, chunk.first = c.site, c.first
+	chunk.metas = make(map[string]pageMeta)
+	for _, item := range chunk.fetched {
+		if meta, ok := c.changed[item.link]; ok {
+			chunk.metas[item.link] = meta
 		}
 	}
-	for err := range errCh {
-		fmt.Println(err)
+	c.emit(chunk)
+	c.pending = crawlChunk{}
+}
+
+// reports whether the crawl may go on after fetched pages, within the page and byte
+// budgets of the site
+func (c *siteCrawl) withinBudget(fetched int) bool {
+	if fetched >= c.policy.maxPages {
+		return false
+	}
+	if c.bytes >= c.policy.maxBytes {
+		fmt.Printf("%s: stopping after %d bytes, the byte budget of the site\n", c.site, c.bytes)
+		return false
 	}
-	return siteLinksMap, nil
+	return true
 }
 
-// parses the config file, crawls the blog site, finds new blogposts
-// and notifies the user if there are any new blog posts
-func run() error {
-	// crawl
-	site_links_map, err := crawl()
-	if err != nil {
-		return err
+// fetches and parses a document of the site through the host limiter, conditional on
+// the validators stored for it, unless robots.txt disallows it
+func fetchForSite[T any](c *siteCrawl, link string, parse func(io.Reader, string) (T, error)) (T, bool, error) {
+	if u, err := url.Parse(link); err != nil || !c.robots.allows(u) {
+		var none T
+		return none, false, fmt.Errorf("%s: disallowed by robots.txt", link)
 	}
-	// update the database for the new posts
-	for blog, posts := range site_links_map {
-		for _, post := range posts {
-			_, err := addNewPostIfNotExist(blog, post)
-			if err != nil {
+	meta := c.metas[link]
+	st := &fetchStats{}
+	limiter.acquire(c.host)
+	doc, unchanged, err := fetchParsed(link, &meta, parse, st)
+	limiter.release(c.host)
+	c.bytes += st.bytes
+	metrics.observeFetch(c.site, st, err)
+	if err == nil && meta != c.metas[link] {
+		c.changed[link] = meta
+	}
+	return doc, unchanged, err
+}
+
+// collects the posts of a site from its feed or sitemap, following a sitemap index
+// down to the sitemaps it lists. One fetch lists every post, there is no need to walk
+// the html pages of the site
+func (c *siteCrawl) crawlFeed(feed string) error {
+	queue, fetched := c.resume(crawlItem{link: feed})
+	for ; len(queue) > 0 && c.withinBudget(fetched); fetched++ {
+		if err := c.ctx.Err(); err != nil {
+			return err
+		}
+		item := queue[0]
+		queue = queue[1:]
+		sitemaps, err := c.crawlFeedDoc(item.link)
+		if err != nil {
+			if item.link == feed {
 				return err
 			}
+			fmt.Println(err)
 		}
+		c.fetchedPage(item, sitemaps)
+		queue = append(queue, sitemaps...)
 	}
+	c.leave(crawlItem{link: feed}, queue)
 	return nil
 }
 
-func syncBlogs(configFile string) error {
-	err := parseConfig(configFile)
+// reads a feed or sitemap, emitting the posts it lists, and returns the sitemaps it
+// lists that the crawl did not queue yet
+func (c *siteCrawl) crawlFeedDoc(link string) ([]crawlItem, error) {
+	doc, unchanged, err := fetchForSite(c, link, parseFeed)
 	if err != nil {
-		return err
+		return nil, err
+	}
+	if unchanged || c.sameLinks(link, append(doc.links, doc.sitemaps...)) {
+		return nil, nil
 	}
-	// crawl
-	site_links_map, err := crawl()
+	base, err := url.Parse(link)
 	if err != nil {
-		return err
+		return nil, nil
 	}
-	// update the database for the new posts
-	for blog, posts := range site_links_map {
-		for _, post := range posts {
-			ok, err := addNewPostIfNotExist(blog, post)
-			if err != nil {
-				return err
-			}
-			if ok {
-				err = addMail(blog, post)
-				if err != nil {
-					return err
-				}
-			}
+	for i, href := range doc.links {
+		if link, ok := c.discover(base, href); ok {
+			c.emitPost(link, doc.titles[i], doc.fingerprints[i])
 		}
 	}
-	// notify the user about the new sites
-	err = notify()
-	if err != nil {
-		return err
+	sitemaps := []crawlItem{}
+	for _, href := range doc.sitemaps {
+		if sitemap, ok := c.follows(base, href); ok {
+			sitemaps = append(sitemaps, crawlItem{link: sitemap})
+		}
 	}
-	return nil
+	return sitemaps, nil
 }
 
-func main() {
-	// Parse command-line arguments
-	parseFlag := flag.String("config", "", "parse the config file")
-	migrateFlag := flag.Bool("migrate", false, "Create sqlite3 database and prepare tables")
-	exploreFlag := flag.String("explore", "", "Add site to watchlist")
-	listFlag := flag.Bool("list", false, "List saved sites")
-	removeFlag := flag.String("remove", "", "Remove site from watchlist")
-	crawlFlag := flag.Bool("crawl", false, "Crawl all the blog sites curently in the blogs table (watchlist)")
-
-	listPostsCommand := flag.NewFlagSet("listPosts", flag.ExitOnError)
-	updateCommand := flag.NewFlagSet("updateLastLink", flag.ExitOnError)
-	syncCommand := flag.NewFlagSet("sync", flag.ExitOnError)
-
-	// Define multiple flags for the FlagSet
-	var (
-		flagBlogSite = updateCommand.String("site", "", "web address of the blog site")
-		flagLastLink = updateCommand.String("post", "", "web address of the latest blog post")
-		flagSite     = listPostsCommand.String("site", "", "web address of the blog site")
-		flagConfig   = syncCommand.String("conf", "", "config file name")
-	)
-
-	fmt.Println(strings.Join(os.Args, " "))
-
-	// Check if command and flags are provided
-	if len(os.Args) <= 3 {
-		flag.Parse()
-
-		flag.Parse()
-		if *parseFlag != "" {
-			err := parseConfig(*parseFlag)
-			if err != nil {
-				log.Fatal(err)
-			}
-			return
+// crawls the html pages of a blog site breadth first starting at its root. Every page is
+// fetched at most once, pages deeper than the configured max depth are not followed,
+// and the crawl stops once the page or byte budget of the site is spent. Pages that did not change since the
+// previous crawl, or whose links did not, are not expanded, their links were already
+// discovered back then. In incremental mode the crawl also stops short of the posts it
+// already knows, see linksToFollow. A post the crawl follows is stored once its page
+// was read, with the fingerprint of its text, the others as soon as they are found
+func (c *siteCrawl) crawlPages(start string) error {
+	maxDepth, _ := crawlerLimits()
+	frontier, fetched := c.resume(crawlItem{link: start, depth: 0})
+	for ; len(frontier) > 0 && c.withinBudget(fetched); fetched++ {
+		if err := c.ctx.Err(); err != nil {
+			return err
 		}
-
-		if *migrateFlag {
-			fmt.Println("migrate")
-			err := migrate()
-			if err != nil {
-				log.Fatal(err)
-			}
-			return
+		item := frontier[0]
+		frontier = frontier[1:]
+		queued, err := c.crawlPage(item, maxDepth)
+		if err != nil {
+			return err
 		}
-
-		if *exploreFlag != "" {
-			fmt.Println("explore")
-			if err := addNewSite(*exploreFlag, *exploreFlag); err != nil {
-				log.Fatal(err)
-			}
-			return
+		c.fetchedPage(item, queued)
+		frontier = append(frontier, queued...)
+	}
+	// the links left when the crawl ran out of budget are stored without a fingerprint,
+	// the next crawl fetches them, see leave
+	for _, item := range frontier {
+		if item.depth > 0 {
+			c.emitPost(item.link, "", 0)
 		}
+	}
+	c.leave(crawlItem{link: start, depth: 0}, frontier)
+	return nil
+}
 
-		if *listFlag {
-			fmt.Println("list")
-			sites, err := listAllSites()
-			if err != nil {
-				log.Fatal(err)
-			}
-			for site, lastLink := range sites {
-				fmt.Printf("%s %s\n", site, lastLink)
-			}
-			return
+// keeps the frontier a crawl had no budget for as the checkpoint of the site, the next
+// crawl goes on with it instead of stopping at the start page, which did not change. The
+// start is fetched again first, so posts published in between are not missed
+func (c *siteCrawl) leave(start crawlItem, frontier []crawlItem) {
+	if len(frontier) > 0 {
+		c.left = append([]crawlItem{start}, frontier...)
+	}
+}
+
+// fetches a page of the crawl, emits the posts found on it and returns the pages to
+// follow from there. Fails only when the site root cannot be fetched
+func (c *siteCrawl) crawlPage(item crawlItem, maxDepth int) ([]crawlItem, error) {
+	doc, unchanged, err := fetchForSite(c, item.link, parsePage)
+	if item.depth > 0 {
+		c.emitPost(item.link, doc.title, doc.fingerprint)
+	}
+	if err != nil {
+		if item.depth == 0 {
+			return nil, fmt.Errorf("%s: error in findAllLinks", c.site)
 		}
-		if *removeFlag != "" {
-			fmt.Println("remove")
-			if err := removeSite(*removeFlag); err != nil {
-				log.Fatal(err)
-			}
-			return
+		// one broken page should not throw away the rest of the site
+		fmt.Println(err)
+		return nil, nil
+	}
+	if unchanged || c.sameLinks(item.link, doc.links) {
+		return nil, nil
+	}
+	page, err := url.Parse(item.link)
+	if err != nil {
+		return nil, nil
+	}
+	found := make([]string, 0, len(doc.links))
+	atWatermark := false
+	for _, _link := range doc.links {
+		if link, ok := normalizeLink(page, _link, c.host); ok && link == c.watermark {
+			atWatermark = true
 		}
-		if *crawlFlag {
-			fmt.Println("crawl")
-			if err := run(); err != nil {
-				log.Fatal(err)
-			}
-			return
+		if link, ok := c.discover(page, _link); ok {
+			found = append(found, link)
 		}
-	} else if os.Args[1] == "updateLastLink" {
-		updateCommand.Parse(os.Args[2:])
+	}
+	follow := []string{}
+	if item.depth < maxDepth {
+		follow = c.linksToFollow(found, atWatermark)
+	}
+	queued := make([]crawlItem, 0, len(follow))
+	followed := make(map[string]bool, len(follow))
+	for _, link := range follow {
+		followed[link] = true
+		queued = append(queued, crawlItem{link: link, depth: item.depth + 1})
+	}
+	for _, link := range found {
+		if !followed[link] {
+			c.emitPost(link, "", 0)
+		}
+	}
+	return queued, nil
+}
 
-		// Check individual flags
-		if *flagBlogSite != "" && *flagLastLink != "" {
-			err := updateLastSiteVisited(*flagBlogSite, *flagLastLink)
-			if err != nil {
-				log.Fatal(err)
-			}
-			return
+// picks the links found on a page that the crawl goes on with. Outside incremental mode
+// that is all of them. In incremental mode the posts stored by an earlier crawl were
+// followed back then: a page that lists nothing new, or that lists the newest post of
+// the previous crawl, is where the known part of the site begins, and only its new links
+// are followed. Above that watermark the known links are followed as well, pagination
+// may lead to more new posts
+func (c *siteCrawl) linksToFollow(found []string, atWatermark bool) []string {
+	if c.watermark == "" || len(found) == 0 {
+		return found
+	}
+	known, err := knownPosts(c.site, found)
+	if err != nil {
+		fmt.Printf("%s: error looking up known posts: %s\n", c.site, err)
+		return found
+	}
+	follow := make([]string, 0, len(found))
+	for _, link := range found {
+		if !known[link] {
+			follow = append(follow, link)
 		}
-	} else if os.Args[1] == "listPosts" {
-		listPostsCommand.Parse(os.Args[2:])
-		if *flagSite != "" {
-			blogPosts, err := getPostsForSite(*flagSite)
-			if err != nil {
-				log.Fatal(err)
-			}
-			for _, bp := range blogPosts {
-				fmt.Println(bp)
-			}
+	}
+	if len(follow) == 0 || atWatermark {
+		return follow
+	}
+	return found
+}
+
+// crawls a blog site. Sites with a feed or sitemap are read from it, the html pages are
+// only crawled when there is none or it cannot be read. The links found are handed to
+// emit in chunks while the crawl goes on, along with the checkpoint of the crawl. A crawl
+// that is stopped through ctx leaves its checkpoint for the next crawl of the site to
+// resume from, one that ends drops it, and when it succeeded the first link found, the
+// newest post, becomes the last link of the site. Both happen along with storing the
+// last posts found, never ahead of them
+func _crawl(ctx context.Context, blog blogSite, emit func(chunk crawlChunk)) error {
+	c, start, err := newSiteCrawl(ctx, blog, emit)
+	if err != nil {
+		return err
+	}
+	err = c.crawlSite(blog.feed, start)
+	if err != nil && err == ctx.Err() {
+		c.flush()
+		return err
+	}
+	c.pending.done = true
+	if err == nil {
+		c.pending.lastLink, c.pending.left = c.first, c.left
+	}
+	c.flush()
+	return err
+}
+
+// reads the site from its feed, falling back to its pages. A resumed crawl goes on with
+// the one it was reading
+func (c *siteCrawl) crawlSite(feed, start string) error {
+	if feed != "" && (c.resumed == nil || c.inCheckpoint(feed)) {
+		err := c.crawlFeed(feed)
+		if err == nil || err == c.ctx.Err() {
+			return err
+		}
+		fmt.Printf("%s: error reading feed %s, crawling the site instead: %s\n", c.site, feed, err)
+	}
+	return c.crawlPages(start)
+}
+
+// crawls the given blogs on the crawl pool, sending the links found to out as they are
+// discovered. Once ctx is done the crawls stop, and the blogs not crawled yet are not
+// started. Returns the error of every site that could not be crawled
+func crawlBlogs(ctx context.Context, blogs []blogSite, out chan<- crawlChunk) map[string]error {
+	if limiter == nil {
+		limiter = newHostLimiter(orDefault(conf.Crawler.PerHost, DEFAULT_PER_HOST), conf.Crawler.Delay)
+	}
+	pool := newWorkerPool("crawl", orDefault(conf.Crawler.Workers, DEFAULT_CRAWL_WORKERS))
+
+	mu := &sync.Mutex{}
+	siteErrors := make(map[string]error)
+
+	pool.run(len(blogs), func(i int) {
+		if ctx.Err() != nil {
 			return
 		}
-	} else if os.Args[1] == "sync" {
-		syncCommand.Parse(os.Args[2:])
-		if *flagConfig != "" {
-			err := syncBlogs(*flagConfig)
-			if err != nil {
-				log.Fatal(err)
-			}
+		site := blogs[i].site
+		err := _crawl(ctx, blogs[i], func(chunk crawlChunk) { out <- chunk })
+		if err == nil || err == ctx.Err() {
 			return
 		}
-	} else {
-		fmt.Println("Invalid command")
+		fmt.Println(err)
+		mu.Lock()
+		siteErrors[site] = err
+		mu.Unlock()
+	})
+	fmt.Println(pool)
+	return siteErrors
+}
+
+// parses the config file, crawls the blog site, finds new blogposts
+// and notifies the user if there are any new blog posts
+func run() error {
+	blogs, err := listBlogs()
+	if err != nil {
+		fmt.Printf("error fetching items from blogs table\n")
+		return err
+	}
+	ctx, stop := interruptContext()
+	defer stop()
+	// crawl and update the database for the new posts
+	_, _, err = runPipeline(ctx, blogs, false)
+	if err == nil && ctx.Err() != nil {
+		return errCrawlStopped
+	}
+	return err
+}
+
+// runs a full sync, printing the metrics of the run at its end in the given format
+// unless it is empty
+func syncBlogs(configFile, metricsFormat string) error {
+	err := parseConfig(configFile)
+	if err != nil {
+		return err
+	}
+	blogs, err := listBlogs()
+	if err != nil {
+		fmt.Printf("error fetching items from blogs table\n")
+		return err
+	}
+	ctx, stop := interruptContext()
+	defer stop()
+	// crawl, update the database for the new posts queueing a mail for each of them,
+	// and notify the user about them
+	_, _, err = runPipeline(ctx, blogs, true)
+	if err != nil {
+		return err
+	}
+	if ctx.Err() != nil {
+		return errCrawlStopped
+	}
+	return writeMetrics(metricsFormat)
+}
+
+func main() {
+	args := os.Args[1:]
+	for len(args) > 0 && (args[0] == "--quiet" || args[0] == "-quiet") {
+		quiet, args = true, args[1:]
+	}
+	diagnostic(strings.Join(os.Args, " "))
+
+	cmd, args, err := findCommand(args)
+	if err != nil {
+		fmt.Println(err)
+		usage()
 		os.Exit(1)
 	}
+	err = cmd.run(args)
+	closeDB()
+	if err != nil {
+		log.Fatal(err)
+	}
 }
@@ -0,0 +1,221 @@
+package main
+
+import (
+	"context"
+	"database/sql"
+	"errors"
+	"fmt"
+	"os"
+	"os/signal"
+	"syscall"
+	"time"
+)
+
+// a crawl checkpoints its progress while it goes: the pages of its frontier, those it
+// fetched and those it queued, are stored in the same transactions as the posts found on
+// them. A crawl that was interrupted, by a signal or because the process died, is resumed
+// from its checkpoint by the next crawl of the site, which neither fetches the pages
+// fetched before again nor loses the posts queued to be followed. A checkpoint older than
+// CHECKPOINT_MAX_AGE is dropped and the site crawled from the start, the pages fetched
+// back then may well have changed since. A process that dies without a signal fetches the
+// last CHECKPOINT_PAGES pages of each of its crawls again at most. A crawl that ran out of
+// its page or byte budget leaves the pages it did not fetch as a checkpoint as well, the
+// next crawl of the site fetches them with a budget of its own
+const (
+	CHECKPOINT_PAGES   = 16
+	CHECKPOINT_MAX_AGE = 24 * time.Hour
+)
+
+// returned by the commands whose crawl was interrupted
+var errCrawlStopped = errors.New("interrupted, the next run resumes the crawl")
+
+// a page of a checkpointed frontier
+type frontierPage struct {
+	crawlItem
+	fetched bool
+}
+
+// returns a context that is done once the process is asked to stop with SIGINT or
+// SIGTERM. A crawl under it finishes the pages it is fetching, stores what it found along
+// with its checkpoint and stops
+func interruptContext() (context.Context, context.CancelFunc) {
+	return signal.NotifyContext(context.Background(), os.Interrupt, syscall.SIGTERM)
+}
+
+// reads the checkpoint of an interrupted crawl of the site, which the crawl then resumes:
+// the links it saw are not discovered again and the newest post it found stays the
+// first link. A checkpoint without a frontier or that is too old is dropped
+func (c *siteCrawl) loadCheckpoint() error {
+	db, err := getDBConnection()
+	if err != nil {
+		return err
+	}
+	first, startedAt := "", int64(0)
+	err = db.QueryRow(FETCH_CRAWL_SITE, c.site).Scan(&first, &startedAt)
+	if err == sql.ErrNoRows {
+		return nil
+	}
+	if err != nil {
+		return err
+	}
+	rows, err := db.Query(FETCH_CRAWL_FRONTIER, c.site)
+	if err != nil {
+		return err
+	}
+	defer rows.Close()
+	pages, fetched := make([]frontierPage, 0), false
+	for rows.Next() {
+		page := frontierPage{}
+		if err := rows.Scan(&page.link, &page.depth, &page.fetched); err != nil {
+			return err
+		}
+		pages = append(pages, page)
+		fetched = fetched || page.fetched
+	}
+	if err = rows.Err(); err != nil {
+		return err
+	}
+	// the pages left by a crawl out of budget were never fetched, they do not get old
+	if len(pages) == 0 || (fetched && time.Since(time.UnixMilli(startedAt)) > CHECKPOINT_MAX_AGE) {
+		return clearCheckpoint(db, c.site)
+	}
+	c.resumed, c.first = pages, first
+	for _, page := range pages {
+		c.visited[page.link] = true
+	}
+	return nil
+}
+
+// drops the checkpoint of a site
+func clearCheckpoint(db *sql.DB, site string) error {
+	tx, err := db.Begin()
+	if err != nil {
+		return err
+	}
+	defer tx.Rollback()
+	for _, query := range []string{CLEAR_CRAWL_FRONTIER, CLEAR_CRAWL_SITE} {
+		if _, err = tx.Exec(query, site); err != nil {
+			return err
+		}
+	}
+	return tx.Commit()
+}
+
+// reports whether link is a page of the checkpoint being resumed
+func (c *siteCrawl) inCheckpoint(link string) bool {
+	for _, page := range c.resumed {
+		if page.link == link {
+			return true
+		}
+	}
+	return false
+}
+
+// returns the frontier the crawl starts with and how many pages it fetched already: the
+// pages left in the checkpoint when resuming, or else start alone
+func (c *siteCrawl) resume(start crawlItem) ([]crawlItem, int) {
+	if c.resumed == nil {
+		c.visited[start.link] = true
+		return []crawlItem{start}, 0
+	}
+	frontier, fetched := make([]crawlItem, 0), 0
+	for _, page := range c.resumed {
+		if page.fetched {
+			fetched++
+		} else {
+			frontier = append(frontier, page.crawlItem)
+		}
+	}
+	c.resumed = nil
+	fmt.Printf("%s: resuming the crawl, %d pages fetched, %d queued\n", c.site, fetched, len(frontier))
+	return frontier, fetched
+}
+
+// the statements that write checkpoints in the transaction storing the posts
+type checkpointStmts struct {
+	tx      *sql.Tx
+	queue   *sql.Stmt
+	fetched *sql.Stmt
+	page    *sql.Stmt
+}
+
+func prepareCheckpoint(tx *sql.Tx) (*checkpointStmts, error) {
+	s := &checkpointStmts{tx: tx}
+	var err error
+	if s.queue, err = tx.Prepare(QUEUE_CRAWL_PAGE); err != nil {
+		return nil, err
+	}
+	if s.fetched, err = tx.Prepare(MARK_CRAWL_FETCHED); err != nil {
+		s.close()
+		return nil, err
+	}
+	if s.page, err = tx.Prepare(UPSERT_PAGE); err != nil {
+		s.close()
+		return nil, err
+	}
+	return s, nil
+}
+
+func (s *checkpointStmts) close() {
+	for _, stmt := range []*sql.Stmt{s.queue, s.fetched, s.page} {
+		if stmt != nil {
+			stmt.Close()
+		}
+	}
+}
+
+// writes the progress a chunk reports: the validators of the pages fetched, and either
+// the fetched and queued pages into the checkpoint, or, for the last chunk of a crawl,
+// the new last link of the site while the checkpoint is dropped, or replaced by the
+// pages the crawl had no budget for
+func (s *checkpointStmts) save(chunk crawlChunk, now int64) error {
+	for link, meta := range chunk.metas {
+		_, err := s.page.Exec(link, chunk.site, meta.etag, meta.lastModified, meta.contentHash, meta.linksHash)
+		if err != nil {
+			fmt.Printf("error saving validators of page %s in the pages table\n", link)
+			return err
+		}
+	}
+	if chunk.done {
+		if chunk.lastLink != "" {
+			if _, err := s.tx.Exec(UPDATE_BLOG, chunk.lastLink, chunk.site); err != nil {
+				fmt.Printf("error updating last_link %s for blog %s in the blogs table\n", chunk.lastLink, chunk.site)
+				return err
+			}
+		}
+		for _, query := range []string{CLEAR_CRAWL_FRONTIER, CLEAR_CRAWL_SITE} {
+			if _, err := s.tx.Exec(query, chunk.site); err != nil {
+				return err
+			}
+		}
+		if len(chunk.left) == 0 {
+			return nil
+		}
+		if _, err := s.tx.Exec(START_CRAWL, chunk.site, chunk.first, now); err != nil {
+			return err
+		}
+		for _, item := range chunk.left {
+			if _, err := s.queue.Exec(chunk.site, item.link, item.depth); err != nil {
+				return err
+			}
+		}
+		return nil
+	}
+	if len(chunk.fetched) == 0 && len(chunk.queued) == 0 {
+		return nil
+	}
+	if _, err := s.tx.Exec(START_CRAWL, chunk.site, chunk.first, now); err != nil {
+		return err
+	}
+	for _, item := range chunk.fetched {
+		if _, err := s.fetched.Exec(chunk.site, item.link, item.depth); err != nil {
+			return err
+		}
+	}
+	for _, item := range chunk.queued {
+		if _, err := s.queue.Exec(chunk.site, item.link, item.depth); err != nil {
+			return err
+		}
+	}
+	return nil
+}
@@ -0,0 +1,291 @@
+package main
+
+import (
+	"bufio"
+	"flag"
+	"fmt"
+	"os"
+	"strings"
+	"time"
+)
+
+// a command of the CLI. The commands of the first versions are flags, --name or
+// --name VALUE, the later ones sub-commands with flags of their own
+type command struct {
+	name  string
+	flag  bool   // invoked as --name
+	value string // what --name takes, empty for a command without a value
+	usage string
+	run   func(args []string) error
+}
+
+// the commands in the order the usage lists them. Only the command that runs registers
+// its flags, and everything a command needs beyond that is set up on first use by the
+// code that needs it: the config file by the commands that take one, the database by
+// getDBConnection, the HTTP client by getHTTPClient and the SMTP sessions by notify
+var commands = []command{
+	{name: "config", flag: true, value: "FILE", usage: "print the settings of a config file", run: configCommand},
+	{name: "migrate", flag: true, usage: "create the database or bring it up to date", run: migrateCommand},
+	{name: "explore", flag: true, value: "URL", usage: "add a site to the watchlist", run: exploreCommand},
+	{name: "list", flag: true, usage: "list the watched sites", run: listCommand},
+	{name: "remove", flag: true, value: "URL", usage: "remove a site from the watchlist", run: removeCommand},
+	{name: "crawl", flag: true, usage: "crawl the watched sites and store their new posts", run: crawlCommand},
+	{name: "links", flag: true, value: "URL", usage: "print the links the crawler finds on a page", run: linksCommand},
+	{name: "updateLastLink", usage: "set the newest known post of a site", run: updateLastLinkCommand},
+	{name: "listPosts", usage: "list the stored posts", run: listPostsCommand},
+	{name: "sync", usage: "crawl the watched sites and notify their new posts", run: syncCommand},
+	{name: "watch", usage: "keep polling the watched sites as they become due", run: watchCommand},
+	{name: "import", usage: "add the sites of a watchlist file", run: importCommand},
+	{name: "export", usage: "write the watched sites to a watchlist file", run: exportCommand},
+	{name: "policy", usage: "set the crawl patterns and budgets of a site", run: policyCommand},
+}
+
+// set by a leading --quiet, which leaves out the echo of the command line and the name
+// of the command that runs, so that the output is only what the command prints
+var quiet bool
+
+// prints a diagnostic line unless --quiet is set
+func diagnostic(line string) {
+	if !quiet {
+		fmt.Println(line)
+	}
+}
+
+// looks up the command named by the command line and returns it along with its
+// arguments: the value of a --name command, the flags of a sub-command
+func findCommand(args []string) (command, []string, error) {
+	if len(args) == 0 {
+		return command{}, nil, fmt.Errorf("no command input specified")
+	}
+	name, value, hasValue := args[0], "", false
+	isFlag := strings.HasPrefix(name, "-")
+	if isFlag {
+		name, value, hasValue = strings.Cut(strings.TrimLeft(name, "-"), "=")
+	}
+	for _, cmd := range commands {
+		if cmd.name != name || cmd.flag != isFlag {
+			continue
+		}
+		if !isFlag {
+			return cmd, args[1:], nil
+		}
+		if cmd.value == "" {
+			return cmd, nil, nil
+		}
+		if !hasValue {
+			if len(args) < 2 {
+				return cmd, nil, fmt.Errorf("--%s needs a %s", cmd.name, cmd.value)
+			}
+			value = args[1]
+		}
+		return cmd, []string{value}, nil
+	}
+	return command{}, nil, fmt.Errorf("Invalid command %s", args[0])
+}
+
+// prints the commands
+func usage() {
+	fmt.Fprintln(os.Stderr, "usage: blognotifier [--quiet] COMMAND")
+	for _, cmd := range commands {
+		name := cmd.name
+		if cmd.flag {
+			name = strings.TrimSpace("--" + name + " " + cmd.value)
+		}
+		fmt.Fprintf(os.Stderr, "  %-22s %s\n", name, cmd.usage)
+	}
+}
+
+func configCommand(args []string) error {
+	if err := parseConfig(args[0]); err != nil {
+		return err
+	}
+	printConfig()
+	return nil
+}
+
+func migrateCommand([]string) error {
+	diagnostic("migrate")
+	return migrate()
+}
+
+func exploreCommand(args []string) error {
+	diagnostic("explore")
+	site, ok := normalizeSite(args[0])
+	if !ok {
+		return fmt.Errorf("%s is not a http or https url", args[0])
+	}
+	if err := addNewSite(site, site); err != nil {
+		return err
+	}
+	feed, err := discoverFeed(site)
+	if err != nil {
+		// the site is still watched, it is crawled page by page
+		fmt.Printf("error looking for the feed of %s: %s\n", site, err)
+		return nil
+	}
+	if feed == "" {
+		fmt.Println("no feed or sitemap found, the site will be crawled")
+		return nil
+	}
+	fmt.Printf("feed: %s\n", feed)
+	return updateBlogFeed(site, feed)
+}
+
+func listCommand([]string) error {
+	diagnostic("list")
+	w := bufio.NewWriter(os.Stdout)
+	err := listSites(func(site, lastLink string) error {
+		_, err := fmt.Fprintf(w, "%s %s\n", site, lastLink)
+		return err
+	})
+	if err != nil {
+		return err
+	}
+	return w.Flush()
+}
+
+func removeCommand(args []string) error {
+	diagnostic("remove")
+	site, ok := normalizeSite(args[0])
+	if !ok {
+		site = args[0]
+	}
+	return removeSite(site)
+}
+
+func crawlCommand([]string) error {
+	diagnostic("crawl")
+	return run()
+}
+
+func linksCommand(args []string) error {
+	links, _, err := findAllLinks(args[0], &pageMeta{})
+	if err != nil {
+		return err
+	}
+	w := bufio.NewWriter(os.Stdout)
+	for _, link := range links {
+		fmt.Fprintln(w, link)
+	}
+	return w.Flush()
+}
+
+func updateLastLinkCommand(args []string) error {
+	fs := flag.NewFlagSet("updateLastLink", flag.ExitOnError)
+	site := fs.String("site", "", "web address of the blog site")
+	lastLink := fs.String("post", "", "web address of the latest blog post")
+	fs.Parse(args)
+	if *site == "" || *lastLink == "" {
+		return fmt.Errorf("usage: updateLastLink --site URL --post URL")
+	}
+	return updateLastSiteVisited(*site, *lastLink)
+}
+
+func listPostsCommand(args []string) error {
+	fs := flag.NewFlagSet("listPosts", flag.ExitOnError)
+	site := fs.String("site", "", "web address of the blog site")
+	since := fs.String("since", "", "list the posts discovered since a date like 2006-01-02 or for a duration like 7d, the newest first")
+	search := fs.String("search", "", "list the posts whose title or link contain all these words, the newest first")
+	limit := fs.Int("limit", 0, "list at most this many posts, the newest first")
+	fs.Parse(args)
+
+	w := bufio.NewWriter(os.Stdout)
+	var err error
+	switch {
+	case *since != "" || *search != "" || *limit > 0:
+		filter := postFilter{site: *site, search: *search, limit: *limit}
+		if *since != "" {
+			if filter.since, err = parseSince(*since, time.Now()); err != nil {
+				return err
+			}
+		}
+		err = queryPosts(filter, func(post postRow) error {
+			line := post.discoveredAt.Format(time.RFC3339) + " " + post.link
+			if post.title != "" {
+				line += " " + post.title
+			}
+			_, err := fmt.Fprintln(w, line)
+			return err
+		})
+	case *site != "":
+		err = listPostsForSite(*site, func(link string) error {
+			_, err := fmt.Fprintln(w, link)
+			return err
+		})
+	default:
+		return fmt.Errorf("usage: listPosts [--site URL] [--since WHEN] [--search WORDS] [--limit N]")
+	}
+	if err != nil {
+		return err
+	}
+	return w.Flush()
+}
+
+func syncCommand(args []string) error {
+	fs := flag.NewFlagSet("sync", flag.ExitOnError)
+	configFile := fs.String("conf", "", "config file name")
+	metricsFormat := fs.String("metrics", "", "print the metrics of the run at its end, as json or prometheus")
+	shard := fs.Bool("shard", false, "share the sync with the other sharded syncs on the database")
+	fs.Parse(args)
+	if !validMetricsFormat(*metricsFormat) {
+		return fmt.Errorf("unknown metrics format %s, use json or prometheus", *metricsFormat)
+	}
+	if *configFile == "" {
+		return fmt.Errorf("usage: sync --conf FILE [--metrics json|prometheus] [--shard]")
+	}
+	if *shard {
+		return syncSharded(*configFile, *metricsFormat)
+	}
+	return syncBlogs(*configFile, *metricsFormat)
+}
+
+func watchCommand(args []string) error {
+	fs := flag.NewFlagSet("watch", flag.ExitOnError)
+	configFile := fs.String("conf", "", "config file name")
+	duration := fs.Duration("for", 0, "stop watching after this long, 0 watches until interrupted")
+	metricsFormat := fs.String("metrics", "", "print the metrics of every poll, as json or prometheus")
+	shard := fs.Bool("shard", false, "share the watchlist with the other sharded watches on the database")
+	fs.Parse(args)
+	if !validMetricsFormat(*metricsFormat) {
+		return fmt.Errorf("unknown metrics format %s, use json or prometheus", *metricsFormat)
+	}
+	if *configFile == "" {
+		return fmt.Errorf("usage: watch --conf FILE [--for DURATION] [--metrics json|prometheus] [--shard]")
+	}
+	return watchBlogs(*configFile, *duration, *metricsFormat, *shard)
+}
+
+func importCommand(args []string) error {
+	fs := flag.NewFlagSet("import", flag.ExitOnError)
+	format := fs.String("format", "", "format of the file, opml, csv or lines, by default taken from its extension")
+	fs.Parse(args)
+	if fs.NArg() != 1 {
+		return fmt.Errorf("usage: import [--format opml|csv|lines] FILE, - reads standard input")
+	}
+	return importSites(fs.Arg(0), *format)
+}
+
+func exportCommand(args []string) error {
+	fs := flag.NewFlagSet("export", flag.ExitOnError)
+	format := fs.String("format", "", "format of the file, opml, csv or lines, by default taken from its extension")
+	fs.Parse(args)
+	return exportSites(fs.Arg(0), *format)
+}
+
+func policyCommand(args []string) error {
+	fs := flag.NewFlagSet("policy", flag.ExitOnError)
+	site := fs.String("site", "", "web address of the blog site")
+	include := fs.String("include", "", "crawl only the links matching one of these robots.txt style patterns")
+	exclude := fs.String("exclude", "", "skip the links matching one of these robots.txt style patterns")
+	maxPages := fs.Int("max-pages", 0, "fetch at most this many pages per crawl of the site, 0 for the config file's max_pages")
+	maxBytes := fs.Int64("max-bytes", 0, "read at most about this many bytes per crawl of the site, 0 for the config file's max_site_bytes")
+	fs.Parse(args)
+	if *site == "" || *maxPages < 0 || *maxBytes < 0 {
+		return fmt.Errorf("usage: policy --site URL [--include PATTERNS] [--exclude PATTERNS] [--max-pages N] [--max-bytes N]")
+	}
+	normalized, ok := normalizeSite(*site)
+	if !ok {
+		return fmt.Errorf("%s is not a http or https url", *site)
+	}
+	return setSitePolicy(normalized, *include, *exclude, *maxPages, *maxBytes)
+}
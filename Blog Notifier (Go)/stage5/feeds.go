@@ -0,0 +1,183 @@
+package main
+
+import (
+	"encoding/xml"
+	"fmt"
+	"io"
+	"mime"
+	"net/url"
+	"strings"
+)
+
+// places where blogs commonly publish a feed or a sitemap without announcing it,
+// relative to the site url
+var feedCandidates = []string{"feed", "rss.xml", "atom.xml", "feed.xml", "index.xml", "sitemap.xml"}
+
+// the links listed in a feed or sitemap along with the title of each, empty for the
+// entries of a sitemap, and the fingerprint of the content of each, 0 for an entry that
+// has none. A sitemap index lists further sitemaps instead of posts
+type feedDoc struct {
+	links        []string
+	titles       []string
+	fingerprints []uint64
+	sitemaps     []string
+}
+
+// reads the post links of an RSS 2.0 or Atom feed, or of a sitemap, as the document
+// streams in. Returns an error for anything that is not one of those formats
+func parseFeed(r io.Reader, contentType string) (feedDoc, error) {
+	doc := feedDoc{}
+	if mediaType, _, _ := mime.ParseMediaType(contentType); mediaType == "text/html" {
+		return doc, fmt.Errorf("not a feed or sitemap: %s", mediaType)
+	}
+	d := xml.NewDecoder(r)
+	d.Strict = false
+	// the element names from the document root down to the current element
+	path := make([]string, 0, 8)
+	rooted := false
+	text := &strings.Builder{}
+	// the first link of the current item or entry, its title and the longest of its
+	// content and summary
+	itemStart, itemTitle, itemContent := 0, "", ""
+	addLink := func(link string) {
+		doc.links = append(doc.links, link)
+		doc.titles = append(doc.titles, "")
+		doc.fingerprints = append(doc.fingerprints, 0)
+	}
+	for {
+		tok, err := d.Token()
+		if err == io.EOF {
+			break
+		}
+		if err != nil {
+			return doc, err
+		}
+		switch t := tok.(type) {
+		case xml.StartElement:
+			if len(path) == 0 {
+				switch t.Name.Local {
+				case "rss", "feed", "urlset", "sitemapindex", "RDF":
+					rooted = true
+				default:
+					return doc, fmt.Errorf("not a feed or sitemap: <%s>", t.Name.Local)
+				}
+			}
+			path = append(path, t.Name.Local)
+			text.Reset()
+			if t.Name.Local == "item" || t.Name.Local == "entry" {
+				itemStart, itemTitle, itemContent = len(doc.links), "", ""
+			}
+			// <entry><link rel="alternate" href="..."/> in Atom
+			if t.Name.Local == "link" && parentIs(path, "entry") {
+				rel, href := "", ""
+				for _, attr := range t.Attr {
+					switch attr.Name.Local {
+					case "rel":
+						rel = attr.Value
+					case "href":
+						href = attr.Value
+					}
+				}
+				if href != "" && (rel == "" || rel == "alternate") {
+					addLink(href)
+				}
+			}
+		case xml.CharData:
+			text.Write(t)
+		case xml.EndElement:
+			value := strings.TrimSpace(text.String())
+			switch {
+			// <item><link>...</link> in RSS 2.0 and RSS 1.0
+			case t.Name.Local == "link" && parentIs(path, "item") && value != "":
+				addLink(value)
+			// <url><loc>...</loc> in a sitemap
+			case t.Name.Local == "loc" && parentIs(path, "url") && value != "":
+				addLink(value)
+			case t.Name.Local == "title" && (parentIs(path, "item") || parentIs(path, "entry")):
+				itemTitle = value
+			// <description> and <content:encoded> in RSS, <summary> and <content> in Atom,
+			// html escaped or in CDATA
+			case feedContent[t.Name.Local] && (parentIs(path, "item") || parentIs(path, "entry")):
+				if len(value) > len(itemContent) {
+					itemContent = value
+				}
+			// the title and content may come before or after the link
+			case t.Name.Local == "item" || t.Name.Local == "entry":
+				fingerprint := uint64(0)
+				if itemContent != "" {
+					fingerprint = htmlFingerprint(itemContent)
+				}
+				for i := itemStart; i < len(doc.links); i++ {
+					doc.titles[i] = itemTitle
+					doc.fingerprints[i] = fingerprint
+				}
+			// <sitemap><loc>...</loc> in a sitemap index
+			case t.Name.Local == "loc" && parentIs(path, "sitemap") && value != "":
+				doc.sitemaps = append(doc.sitemaps, value)
+			}
+			text.Reset()
+			if len(path) > 0 {
+				path = path[:len(path)-1]
+			}
+		}
+	}
+	if !rooted || len(path) != 0 {
+		return doc, fmt.Errorf("not a feed or sitemap")
+	}
+	return doc, nil
+}
+
+// the elements of an item or entry that hold the text of the post
+var feedContent = map[string]bool{"description": true, "encoded": true, "summary": true, "content": true}
+
+// reports whether the innermost open element is a child of parent
+func parentIs(path []string, parent string) bool {
+	return len(path) >= 2 && path[len(path)-2] == parent
+}
+
+// looks for the feed of a blog site: first for a feed announced with
+// <link rel="alternate"> on the home page, then at the usual feed and sitemap locations.
+// Returns an empty string when the site has none
+func discoverFeed(site string) (string, error) {
+	root, err := url.Parse(site)
+	if err != nil {
+		return "", err
+	}
+	res, err := getHTTPClient().Get(site)
+	if err != nil {
+		return "", err
+	}
+	announced, err := extractFeedLinks(io.LimitReader(res.Body, maxPageBytes()))
+	res.Body.Close()
+	if err != nil {
+		return "", err
+	}
+
+	candidates := make([]string, 0, len(announced)+len(feedCandidates))
+	for _, href := range append(announced, feedCandidates...) {
+		ref, err := url.Parse(strings.TrimSpace(href))
+		if err == nil {
+			candidates = append(candidates, root.ResolveReference(ref).String())
+		}
+	}
+	for _, candidate := range candidates {
+		if isFeed(candidate) {
+			return candidate, nil
+		}
+	}
+	return "", nil
+}
+
+// fetches link and reports whether it is a feed or sitemap listing at least one link
+func isFeed(link string) bool {
+	res, err := getHTTPClient().Get(link)
+	if err != nil {
+		return false
+	}
+	defer res.Body.Close()
+	if res.StatusCode != 200 {
+		return false
+	}
+	doc, err := parseFeed(io.LimitReader(res.Body, maxPageBytes()), res.Header.Get("Content-Type"))
+	return err == nil && (len(doc.links) > 0 || len(doc.sitemaps) > 0)
+}
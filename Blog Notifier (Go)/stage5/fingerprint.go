@@ -0,0 +1,165 @@
+package main
+
+import (
+	"crypto/sha256"
+	"database/sql"
+	"encoding/hex"
+	"math/bits"
+	"sort"
+	"unicode"
+	"unicode/utf8"
+)
+
+// limits of the near-duplicate detection of posts. Two posts whose fingerprints differ
+// in at most NEAR_DUPLICATE_DISTANCE of their 64 bits are the same article, the usual
+// threshold for SimHash fingerprints of web pages. Pages with fewer than
+// MIN_FINGERPRINT_WORDS words of text get no fingerprint, short pages that share a
+// template would all look alike
+const (
+	NEAR_DUPLICATE_DISTANCE = 3
+	MIN_FINGERPRINT_WORDS   = 32
+	SHINGLE_WORDS           = 3
+	FINGERPRINT_BANDS       = 4
+)
+
+// identifies the set of links found on a page regardless of their order and of
+// repetitions, a page whose links are the same as on the last fetch has nothing new
+// to discover even when the rest of its content changed
+func linkSetFingerprint(links []string) string {
+	sorted := append([]string(nil), links...)
+	sort.Strings(sorted)
+	h := sha256.New()
+	for i, link := range sorted {
+		if i > 0 && link == sorted[i-1] {
+			continue
+		}
+		h.Write([]byte(link))
+		h.Write([]byte{0})
+	}
+	return hex.EncodeToString(h.Sum(nil))
+}
+
+// builds the SimHash fingerprint of a text fed to it piece by piece. Every run of
+// SHINGLE_WORDS consecutive words is a feature, and every bit of the fingerprint is the
+// majority vote of that bit over the hashes of all the features, so texts that share
+// most of their shingles end up with fingerprints that differ in few bits
+type simHasher struct {
+	votes  [64]int
+	words  int
+	recent [SHINGLE_WORDS]uint64 // hashes of the last words, a ring
+	word   []byte                // the word being read, lower case
+}
+
+// feeds text, words are runs of letters and digits compared case insensitively
+func (s *simHasher) write(text []byte) {
+	for len(text) > 0 {
+		r, size := utf8.DecodeRune(text)
+		text = text[size:]
+		if unicode.IsLetter(r) || unicode.IsDigit(r) {
+			s.word = utf8.AppendRune(s.word, unicode.ToLower(r))
+			continue
+		}
+		s.endWord()
+	}
+}
+
+func (s *simHasher) endWord() {
+	if len(s.word) == 0 {
+		return
+	}
+	// FNV-1a, inline to not allocate a hasher per word
+	h := uint64(14695981039346656037)
+	for _, b := range s.word {
+		h ^= uint64(b)
+		h *= 1099511628211
+	}
+	s.word = s.word[:0]
+	s.recent[s.words%SHINGLE_WORDS] = h
+	s.words++
+	if s.words < SHINGLE_WORDS {
+		return
+	}
+	feature := uint64(0)
+	for i := 0; i < SHINGLE_WORDS; i++ {
+		feature = mix64(feature*31 + s.recent[(s.words+i)%SHINGLE_WORDS])
+	}
+	for bit := 0; bit < 64; bit++ {
+		if feature&(1<<bit) != 0 {
+			s.votes[bit]++
+		} else {
+			s.votes[bit]--
+		}
+	}
+}
+
+// returns the fingerprint, 0 when the text is too short to have one
+func (s *simHasher) sum() uint64 {
+	s.endWord()
+	if s.words < MIN_FINGERPRINT_WORDS {
+		return 0
+	}
+	fp := uint64(0)
+	for bit := 0; bit < 64; bit++ {
+		if s.votes[bit] > 0 {
+			fp |= 1 << bit
+		}
+	}
+	return fp
+}
+
+// the finalizer of SplitMix64, spreads the combined word hashes over all 64 bits
+func mix64(x uint64) uint64 {
+	x ^= x >> 30
+	x *= 0xbf58476d1ce4e5b9
+	x ^= x >> 27
+	x *= 0x94d049bb133111eb
+	return x ^ (x >> 31)
+}
+
+// reports whether two fingerprints are those of the same article
+func nearDuplicate(a, b uint64) bool {
+	return bits.OnesCount64(a^b) <= NEAR_DUPLICATE_DISTANCE
+}
+
+// splits a fingerprint into FINGERPRINT_BANDS bands of 16 bits. Fingerprints that differ
+// in at most NEAR_DUPLICATE_DISTANCE bits, fewer than there are bands, are equal in at
+// least one band, so the candidates for a near duplicate are found through an index on
+// the bands instead of comparing against every stored fingerprint
+func fingerprintBands(fp uint64) [FINGERPRINT_BANDS]int64 {
+	bands := [FINGERPRINT_BANDS]int64{}
+	for i := range bands {
+		bands[i] = int64(fp >> (16 * i) & 0xffff)
+	}
+	return bands
+}
+
+// looks for a stored post that is a near duplicate of fp, using the statements of the
+// transaction the post is being added in. Returns its link, or "" when there is none
+func findMirror(find *sql.Stmt, fp uint64) (string, error) {
+	bands := fingerprintBands(fp)
+	rows, err := find.Query(bands[0], bands[1], bands[2], bands[3])
+	if err != nil {
+		return "", err
+	}
+	defer rows.Close()
+	for rows.Next() {
+		link, other := "", int64(0)
+		if err := rows.Scan(&link, &other); err != nil {
+			return "", err
+		}
+		if nearDuplicate(fp, uint64(other)) {
+			return link, nil
+		}
+	}
+	return "", rows.Err()
+}
+
+// stores the fingerprint of a post, one row per band
+func addFingerprint(add *sql.Stmt, post blogPostsLink) error {
+	for band, value := range fingerprintBands(post.fingerprint) {
+		if _, err := add.Exec(band, value, int64(post.fingerprint), post.site, post.link); err != nil {
+			return err
+		}
+	}
+	return nil
+}
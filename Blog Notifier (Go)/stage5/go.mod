@@ -3,12 +3,7 @@ module stage5
 go 1.21.5
 
 require (
-	github.com/PuerkitoBio/goquery v1.8.1
 	github.com/mattn/go-sqlite3 v1.14.19
+	golang.org/x/net v0.7.0
 	gopkg.in/yaml.v3 v3.0.1
 )
-
-require (
-	github.com/andybalholm/cascadia v1.3.1 // indirect
-	golang.org/x/net v0.7.0 // indirect
-)
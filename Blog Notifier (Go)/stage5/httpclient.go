@@ -0,0 +1,142 @@
+package main
+
+import (
+	"context"
+	"fmt"
+	"io"
+	"net"
+	"net/http"
+	"sync"
+	"sync/atomic"
+	"time"
+)
+
+// sent with every request, robots.txt groups name its product token, see ROBOTS_AGENT
+const USER_AGENT = "BlogNotifier/1.0"
+
+var (
+	httpClient     *http.Client
+	httpClientOnce sync.Once
+)
+
+// returns the HTTP client shared by every fetch of the program, built from the http
+// section of the config file the first time it is needed
+func getHTTPClient() *http.Client {
+	httpClientOnce.Do(func() {
+		httpClient = newHTTPClient(conf.HTTP)
+	})
+	return httpClient
+}
+
+// builds an HTTP client with the timeouts and limits of the config file, falling back
+// to the defaults. Idle connections are kept for as many requests per host as the crawl
+// sends at a time, so every crawl worker reuses its connection to a host. Responses are
+// requested gzip compressed and decompressed transparently unless compression is disabled
+func newHTTPClient(c httpConfig) *http.Client {
+	connectTimeout := orDefaultDuration(c.ConnectTimeout, DEFAULT_CONNECT_TIMEOUT)
+	readTimeout := orDefaultDuration(c.ReadTimeout, DEFAULT_READ_TIMEOUT)
+	maxRedirects := orDefault(c.MaxRedirects, DEFAULT_MAX_REDIRECTS)
+	perHost := orDefault(conf.Crawler.PerHost, DEFAULT_PER_HOST)
+
+	dialer := &net.Dialer{Timeout: connectTimeout, KeepAlive: 30 * time.Second}
+	transport := &http.Transport{
+		Proxy: http.ProxyFromEnvironment,
+		DialContext: func(ctx context.Context, network, addr string) (net.Conn, error) {
+			return dialer.DialContext(ctx, network, addr)
+		},
+		TLSHandshakeTimeout:   connectTimeout,
+		ResponseHeaderTimeout: readTimeout,
+		ExpectContinueTimeout: time.Second,
+		MaxIdleConns:          orDefault(c.IdleConnections, perHost*orDefault(conf.Crawler.Workers, DEFAULT_CRAWL_WORKERS)),
+		MaxIdleConnsPerHost:   perHost,
+		IdleConnTimeout:       90 * time.Second,
+		DisableCompression:    c.DisableCompression,
+		ForceAttemptHTTP2:     true,
+	}
+	return &http.Client{
+		Transport: userAgentTransport{readTimeoutTransport{transport, readTimeout}},
+		Timeout:   orDefaultDuration(c.Timeout, DEFAULT_REQUEST_TIMEOUT),
+		CheckRedirect: func(req *http.Request, via []*http.Request) error {
+			if len(via) > maxRedirects {
+				return fmt.Errorf("%s: stopped after %d redirects", via[0].URL, maxRedirects)
+			}
+			return nil
+		},
+	}
+}
+
+// returns a duration from the config file, or def when it is not set
+func orDefaultDuration(v, def time.Duration) time.Duration {
+	if v <= 0 {
+		return def
+	}
+	return v
+}
+
+// sets the User-Agent of the requests that do not set one
+type userAgentTransport struct {
+	http.RoundTripper
+}
+
+func (t userAgentTransport) RoundTrip(req *http.Request) (*http.Response, error) {
+	if req.Header.Get("User-Agent") == "" {
+		req = req.Clone(req.Context())
+		req.Header.Set("User-Agent", USER_AGENT)
+	}
+	return t.RoundTripper.RoundTrip(req)
+}
+
+// fails the read of a response body once no data arrived for timeout. Unlike a deadline
+// on the whole request, a large page that keeps streaming in is not cut off. The wait for
+// the headers is bounded by ResponseHeaderTimeout, and idle connections in the pool are
+// left to IdleConnTimeout
+type readTimeoutTransport struct {
+	http.RoundTripper
+	timeout time.Duration
+}
+
+func (t readTimeoutTransport) RoundTrip(req *http.Request) (*http.Response, error) {
+	ctx, cancel := context.WithCancel(req.Context())
+	res, err := t.RoundTripper.RoundTrip(req.WithContext(ctx))
+	if err != nil {
+		cancel()
+		return nil, err
+	}
+	body := &readTimeoutBody{ReadCloser: res.Body, timeout: t.timeout, cancel: cancel}
+	body.timer = time.AfterFunc(t.timeout, body.expire)
+	body.timer.Stop()
+	res.Body = body
+	return res, nil
+}
+
+// a response body whose request is canceled when a read waits longer than timeout. The
+// timer only runs during a read, the time the caller takes between two reads is not counted
+type readTimeoutBody struct {
+	io.ReadCloser
+	timeout time.Duration
+	cancel  context.CancelFunc
+	timer   *time.Timer
+	expired atomic.Bool
+}
+
+func (b *readTimeoutBody) expire() {
+	b.expired.Store(true)
+	b.cancel()
+}
+
+func (b *readTimeoutBody) Read(p []byte) (int, error) {
+	b.timer.Reset(b.timeout)
+	n, err := b.ReadCloser.Read(p)
+	b.timer.Stop()
+	if err != nil && b.expired.Load() {
+		err = fmt.Errorf("no data received for %s", b.timeout)
+	}
+	return n, err
+}
+
+func (b *readTimeoutBody) Close() error {
+	b.timer.Stop()
+	err := b.ReadCloser.Close()
+	b.cancel()
+	return err
+}
@@ -0,0 +1,230 @@
+package main
+
+import (
+	"io"
+	"mime"
+	"strings"
+
+	"golang.org/x/net/html"
+)
+
+// reports whether a response with the given Content-Type header can contain links
+// worth crawling, a missing header is given the benefit of the doubt
+func isHTML(contentType string) bool {
+	if contentType == "" {
+		return true
+	}
+	mediaType, _, err := mime.ParseMediaType(contentType)
+	if err != nil {
+		return false
+	}
+	return mediaType == "text/html" || mediaType == "application/xhtml+xml"
+}
+
+// collects the href of every <a> tag while the page is read. Unlike building a DOM,
+// the tokenizer keeps only the current token in memory, and text, comments and the
+// contents of <script> and <style> are skipped without being copied
+func extractLinks(r io.Reader) ([]string, error) {
+	z := html.NewTokenizer(r)
+	links := make([]string, 0)
+	for {
+		switch z.Next() {
+		case html.ErrorToken:
+			if z.Err() == io.EOF {
+				return links, nil
+			}
+			return links, z.Err()
+		case html.StartTagToken, html.SelfClosingTagToken:
+			name, hasAttr := z.TagName()
+			if string(name) != "a" {
+				continue
+			}
+			for hasAttr {
+				var key, val []byte
+				key, val, hasAttr = z.TagAttr()
+				if string(key) == "href" {
+					links = append(links, string(val))
+					break
+				}
+			}
+		}
+	}
+}
+
+// what the crawl keeps of an html page: its title, its links and the fingerprint of its
+// text
+type pageDoc struct {
+	title       string
+	links       []string
+	fingerprint uint64
+}
+
+// elements whose text is not part of the content of a page: code, anywhere, and the
+// navigation and boilerplate every page of a blog repeats, outside the <article> or
+// <main> element. Inside it a header holds the headline and byline of the post
+var (
+	codeElements   = map[string]bool{"script": true, "style": true, "noscript": true, "template": true}
+	layoutElements = map[string]bool{"nav": true, "header": true, "footer": true, "aside": true}
+)
+
+// reports whether the text of the element tag is left out, inArticle being the number of
+// open <article> and <main> elements
+func skipped(tag string, inArticle int) bool {
+	return codeElements[tag] || (layoutElements[tag] && inArticle == 0)
+}
+
+// collects the links of a page like extractLinks and, in the same pass, its <title> and
+// the SimHash fingerprint of its text, see simHasher. The text of the <article> or <main> element
+// is the post when the page has one, otherwise the whole page outside the <head> is,
+// either way without the boilerplate elements
+func extractPage(r io.Reader) (pageDoc, error) {
+	z := html.NewTokenizer(r)
+	doc := pageDoc{links: make([]string, 0)}
+	article, body := &simHasher{}, &simHasher{}
+	inHead, inTitle, inArticle, skip := false, false, 0, 0
+	title := &strings.Builder{}
+	for {
+		tt := z.Next()
+		switch tt {
+		case html.ErrorToken:
+			if z.Err() != io.EOF {
+				return doc, z.Err()
+			}
+			doc.title = strings.Join(strings.Fields(title.String()), " ")
+			doc.fingerprint = body.sum()
+			if article.words >= MIN_FINGERPRINT_WORDS {
+				doc.fingerprint = article.sum()
+			}
+			return doc, nil
+		case html.TextToken:
+			if inTitle {
+				title.Write(z.Text())
+				continue
+			}
+			if inHead || skip > 0 {
+				continue
+			}
+			text := z.Text()
+			body.write(text)
+			body.endWord()
+			if inArticle > 0 {
+				article.write(text)
+				article.endWord()
+			}
+		case html.StartTagToken, html.SelfClosingTagToken:
+			name, hasAttr := z.TagName()
+			tag := string(name)
+			selfClosing := tt == html.SelfClosingTagToken
+			switch {
+			case tag == "head":
+				inHead = !selfClosing
+			case tag == "body":
+				inHead = false
+			case tag == "title" && !selfClosing:
+				// the first title of the page, an <svg> may have its own
+				inTitle = title.Len() == 0
+			case (tag == "article" || tag == "main") && !selfClosing:
+				inArticle++
+			case skipped(tag, inArticle) && !selfClosing:
+				skip++
+			}
+			if tag != "a" {
+				continue
+			}
+			for hasAttr {
+				var key, val []byte
+				key, val, hasAttr = z.TagAttr()
+				if string(key) == "href" {
+					doc.links = append(doc.links, string(val))
+					break
+				}
+			}
+		case html.EndTagToken:
+			name, _ := z.TagName()
+			tag := string(name)
+			switch {
+			case tag == "head":
+				inHead = false
+			case tag == "title":
+				inTitle = false
+			case (tag == "article" || tag == "main") && inArticle > 0:
+				inArticle--
+			case skipped(tag, inArticle) && skip > 0:
+				skip--
+			}
+		}
+	}
+}
+
+// the SimHash fingerprint of the text of an html fragment, such as the content of a feed
+// entry. The fragment is read the way extractPage reads an article, so a post found
+// through a feed and its copy found on the pages of another blog get the same fingerprint
+func htmlFingerprint(fragment string) uint64 {
+	z := html.NewTokenizer(strings.NewReader(fragment))
+	text, skip := &simHasher{}, 0
+	for {
+		switch tt := z.Next(); tt {
+		case html.ErrorToken:
+			return text.sum()
+		case html.TextToken:
+			if skip == 0 {
+				text.write(z.Text())
+				text.endWord()
+			}
+		case html.StartTagToken:
+			if name, _ := z.TagName(); skipped(string(name), 1) {
+				skip++
+			}
+		case html.EndTagToken:
+			if name, _ := z.TagName(); skipped(string(name), 1) && skip > 0 {
+				skip--
+			}
+		}
+	}
+}
+
+// collects the href of every <link rel="alternate"> that announces an RSS or Atom feed
+func extractFeedLinks(r io.Reader) ([]string, error) {
+	z := html.NewTokenizer(r)
+	links := make([]string, 0)
+	for {
+		switch z.Next() {
+		case html.ErrorToken:
+			if z.Err() == io.EOF {
+				return links, nil
+			}
+			return links, z.Err()
+		case html.StartTagToken, html.SelfClosingTagToken:
+			name, hasAttr := z.TagName()
+			if string(name) == "body" {
+				// feeds are announced in the head
+				return links, nil
+			}
+			if string(name) != "link" {
+				continue
+			}
+			rel, typ, href := "", "", ""
+			for hasAttr {
+				var key, val []byte
+				key, val, hasAttr = z.TagAttr()
+				switch string(key) {
+				case "rel":
+					rel = strings.ToLower(string(val))
+				case "type":
+					typ = strings.ToLower(strings.TrimSpace(string(val)))
+				case "href":
+					href = string(val)
+				}
+			}
+			if href == "" || (typ != "application/rss+xml" && typ != "application/atom+xml") {
+				continue
+			}
+			for _, value := range strings.Fields(rel) {
+				if value == "alternate" {
+					links = append(links, href)
+					break
+				}
+			}
+		}
+	}
+}
@@ -0,0 +1,112 @@
+package main
+
+import (
+	"bytes"
+	"fmt"
+	"math/bits"
+	"reflect"
+	"strings"
+	"testing"
+)
+
+func TestExtractLinks(t *testing.T) {
+	page := `<!DOCTYPE html><html><head><title><a href="/title">no</a></title>
+<script>document.write('<a href="/script">no</a>')</script></head>
+<body><!-- <a href="/comment">no</a> -->
+<A HREF="/upper">upper</A> <a class=x href=/unquoted>unquoted</a>
+<a href="/q?a=1&amp;b=2">entity</a> <a name="anchor">no href</a> <a href="/self"/>
+</body></html>`
+	links, err := extractLinks(strings.NewReader(page))
+	if err != nil {
+		t.Fatal(err)
+	}
+	want := []string{"/upper", "/unquoted", "/q?a=1&b=2", "/self"}
+	if !reflect.DeepEqual(links, want) {
+		t.Errorf("extractLinks() = %q, want %q", links, want)
+	}
+}
+
+func TestExtractPageFingerprint(t *testing.T) {
+	article := strings.Repeat("Crawlers follow links from page to page and store what they find. ", 8)
+	page := func(blog, text string) string {
+		return `<html><head><title>` + blog + `</title><script>var blog = "` + blog + `";</script></head>
+<body><header><a href="/">` + blog + `</a></header><nav><a href="/archive">archive of ` + blog + `</a></nav>
+<h1>Posted on ` + blog + `</h1><article><p>` + text + `</p></article>
+<footer>Copyright ` + blog + `</footer></body></html>`
+	}
+	fingerprint := func(html string) uint64 {
+		doc, err := extractPage(strings.NewReader(html))
+		if err != nil {
+			t.Fatal(err)
+		}
+		return doc.fingerprint
+	}
+
+	doc, err := extractPage(strings.NewReader(page("one", article)))
+	if err != nil {
+		t.Fatal(err)
+	}
+	if want := []string{"/", "/archive"}; !reflect.DeepEqual(doc.links, want) {
+		t.Errorf("extractPage() links = %q, want %q", doc.links, want)
+	}
+	if doc.title != "one" {
+		t.Errorf("extractPage() title = %q, want %q", doc.title, "one")
+	}
+	mirror := fingerprint(page("another blog", article))
+	if doc.fingerprint == 0 || mirror != doc.fingerprint {
+		t.Errorf("the same article on two blogs has fingerprints %x and %x", doc.fingerprint, mirror)
+	}
+	edited := fingerprint(page("one", strings.Replace(article, "store", "keep", 1)))
+	if !nearDuplicate(doc.fingerprint, edited) {
+		t.Errorf("an article with one word changed is %d bits away", bits.OnesCount64(doc.fingerprint^edited))
+	}
+	other := fingerprint(page("one", strings.Repeat("Mail servers queue messages and retry deliveries later. ", 8)))
+	if nearDuplicate(doc.fingerprint, other) {
+		t.Errorf("two different articles are near duplicates, %x and %x", doc.fingerprint, other)
+	}
+	// link text is text of the article, and a link left open does not hide what follows
+	linked := strings.Replace(article, "links", `<a href="/links">links</a>`, 1)
+	unclosed := strings.Replace(article, "store", `<a href="/store">store`, 1)
+	for _, html := range []string{linked, unclosed} {
+		if got := fingerprint(page("one", html)); got != doc.fingerprint {
+			t.Errorf("an article with markup %q has fingerprint %x, want %x", html[:80], got, doc.fingerprint)
+		}
+	}
+	// the headline and byline in the header of the article are part of its text
+	withHeader := "<header><h2>Following links</h2>By Ann</header>" + article
+	headed := fingerprint(page("one", withHeader))
+	if headed == doc.fingerprint || headed != htmlFingerprint("<p>"+withHeader+"</p>") {
+		t.Errorf("the header of an article is left out of its fingerprint %x", headed)
+	}
+	// the same article in a feed entry, whose content is an html fragment
+	if fromFeed := htmlFingerprint("<p>" + article + "</p>"); fromFeed != doc.fingerprint {
+		t.Errorf("the article of a feed entry has fingerprint %x, on its page it has %x", fromFeed, doc.fingerprint)
+	}
+	if short := fingerprint(page("one", "Too short.")); short != 0 {
+		t.Errorf("a page without enough text has fingerprint %x, want none", short)
+	}
+}
+
+// an archive page of a blog, the kind of page the crawler spends most of its time on
+func archivePage(posts int) []byte {
+	b := &strings.Builder{}
+	b.WriteString("<!DOCTYPE html><html><head><title>Archive</title>")
+	b.WriteString("<style>a { color: red }</style></head><body><nav><a href=\"/\">home</a></nav><ul>\n")
+	for i := 0; i < posts; i++ {
+		fmt.Fprintf(b, "<li class=\"post\"><a href=\"/posts/%d\" title=\"Post %d\">Post %d</a>"+
+			"<p>A short summary of post %d, with <em>some</em> markup.</p></li>\n", i, i, i, i)
+	}
+	b.WriteString("</ul></body></html>")
+	return []byte(b.String())
+}
+
+func BenchmarkExtractLinks(b *testing.B) {
+	page := archivePage(2000)
+	b.SetBytes(int64(len(page)))
+	b.ReportAllocs()
+	for i := 0; i < b.N; i++ {
+		if _, err := extractLinks(bytes.NewReader(page)); err != nil {
+			b.Fatal(err)
+		}
+	}
+}
@@ -0,0 +1,117 @@
+package main
+
+import (
+	"crypto/tls"
+	"fmt"
+	"net/smtp"
+	"strings"
+	"sync/atomic"
+	"time"
+)
+
+// counters of a notify run, shared by all SMTP sessions
+type mailerStats struct {
+	connections atomic.Int64
+	sent        atomic.Int64
+	failed      atomic.Int64
+	throttled   atomic.Int64 // requests turned away for going over a rate limit
+}
+
+// opens an SMTP session to the configured server, upgrading it to TLS when offered
+func dialSMTP() (*smtp.Client, error) {
+	c, err := smtp.Dial(mailAddr)
+	if err != nil {
+		return nil, err
+	}
+	if ok, _ := c.Extension("STARTTLS"); ok {
+		err = c.StartTLS(&tls.Config{ServerName: conf.Server.Host})
+		if err != nil {
+			c.Close()
+			return nil, err
+		}
+	}
+	return c, nil
+}
+
+// sends a single message as one mail transaction on an open session
+func sendOnSession(c *smtp.Client, msg []byte) error {
+	if err := c.Mail(sender); err != nil {
+		return err
+	}
+	if err := c.Rcpt(recipient); err != nil {
+		return err
+	}
+	w, err := c.Data()
+	if err != nil {
+		return err
+	}
+	if _, err = w.Write(msg); err != nil {
+		w.Close()
+		return err
+	}
+	return w.Close()
+}
+
+// delivers msgs one after another over a single SMTP connection and calls done(i, err)
+// once for every message, with the error that kept it from being delivered if any.
+// A rejected message only resets the session, a session that cannot be reset is
+// replaced by a new connection
+func deliverOnSession(msgs [][]byte, stats *mailerStats, done func(i int, err error)) error {
+	// reports the messages from i on as failed with err
+	fail := func(i int, err error) error {
+		for ; i < len(msgs); i++ {
+			stats.failed.Add(1)
+			done(i, err)
+		}
+		return err
+	}
+	c, err := dialSMTP()
+	if err != nil {
+		return fail(0, err)
+	}
+	stats.connections.Add(1)
+	defer func() {
+		if c != nil {
+			c.Quit()
+		}
+	}()
+
+	for i, msg := range msgs {
+		err := sendOnSession(c, msg)
+		if err == nil {
+			stats.sent.Add(1)
+			done(i, nil)
+			continue
+		}
+		stats.failed.Add(1)
+		done(i, err)
+		fmt.Println("error delivering mail")
+		fmt.Println(err)
+		if c.Reset() == nil {
+			continue
+		}
+		c.Close()
+		c, err = dialSMTP()
+		if err != nil {
+			return fail(i+1, err)
+		}
+		stats.connections.Add(1)
+	}
+	return nil
+}
+
+// builds an RFC 5322 message with the given subject and body
+func formatMail(subject, body string) []byte {
+	body = strings.ReplaceAll(body, "\n", "\r\n")
+	return []byte(fmt.Sprintf("From: %s\r\nTo: %s\r\nSubject: %s\r\nDate: %s\r\n\r\n%s\r\n",
+		sender, recipient, subject, time.Now().Format(time.RFC1123Z), body))
+}
+
+// rolls all the mails into a single message
+func digestMail(mails []mailStruct) []byte {
+	lines := make([]string, 0, len(mails))
+	for _, mail := range mails {
+		lines = append(lines, mail.msg)
+	}
+	return formatMail(fmt.Sprintf("%d new blog posts", len(mails)), strings.Join(lines, "\n"))
+}
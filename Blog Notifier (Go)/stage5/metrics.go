@@ -0,0 +1,336 @@
+package main
+
+import (
+	"encoding/json"
+	"fmt"
+	"io"
+	"os"
+	"sort"
+	"strings"
+	"sync"
+	"time"
+)
+
+// upper bounds, in seconds, of the buckets of the fetch latency histograms
+var latencyBuckets = []float64{0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10}
+
+// a latency histogram, counts[i] is the number of observations in bucket i and the last
+// entry counts the ones above the largest bound
+type histogram struct {
+	counts []int64
+	sum    float64
+	count  int64
+}
+
+func (h *histogram) observe(d time.Duration) {
+	if h.counts == nil {
+		h.counts = make([]int64, len(latencyBuckets)+1)
+	}
+	s := d.Seconds()
+	i := sort.SearchFloat64s(latencyBuckets, s)
+	h.counts[i]++
+	h.sum += s
+	h.count++
+}
+
+// the cumulative count of observations at or below every bound, the way Prometheus
+// reports histogram buckets
+func (h *histogram) cumulative() []int64 {
+	out := make([]int64, len(latencyBuckets)+1)
+	total := int64(0)
+	for i := range out {
+		if h.counts != nil {
+			total += h.counts[i]
+		}
+		out[i] = total
+	}
+	return out
+}
+
+// what a single fetch cost, filled in by fetchParsed
+type fetchStats struct {
+	status  int
+	bytes   int64
+	latency time.Duration // until the response headers arrived
+	read    time.Duration // spent waiting for the body
+	parse   time.Duration // spent in the parser, not counting the waits for the body
+}
+
+// counts the bytes read from r and the time spent waiting for them
+type timedReader struct {
+	r     io.Reader
+	bytes int64
+	wait  time.Duration
+}
+
+func (t *timedReader) Read(p []byte) (int, error) {
+	start := time.Now()
+	n, err := t.r.Read(p)
+	t.wait += time.Since(start)
+	t.bytes += int64(n)
+	return n, err
+}
+
+type siteMetrics struct {
+	fetches     int64
+	notModified int64
+	sameLinks   int64 // pages fetched in full whose links had not changed
+	errors      int64
+	bytes       int64
+	latency     histogram
+	read        time.Duration
+	parse       time.Duration
+}
+
+// the measurements of one run of the program, printed at its end with --metrics
+type runMetrics struct {
+	mu          sync.Mutex
+	start       time.Time
+	sites       map[string]*siteMetrics
+	phases      map[string]time.Duration
+	dbWrite     time.Duration
+	dbWrites    int64
+	mailsSent   int64
+	mailsFailed int64
+	connections int64
+}
+
+var metrics = newRunMetrics()
+
+func newRunMetrics() *runMetrics {
+	return &runMetrics{
+		start:  time.Now(),
+		sites:  make(map[string]*siteMetrics),
+		phases: make(map[string]time.Duration),
+	}
+}
+
+// returns the metrics of site, the caller holds the lock
+func (m *runMetrics) site(site string) *siteMetrics {
+	s, ok := m.sites[site]
+	if !ok {
+		s = &siteMetrics{}
+		m.sites[site] = s
+	}
+	return s
+}
+
+func (m *runMetrics) observeFetch(site string, st *fetchStats, err error) {
+	m.mu.Lock()
+	defer m.mu.Unlock()
+	s := m.site(site)
+	s.fetches++
+	if st.status == 304 {
+		s.notModified++
+	}
+	if err != nil {
+		s.errors++
+	}
+	s.bytes += st.bytes
+	s.read += st.read
+	s.parse += st.parse
+	if st.status != 0 {
+		s.latency.observe(st.latency)
+	}
+}
+
+func (m *runMetrics) observeUnchangedLinks(site string) {
+	m.mu.Lock()
+	m.site(site).sameLinks++
+	m.mu.Unlock()
+}
+
+// adds the time since start to the time spent writing to the database, used as
+// defer metrics.dbWriteSince(time.Now())
+func (m *runMetrics) dbWriteSince(start time.Time) {
+	d := time.Since(start)
+	m.mu.Lock()
+	m.dbWrite += d
+	m.dbWrites++
+	m.mu.Unlock()
+}
+
+// adds the time since start to the named phase of the run
+func (m *runMetrics) phaseSince(name string, start time.Time) {
+	d := time.Since(start)
+	m.mu.Lock()
+	m.phases[name] += d
+	m.mu.Unlock()
+}
+
+func (m *runMetrics) observeMails(stats *mailerStats) {
+	m.mu.Lock()
+	m.mailsSent += stats.sent.Load()
+	m.mailsFailed += stats.failed.Load()
+	m.connections += stats.connections.Load()
+	m.mu.Unlock()
+}
+
+type histogramReport struct {
+	Buckets []float64 `json:"buckets"`
+	Counts  []int64   `json:"counts"`
+	Sum     float64   `json:"sum"`
+	Count   int64     `json:"count"`
+}
+
+type siteReport struct {
+	Fetches      int64           `json:"fetches"`
+	NotModified  int64           `json:"not_modified"`
+	SameLinks    int64           `json:"links_unchanged"`
+	Errors       int64           `json:"errors"`
+	Bytes        int64           `json:"bytes"`
+	ReadSeconds  float64         `json:"read_seconds"`
+	ParseSeconds float64         `json:"parse_seconds"`
+	Latency      histogramReport `json:"latency_seconds"`
+}
+
+type mailsReport struct {
+	Sent        int64 `json:"sent"`
+	Failed      int64 `json:"failed"`
+	Connections int64 `json:"connections"`
+}
+
+type metricsReport struct {
+	WallSeconds    float64               `json:"wall_seconds"`
+	Phases         map[string]float64    `json:"phase_seconds"`
+	DBWriteSeconds float64               `json:"db_write_seconds"`
+	DBWrites       int64                 `json:"db_writes"`
+	Mails          mailsReport           `json:"mails"`
+	Sites          map[string]siteReport `json:"sites"`
+}
+
+func (m *runMetrics) report() metricsReport {
+	m.mu.Lock()
+	defer m.mu.Unlock()
+	r := metricsReport{
+		WallSeconds:    time.Since(m.start).Seconds(),
+		Phases:         make(map[string]float64, len(m.phases)),
+		DBWriteSeconds: m.dbWrite.Seconds(),
+		DBWrites:       m.dbWrites,
+		Mails:          mailsReport{Sent: m.mailsSent, Failed: m.mailsFailed, Connections: m.connections},
+		Sites:          make(map[string]siteReport, len(m.sites)),
+	}
+	for name, d := range m.phases {
+		r.Phases[name] = d.Seconds()
+	}
+	for site, s := range m.sites {
+		r.Sites[site] = siteReport{
+			Fetches:      s.fetches,
+			NotModified:  s.notModified,
+			SameLinks:    s.sameLinks,
+			Errors:       s.errors,
+			Bytes:        s.bytes,
+			ReadSeconds:  s.read.Seconds(),
+			ParseSeconds: s.parse.Seconds(),
+			Latency: histogramReport{
+				Buckets: latencyBuckets,
+				Counts:  s.latency.cumulative(),
+				Sum:     s.latency.sum,
+				Count:   s.latency.count,
+			},
+		}
+	}
+	return r
+}
+
+// writes the report as a single line of JSON
+func (r metricsReport) writeJSON(w io.Writer) error {
+	b, err := json.Marshal(r)
+	if err != nil {
+		return err
+	}
+	_, err = fmt.Fprintf(w, "%s\n", b)
+	return err
+}
+
+var promLabelEscaper = strings.NewReplacer(`\`, `\\`, `"`, `\"`, "\n", `\n`)
+
+// writes the report in the Prometheus text exposition format
+func (r metricsReport) writePrometheus(w io.Writer) error {
+	b := &strings.Builder{}
+	metric := func(name, typ, help string) {
+		fmt.Fprintf(b, "# HELP blognotifier_%s %s\n# TYPE blognotifier_%s %s\n", name, help, name, typ)
+	}
+	sites := make([]string, 0, len(r.Sites))
+	for site := range r.Sites {
+		sites = append(sites, site)
+	}
+	sort.Strings(sites)
+	perSite := func(name, typ, help string, value func(s siteReport) string) {
+		metric(name, typ, help)
+		for _, site := range sites {
+			fmt.Fprintf(b, "blognotifier_%s{site=\"%s\"} %s\n", name, promLabelEscaper.Replace(site), value(r.Sites[site]))
+		}
+	}
+	integer := func(v int64) string { return fmt.Sprintf("%d", v) }
+	float := func(v float64) string { return fmt.Sprintf("%g", v) }
+
+	metric("wall_seconds", "gauge", "Wall time of the run.")
+	fmt.Fprintf(b, "blognotifier_wall_seconds %g\n", r.WallSeconds)
+	metric("phase_seconds", "gauge", "Wall time of every phase of the run.")
+	phases := make([]string, 0, len(r.Phases))
+	for name := range r.Phases {
+		phases = append(phases, name)
+	}
+	sort.Strings(phases)
+	for _, name := range phases {
+		fmt.Fprintf(b, "blognotifier_phase_seconds{phase=\"%s\"} %g\n", name, r.Phases[name])
+	}
+	metric("db_write_seconds_total", "counter", "Time spent writing to the database.")
+	fmt.Fprintf(b, "blognotifier_db_write_seconds_total %g\n", r.DBWriteSeconds)
+	metric("db_writes_total", "counter", "Database writes, a transaction counts once.")
+	fmt.Fprintf(b, "blognotifier_db_writes_total %d\n", r.DBWrites)
+	metric("mails_sent_total", "counter", "Mail messages accepted by the SMTP server.")
+	fmt.Fprintf(b, "blognotifier_mails_sent_total %d\n", r.Mails.Sent)
+	metric("mails_failed_total", "counter", "Mail messages that could not be delivered.")
+	fmt.Fprintf(b, "blognotifier_mails_failed_total %d\n", r.Mails.Failed)
+	metric("smtp_connections_total", "counter", "SMTP connections opened.")
+	fmt.Fprintf(b, "blognotifier_smtp_connections_total %d\n", r.Mails.Connections)
+
+	perSite("fetches_total", "counter", "Pages requested.", func(s siteReport) string { return integer(s.Fetches) })
+	perSite("not_modified_total", "counter", "Pages answered with 304 Not Modified.",
+		func(s siteReport) string { return integer(s.NotModified) })
+	perSite("links_unchanged_total", "counter", "Pages fetched in full whose links had not changed.",
+		func(s siteReport) string { return integer(s.SameLinks) })
+	perSite("fetch_errors_total", "counter", "Pages that could not be fetched or parsed.",
+		func(s siteReport) string { return integer(s.Errors) })
+	perSite("fetch_bytes_total", "counter", "Bytes of page bodies read.", func(s siteReport) string { return integer(s.Bytes) })
+	perSite("read_seconds_total", "counter", "Time spent waiting for page bodies.",
+		func(s siteReport) string { return float(s.ReadSeconds) })
+	perSite("parse_seconds_total", "counter", "Time spent parsing pages.",
+		func(s siteReport) string { return float(s.ParseSeconds) })
+
+	metric("fetch_latency_seconds", "histogram", "Time until the response headers arrived.")
+	for _, site := range sites {
+		label := promLabelEscaper.Replace(site)
+		h := r.Sites[site].Latency
+		for i, count := range h.Counts {
+			le := "+Inf"
+			if i < len(h.Buckets) {
+				le = fmt.Sprintf("%g", h.Buckets[i])
+			}
+			fmt.Fprintf(b, "blognotifier_fetch_latency_seconds_bucket{site=\"%s\",le=\"%s\"} %d\n", label, le, count)
+		}
+		fmt.Fprintf(b, "blognotifier_fetch_latency_seconds_sum{site=\"%s\"} %g\n", label, h.Sum)
+		fmt.Fprintf(b, "blognotifier_fetch_latency_seconds_count{site=\"%s\"} %d\n", label, h.Count)
+	}
+	_, err := io.WriteString(w, b.String())
+	return err
+}
+
+// reports whether format is one of the --metrics formats, the empty format disables them
+func validMetricsFormat(format string) bool {
+	return format == "" || format == "json" || format == "prometheus"
+}
+
+// prints the metrics of the run in the given format to standard output
+func writeMetrics(format string) error {
+	r := metrics.report()
+	switch format {
+	case "json":
+		return r.writeJSON(os.Stdout)
+	case "prometheus":
+		return r.writePrometheus(os.Stdout)
+	}
+	return nil
+}
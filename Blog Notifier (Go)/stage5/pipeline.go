@@ -0,0 +1,132 @@
+package main
+
+import (
+	"context"
+	"fmt"
+	"time"
+)
+
+// what a site crawl hands the writer: the posts it discovered and the pages it fetched
+// and queued since its last chunk, and in its last chunk how it ended. The writer stores
+// a chunk in one transaction, see addNewPostsBatch
+type crawlChunk struct {
+	site     string
+	posts    []blogPostsLink
+	fetched  []crawlItem
+	queued   []crawlItem
+	metas    map[string]pageMeta // validators of the fetched pages that changed
+	first    string              // the newest post found so far
+	done     bool                // the crawl ended, its checkpoint is dropped
+	lastLink string              // with done, the new last link of the site if the crawl succeeded
+	left     []crawlItem         // with done, the pages the budget did not cover, see siteCrawl.left
+}
+
+type storeResult struct {
+	added map[string]int
+	err   error
+}
+
+// crawls blogs, stores the new posts and, with withMails, mails them, as three stages
+// that run concurrently. The crawl workers hand the links of a site over in chunks while
+// they discover them, a single writer stores them in batched transactions and wakes the
+// mail stage whenever a batch queued mails, so the first mails go out while the crawl
+// is still running. A digest covers all the new posts, with client.digest the mail stage
+// only runs once everything is stored. The channel to the writer is bounded, a crawl worker waits while the
+// writer is behind, and memory does not grow with the number of links found. Once ctx is
+// done the crawl stops, what it found is still stored and mailed.
+// Returns the number of new posts and the crawl error of every site
+func runPipeline(ctx context.Context, blogs []blogSite, withMails bool) (map[string]int, map[string]error, error) {
+	found := make(chan crawlChunk, orDefault(conf.Crawler.Workers, DEFAULT_CRAWL_WORKERS))
+	// holds at most one pending wake up, the mail stage claims every mail that is due at
+	// once, so wake ups that arrive while it is busy are covered by the pending one
+	wake := make(chan struct{}, 1)
+	streaming := withMails && !conf.Client.Digest
+	if streaming {
+		// mails left over by earlier runs may be due already
+		wake <- struct{}{}
+	}
+
+	mailed := make(chan struct{})
+	go func() {
+		defer close(mailed)
+		for range wake {
+			start := time.Now()
+			if err := notify(); err != nil {
+				fmt.Println("error notifying new posts")
+				fmt.Println(err)
+			}
+			metrics.phaseSince("notify", start)
+		}
+	}()
+
+	stored := make(chan storeResult, 1)
+	go func() {
+		added, err := storePosts(found, withMails, streaming, wake)
+		if withMails {
+			// one last round for the mails stored since the mail stage last started
+			select {
+			case wake <- struct{}{}:
+			default:
+			}
+		}
+		close(wake)
+		stored <- storeResult{added, err}
+	}()
+
+	start := time.Now()
+	siteErrors := crawlBlogs(ctx, blogs, found)
+	close(found)
+	metrics.phaseSince("crawl", start)
+
+	res := <-stored
+	<-mailed
+	return res.added, siteErrors, res.err
+}
+
+// the writer stage of the pipeline: stores the chunks received on found, merging the
+// chunks that are waiting into one transaction of up to POSTS_BATCH_SIZE posts, and
+// with streaming set wakes the mail stage after every batch that queued mails. After a failed write the
+// remaining links are still received, so that the crawl is not blocked, but dropped
+func storePosts(found <-chan crawlChunk, withMails, streaming bool, wake chan<- struct{}) (map[string]int, error) {
+	added := make(map[string]int)
+	db, err := getDBConnection()
+	batch := make([]crawlChunk, 0)
+	for chunk := range found {
+		batch = append(batch[:0], chunk)
+		posts := len(chunk.posts)
+	more:
+		for posts < POSTS_BATCH_SIZE {
+			select {
+			case chunk, ok := <-found:
+				if !ok {
+					break more
+				}
+				batch = append(batch, chunk)
+				posts += len(chunk.posts)
+			default:
+				break more
+			}
+		}
+		if err != nil {
+			continue
+		}
+
+		start := time.Now()
+		var n int
+		n, err = addNewPostsBatch(db, batch, withMails, added)
+		metrics.dbWriteSince(start)
+		metrics.phaseSince("store", start)
+		if err != nil {
+			fmt.Println("error storing new posts")
+			fmt.Println(err)
+			continue
+		}
+		if streaming && n > 0 {
+			select {
+			case wake <- struct{}{}:
+			default:
+			}
+		}
+	}
+	return added, err
+}
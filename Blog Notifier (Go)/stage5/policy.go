@@ -0,0 +1,362 @@
+package main
+
+import (
+	"database/sql"
+	"fmt"
+	"io"
+	"net/url"
+	"strconv"
+	"strings"
+	"sync"
+	"time"
+)
+
+// what a crawl may fetch is decided by the robots.txt of the host of the site and by the
+// policy of the site: include and exclude patterns and the page and byte budgets. The
+// robots.txt of a host is fetched once per ROBOTS_TTL, see robotsCache, and its rules are
+// those of the group naming ROBOTS_AGENT, or else of the * group. A robots.txt that is
+// missing allows everything, one that cannot be fetched forbids the whole host until it
+// is tried again after ROBOTS_RETRY_DELAY, as RFC 9309 asks. Crawl-delay spaces the
+// requests to the host, up to MAX_CRAWL_DELAY
+const (
+	ROBOTS_AGENT       = "blognotifier"
+	ROBOTS_TTL         = 24 * time.Hour
+	ROBOTS_RETRY_DELAY = 10 * time.Minute
+	MAX_ROBOTS_BYTES   = 500 << 10
+	MAX_CRAWL_DELAY    = 30 * time.Second
+)
+
+// an allow or disallow line of a robots.txt
+type robotsRule struct {
+	pattern string
+	allow   bool
+}
+
+// the rules of a robots.txt that apply to the crawler. A nil *robotsRules allows
+// everything
+type robotsRules struct {
+	rules       []robotsRule
+	delay       time.Duration
+	disallowAll bool      // the robots.txt could not be fetched
+	expires     time.Time // when the rules are to be fetched again
+}
+
+// a group of a robots.txt: the user agents it names and their rules
+type robotsGroup struct {
+	agents []string
+	rules  []robotsRule
+	delay  time.Duration
+}
+
+func (g *robotsGroup) names(agent string) bool {
+	for _, name := range g.agents {
+		if name == agent || strings.HasPrefix(name, agent+"/") {
+			return true
+		}
+	}
+	return false
+}
+
+// parses a robots.txt into the rules of the groups naming ROBOTS_AGENT, or of the *
+// groups when none does. Consecutive user-agent lines share the rules that follow them,
+// lines the crawler does not know are skipped
+func parseRobots(body string) *robotsRules {
+	groups := []*robotsGroup{}
+	var group *robotsGroup
+	inRules := false
+	for _, line := range strings.Split(body, "\n") {
+		if i := strings.IndexByte(line, '#'); i >= 0 {
+			line = line[:i]
+		}
+		key, value, ok := strings.Cut(line, ":")
+		if !ok {
+			continue
+		}
+		key, value = strings.ToLower(strings.TrimSpace(key)), strings.TrimSpace(value)
+		switch key {
+		case "user-agent":
+			if group == nil || inRules {
+				group, inRules = &robotsGroup{}, false
+				groups = append(groups, group)
+			}
+			group.agents = append(group.agents, strings.ToLower(value))
+		case "allow", "disallow":
+			if group == nil {
+				continue
+			}
+			inRules = true
+			// an empty disallow allows everything, there is nothing to record
+			if value != "" {
+				group.rules = append(group.rules, robotsRule{pattern: value, allow: key == "allow"})
+			}
+		case "crawl-delay":
+			if group == nil {
+				continue
+			}
+			inRules = true
+			if seconds, err := strconv.ParseFloat(value, 64); err == nil && seconds > 0 {
+				group.delay = min(time.Duration(seconds*float64(time.Second)), MAX_CRAWL_DELAY)
+			}
+		}
+	}
+
+	rules := &robotsRules{}
+	for _, agent := range []string{ROBOTS_AGENT, "*"} {
+		matched := false
+		for _, group := range groups {
+			if group.names(agent) {
+				matched = true
+				rules.rules = append(rules.rules, group.rules...)
+				rules.delay = max(rules.delay, group.delay)
+			}
+		}
+		if matched {
+			break
+		}
+	}
+	return rules
+}
+
+// reports whether the rules allow fetching u. The longest pattern matching the path
+// decides, allow wins a tie, and a path no pattern matches is allowed
+func (r *robotsRules) allows(u *url.URL) bool {
+	if r == nil {
+		return true
+	}
+	path := requestPath(u)
+	if path == "/robots.txt" {
+		return true
+	}
+	if r.disallowAll {
+		return false
+	}
+	allow, longest := true, -1
+	for _, rule := range r.rules {
+		if len(rule.pattern) < longest || !patternMatches(rule.pattern, path) {
+			continue
+		}
+		if len(rule.pattern) > longest || rule.allow {
+			allow = rule.allow
+		}
+		longest = len(rule.pattern)
+	}
+	return allow
+}
+
+// the path and query of u, which the patterns of robots.txt and of the site policy match
+func requestPath(u *url.URL) string {
+	path := u.EscapedPath()
+	if path == "" {
+		path = "/"
+	}
+	if u.RawQuery != "" {
+		path += "?" + u.RawQuery
+	}
+	return path
+}
+
+// matches a path against a pattern of robots.txt syntax: the pattern matches a prefix of
+// the path, * stands for any characters and a trailing $ anchors it at the end of the path
+func patternMatches(pattern, path string) bool {
+	anchored := strings.HasSuffix(pattern, "$")
+	if anchored {
+		pattern = pattern[:len(pattern)-1]
+	}
+	parts := strings.Split(pattern, "*")
+	if !strings.HasPrefix(path, parts[0]) {
+		return false
+	}
+	rest := path[len(parts[0]):]
+	if len(parts) == 1 {
+		return !anchored || rest == ""
+	}
+	for _, part := range parts[1 : len(parts)-1] {
+		i := strings.Index(rest, part)
+		if i < 0 {
+			return false
+		}
+		rest = rest[i+len(part):]
+	}
+	last := parts[len(parts)-1]
+	if anchored {
+		return strings.HasSuffix(rest, last)
+	}
+	return strings.Contains(rest, last)
+}
+
+// the robots.txt rules of the origins crawled by this process. Every origin is looked
+// up once by all the crawls that need it, the database is asked first and the robots.txt
+// only fetched when the one stored there is older than ROBOTS_TTL
+type robotsCache struct {
+	mu      sync.Mutex
+	origins map[string]*robotsEntry
+}
+
+type robotsEntry struct {
+	mu    sync.Mutex
+	rules *robotsRules
+}
+
+var robots = &robotsCache{origins: make(map[string]*robotsEntry)}
+
+// returns the rules for the origin, scheme and host, of a site, host being its key in the
+// host limiter. The Crawl-delay of the rules is applied to the limiter
+func (c *robotsCache) rulesFor(origin, host string) *robotsRules {
+	c.mu.Lock()
+	entry, ok := c.origins[origin]
+	if !ok {
+		entry = &robotsEntry{}
+		c.origins[origin] = entry
+	}
+	c.mu.Unlock()
+
+	// the crawls of the other sites of the origin wait for the one loading the rules
+	entry.mu.Lock()
+	defer entry.mu.Unlock()
+	if entry.rules == nil || time.Now().After(entry.rules.expires) {
+		entry.rules = loadRobots(origin, host)
+		limiter.setDelay(host, entry.rules.delay)
+	}
+	return entry.rules
+}
+
+// reads the robots.txt of an origin from the database, or fetches and stores it when the
+// stored one is missing or out of date
+func loadRobots(origin, host string) *robotsRules {
+	db, err := getDBConnection()
+	if err != nil {
+		fmt.Println(err)
+		return &robotsRules{disallowAll: true, expires: time.Now().Add(ROBOTS_RETRY_DELAY)}
+	}
+	body, fetchedAt := "", int64(0)
+	err = db.QueryRow(FETCH_ROBOTS, origin).Scan(&body, &fetchedAt)
+	if err != nil && err != sql.ErrNoRows {
+		fmt.Printf("%s: error reading the stored robots.txt: %s\n", origin, err)
+	}
+	expires := time.UnixMilli(fetchedAt).Add(ROBOTS_TTL)
+	if err == nil && time.Now().Before(expires) {
+		rules := parseRobots(body)
+		rules.expires = expires
+		return rules
+	}
+
+	limiter.acquire(host)
+	body, err = fetchRobots(origin)
+	limiter.release(host)
+	if err != nil {
+		fmt.Printf("%s: %s, not crawling the host\n", origin, err)
+		return &robotsRules{disallowAll: true, expires: time.Now().Add(ROBOTS_RETRY_DELAY)}
+	}
+	now := time.Now()
+	if _, err := db.Exec(SAVE_ROBOTS, origin, body, now.UnixMilli()); err != nil {
+		fmt.Printf("%s: error storing robots.txt: %s\n", origin, err)
+	}
+	rules := parseRobots(body)
+	rules.expires = now.Add(ROBOTS_TTL)
+	return rules
+}
+
+// fetches the robots.txt of an origin. A robots.txt that does not exist, any client
+// error, is an empty one, a server error or a failed request is an error
+func fetchRobots(origin string) (string, error) {
+	res, err := getHTTPClient().Get(origin + "/robots.txt")
+	if err != nil {
+		return "", fmt.Errorf("error fetching robots.txt: %w", err)
+	}
+	defer res.Body.Close()
+	switch {
+	case res.StatusCode >= 200 && res.StatusCode < 300:
+		b, err := io.ReadAll(io.LimitReader(res.Body, MAX_ROBOTS_BYTES))
+		if err != nil {
+			return "", fmt.Errorf("error reading robots.txt: %w", err)
+		}
+		return string(b), nil
+	case res.StatusCode >= 400 && res.StatusCode < 500:
+		return "", nil
+	}
+	return "", fmt.Errorf("robots.txt answered %s", res.Status)
+}
+
+// the policy of a site: the include and exclude patterns, of the config file and of the
+// site together, and its page and byte budgets
+type sitePolicy struct {
+	include  []string
+	exclude  []string
+	maxPages int
+	maxBytes int64
+}
+
+// reads the policy of a site from its row in the blogs table, falling back to the config
+// file for the budgets the site does not set
+func loadSitePolicy(site string) (sitePolicy, error) {
+	_, maxPages := crawlerLimits()
+	policy := sitePolicy{
+		include:  conf.Crawler.Include,
+		exclude:  conf.Crawler.Exclude,
+		maxPages: maxPages,
+		maxBytes: conf.Crawler.MaxSiteBytes,
+	}
+	if policy.maxBytes <= 0 {
+		policy.maxBytes = DEFAULT_MAX_SITE_BYTES
+	}
+	db, err := getDBConnection()
+	if err != nil {
+		return policy, err
+	}
+	include, exclude, pages, bytes := "", "", 0, int64(0)
+	err = db.QueryRow(FETCH_BLOG_POLICY, site).Scan(&include, &exclude, &pages, &bytes)
+	if err == sql.ErrNoRows {
+		return policy, nil
+	}
+	if err != nil {
+		return policy, err
+	}
+	policy.include = append(strings.Fields(include), policy.include...)
+	policy.exclude = append(strings.Fields(exclude), policy.exclude...)
+	if pages > 0 {
+		policy.maxPages = pages
+	}
+	if bytes > 0 {
+		policy.maxBytes = bytes
+	}
+	return policy, nil
+}
+
+// reports whether the patterns let the crawl store and fetch u: it matches none of the
+// exclude patterns and, when there are include patterns, one of them
+func (p sitePolicy) wants(u *url.URL) bool {
+	path := requestPath(u)
+	for _, pattern := range p.exclude {
+		if patternMatches(pattern, path) {
+			return false
+		}
+	}
+	if len(p.include) == 0 {
+		return true
+	}
+	for _, pattern := range p.include {
+		if patternMatches(pattern, path) {
+			return true
+		}
+	}
+	return false
+}
+
+// sets the include and exclude patterns, separated by white space, and the budgets of a
+// watched site. Empty patterns and zero budgets leave it to the config file
+func setSitePolicy(site, include, exclude string, maxPages int, maxBytes int64) error {
+	db, err := getDBConnection()
+	if err != nil {
+		return err
+	}
+	include = strings.Join(strings.Fields(include), " ")
+	exclude = strings.Join(strings.Fields(exclude), " ")
+	res, err := db.Exec(UPDATE_BLOG_POLICY, include, exclude, maxPages, maxBytes, site)
+	if err != nil {
+		return err
+	}
+	if n, err := res.RowsAffected(); err == nil && n == 0 {
+		return fmt.Errorf("%s is not watched", site)
+	}
+	return nil
+}
@@ -0,0 +1,127 @@
+package main
+
+import (
+	"database/sql"
+	"fmt"
+	"strconv"
+	"strings"
+	"time"
+)
+
+// the conditions of listPosts --since, --search and --site. A zero since matches every
+// post, a limit of 0 or less does not limit the number of posts
+type postFilter struct {
+	site   string
+	since  time.Time
+	search string
+	limit  int
+}
+
+// a post as listed by queryPosts
+type postRow struct {
+	site         string
+	link         string
+	title        string
+	discoveredAt time.Time
+}
+
+// parses the value of --since relative to now: a date like 2006-01-02, a time in RFC
+// 3339 format, or a duration back from now like 36h, 7d or 2w
+func parseSince(value string, now time.Time) (time.Time, error) {
+	for _, layout := range []string{time.RFC3339, "2006-01-02"} {
+		if t, err := time.ParseInLocation(layout, value, time.Local); err == nil {
+			return t, nil
+		}
+	}
+	unit := time.Duration(0)
+	switch {
+	case strings.HasSuffix(value, "d"):
+		unit = 24 * time.Hour
+	case strings.HasSuffix(value, "w"):
+		unit = 7 * 24 * time.Hour
+	}
+	if unit > 0 {
+		n, err := strconv.Atoi(strings.TrimSpace(value[:len(value)-1]))
+		if err == nil && n >= 0 {
+			return now.Add(-time.Duration(n) * unit), nil
+		}
+	} else if d, err := time.ParseDuration(value); err == nil && d >= 0 {
+		return now.Add(-d), nil
+	}
+	return time.Time{}, fmt.Errorf("invalid --since %q, use a date like 2006-01-02 or a duration like 7d", value)
+}
+
+// turns the words searched for into an FTS5 query that matches the posts containing
+// all of them. Every word is quoted, so that characters like - or * are searched for
+// instead of read as query syntax
+func ftsQuery(words []string) string {
+	quoted := make([]string, len(words))
+	for i, word := range words {
+		quoted[i] = `"` + strings.ReplaceAll(word, `"`, `""`) + `"`
+	}
+	return strings.Join(quoted, " ")
+}
+
+// builds the QUERY_POSTS statement of f. Without a search the posts are read newest
+// first off the time index, or the site and time index for a single site, and reading
+// stops at the limit. A search goes through the full-text index when there is one, and
+// otherwise matches the words against the titles and links while walking the time index
+func postQuery(f postFilter, fullText bool) (string, []any) {
+	table := "posts"
+	where := []string{"discovered_at >= ?"}
+	args := []any{f.since.UnixMilli()}
+	if f.site != "" {
+		where = append(where, "site = ?")
+		args = append(args, f.site)
+	}
+	words := strings.Fields(f.search)
+	if len(words) > 0 && fullText {
+		table = "posts_fts"
+		where = append(where, "posts_fts MATCH ?")
+		args = append(args, ftsQuery(words))
+	} else {
+		for _, word := range words {
+			pattern := "%" + word + "%"
+			where = append(where, "(title LIKE ? OR link LIKE ?)")
+			args = append(args, pattern, pattern)
+		}
+	}
+	limit := f.limit
+	if limit <= 0 {
+		limit = -1
+	}
+	return fmt.Sprintf(QUERY_POSTS, table, strings.Join(where, " AND ")), append(args, limit)
+}
+
+// hands the posts matching f to each, the newest first, as they are read from the
+// database
+func queryPosts(f postFilter, each func(post postRow) error) error {
+	db, err := getDBConnection()
+	if err != nil {
+		return err
+	}
+	fullText := false
+	if strings.TrimSpace(f.search) != "" {
+		if fullText, err = hasTable(db, "posts_fts"); err != nil {
+			return err
+		}
+	}
+	query, args := postQuery(f, fullText)
+	rows, err := db.Query(query, args...)
+	if err != nil {
+		return err
+	}
+	defer rows.Close()
+	for rows.Next() {
+		post, title, discoveredAt := postRow{}, sql.NullString{}, int64(0)
+		if err := rows.Scan(&post.site, &post.link, &title, &discoveredAt); err != nil {
+			return err
+		}
+		post.title = title.String
+		post.discoveredAt = time.UnixMilli(discoveredAt)
+		if err := each(post); err != nil {
+			return err
+		}
+	}
+	return rows.Err()
+}
@@ -0,0 +1,257 @@
+package main
+
+import (
+	"context"
+	"database/sql"
+	"fmt"
+	"time"
+)
+
+// a blog due for a poll along with its schedule. A zero interval means the blog has
+// never been polled by the watch command
+type scheduledBlog struct {
+	blogSite
+	interval time.Duration
+	errors   int
+}
+
+// returns the poll intervals from the config file, falling back to the defaults
+func pollIntervals() (initial, lo, hi time.Duration) {
+	initial, lo, hi = conf.Watch.Interval, conf.Watch.MinInterval, conf.Watch.MaxInterval
+	if lo <= 0 {
+		lo = DEFAULT_MIN_POLL_INTERVAL
+	}
+	if hi <= 0 {
+		hi = DEFAULT_MAX_POLL_INTERVAL
+	}
+	if hi < lo {
+		hi = lo
+	}
+	if initial <= 0 {
+		initial = DEFAULT_POLL_INTERVAL
+	}
+	return min(max(initial, lo), hi), lo, hi
+}
+
+// adapts the poll interval of a blog to its observed post frequency: n new posts over
+// the last interval mean a post every interval/n, which becomes the next interval so that
+// a poll finds about one new post. A poll without new posts stretches the interval by half
+func nextPollInterval(interval time.Duration, n int) time.Duration {
+	initial, lo, hi := pollIntervals()
+	switch {
+	case interval <= 0:
+		// the first poll ingests the posts already published, they say nothing
+		// about how often the blog posts
+		interval = initial
+	case n > 0:
+		interval /= time.Duration(n)
+	default:
+		interval += interval / 2
+	}
+	return min(max(interval, lo), hi)
+}
+
+// the delay before a blog is polled again after errors consecutive polls failed. It starts
+// at the min interval, a passing failure is retried soon, and doubles with every failure
+// up to the max interval
+func retryDelay(errors int) time.Duration {
+	_, lo, hi := pollIntervals()
+	delay := lo
+	for i := 1; i < errors && delay < hi; i++ {
+		delay *= 2
+	}
+	return min(delay, hi)
+}
+
+// lists the blogs whose next poll is due at now and that no sharded run holds
+func listDueBlogs(now time.Time) ([]scheduledBlog, error) {
+	db, err := getDBConnection()
+	if err != nil {
+		return nil, err
+	}
+	rows, err := db.Query(FETCH_DUE_BLOGS, now.UnixMilli(), now.UnixMilli())
+	if err != nil {
+		return nil, err
+	}
+	defer rows.Close()
+	return scanScheduledBlogs(rows)
+}
+
+// reads blogs and their schedule from rows of site, feed, last_link, poll_interval and
+// poll_errors
+func scanScheduledBlogs(rows *sql.Rows) ([]scheduledBlog, error) {
+	blogs := make([]scheduledBlog, 0)
+	for rows.Next() {
+		blog := scheduledBlog{}
+		interval, lastLink := int64(0), sql.NullString{}
+		if err := rows.Scan(&blog.site, &blog.feed, &lastLink, &interval, &blog.errors); err != nil {
+			return nil, err
+		}
+		blog.lastLink = lastLink.String
+		blog.interval = time.Duration(interval) * time.Millisecond
+		blogs = append(blogs, blog)
+	}
+	return blogs, rows.Err()
+}
+
+// returns the time of the earliest scheduled poll, ok is false when no blog is watched
+func nextPollTime() (time.Time, bool, error) {
+	db, err := getDBConnection()
+	if err != nil {
+		return time.Time{}, false, err
+	}
+	next := sql.NullInt64{}
+	if err := db.QueryRow(FETCH_NEXT_POLL).Scan(&next); err != nil {
+		return time.Time{}, false, err
+	}
+	return time.UnixMilli(next.Int64), next.Valid, nil
+}
+
+// stores the new schedule of the polled blogs in one transaction, releasing their leases
+func saveSchedules(blogs []scheduledBlog, next []time.Time) error {
+	defer metrics.dbWriteSince(time.Now())
+	db, err := getDBConnection()
+	if err != nil {
+		return err
+	}
+	tx, err := db.Begin()
+	if err != nil {
+		return err
+	}
+	defer tx.Rollback()
+	stmt, err := tx.Prepare(UPDATE_BLOG_SCHEDULE)
+	if err != nil {
+		return err
+	}
+	defer stmt.Close()
+	for i, blog := range blogs {
+		_, err = stmt.Exec(blog.interval.Milliseconds(), blog.errors, next[i].UnixMilli(), blog.site)
+		if err != nil {
+			return err
+		}
+	}
+	return tx.Commit()
+}
+
+// polls every blog that is due: crawls them, stores their new posts, mails them and
+// schedules the next poll of each blog from what it found. With an owner the watch is
+// sharded, only a batch of the due blogs is claimed and leased to owner while polled.
+// Every poll is a run of its own for the metrics, they are printed at its end in the
+// given format unless it is empty. A poll stopped through ctx returns errCrawlStopped,
+// it leaves the blogs due and gives up their leases, the next poll resumes their crawls
+func pollDueBlogs(ctx context.Context, now time.Time, metricsFormat, owner string) error {
+	var due []scheduledBlog
+	var err error
+	if owner == "" {
+		due, err = listDueBlogs(now)
+	} else {
+		lease, batch, _ := shardLimits()
+		due, err = claimBlogs(CLAIM_DUE_BLOGS, owner, now, now, lease, batch)
+	}
+	if err != nil {
+		return err
+	}
+	if len(due) == 0 {
+		// failed mails come due for a retry on their own schedule
+		return notify()
+	}
+	metrics = newRunMetrics()
+	blogs := make([]blogSite, 0, len(due))
+	for _, blog := range due {
+		blogs = append(blogs, blog.blogSite)
+	}
+	stop := func() {}
+	if owner != "" {
+		lease, _, _ := shardLimits()
+		stop = keepLeases(owner, lease)
+	}
+	// mails that cannot be delivered are retried by a later poll
+	added, siteErrors, err := runPipeline(ctx, blogs, true)
+	stop()
+	if ctx.Err() != nil {
+		// the blogs stay due, the next poll of any watch resumes their crawls
+		if owner != "" {
+			if err := dropBlogLeases(owner); err != nil {
+				fmt.Println("error releasing leases")
+				fmt.Println(err)
+			}
+		}
+		return errCrawlStopped
+	}
+	if err != nil {
+		return err
+	}
+
+	total := 0
+	next := make([]time.Time, len(due))
+	for i := range due {
+		blog := &due[i]
+		if siteErrors[blog.site] != nil {
+			blog.errors++
+			next[i] = now.Add(retryDelay(blog.errors))
+			continue
+		}
+		n := added[blog.site]
+		total += n
+		blog.errors = 0
+		blog.interval = nextPollInterval(blog.interval, n)
+		next[i] = now.Add(blog.interval)
+	}
+	if err = saveSchedules(due, next); err != nil {
+		return err
+	}
+	fmt.Printf("watch: polled %d sites, %d new posts, %d errors\n", len(due), total, len(siteErrors))
+	return writeMetrics(metricsFormat)
+}
+
+// keeps polling the watched blogs as they become due until interrupted, or until
+// duration has passed when it is positive, which lets the poll in progress finish. Only
+// the end of duration is a clean stop, an interrupted watch returns errCrawlStopped. A
+// sharded watch shares the blogs with the other sharded watches on the database, see
+// pollDueBlogs
+func watchBlogs(configFile string, duration time.Duration, metricsFormat string, sharded bool) error {
+	err := parseConfig(configFile)
+	if err != nil {
+		return err
+	}
+	ctx, stop := interruptContext()
+	defer stop()
+	until := ctx
+	if duration > 0 {
+		var cancel context.CancelFunc
+		until, cancel = context.WithTimeout(ctx, duration)
+		defer cancel()
+	}
+
+	owner := ""
+	if sharded {
+		owner = leaseOwner()
+	}
+	_, lo, _ := pollIntervals()
+	for {
+		if err := pollDueBlogs(ctx, time.Now(), metricsFormat, owner); err != nil {
+			return err
+		}
+		// blogs added while watching are due at once, looking again after the min
+		// interval at the latest picks them up
+		wait := lo
+		next, ok, err := nextPollTime()
+		if err != nil {
+			return err
+		}
+		if ok {
+			wait = min(max(time.Until(next), 0), lo)
+		}
+		timer := time.NewTimer(wait)
+		select {
+		case <-until.Done():
+			timer.Stop()
+			if ctx.Err() != nil {
+				return errCrawlStopped
+			}
+			fmt.Println("watch: stopped")
+			return nil
+		case <-timer.C:
+		}
+	}
+}
@@ -0,0 +1,176 @@
+package main
+
+import (
+	"crypto/rand"
+	"encoding/hex"
+	"fmt"
+	"os"
+	"time"
+)
+
+// sharded runs split the watchlist between several processes, on one host or on several
+// sharing the database. A process claims a batch of blogs at a time by leasing them, works
+// on them while renewing the lease and releases them when done. The blogs of a process
+// that died are claimed by another one once their lease ran out
+
+// names the process in the leases it holds, unique across hosts and restarts
+func leaseOwner() string {
+	host, err := os.Hostname()
+	if err != nil {
+		host = "localhost"
+	}
+	b := make([]byte, 4)
+	rand.Read(b)
+	return fmt.Sprintf("%s:%d:%s", host, os.Getpid(), hex.EncodeToString(b))
+}
+
+// returns the lease, batch and round of sharded runs from the config file, falling back to
+// the defaults
+func shardLimits() (lease time.Duration, batch int, round time.Duration) {
+	return orDefaultDuration(conf.Shard.Lease, DEFAULT_SHARD_LEASE),
+		orDefault(conf.Shard.Batch, DEFAULT_SHARD_BATCH),
+		orDefaultDuration(conf.Shard.Round, DEFAULT_SHARD_ROUND)
+}
+
+// leases up to batch blogs to owner with one of the CLAIM_*_BLOGS statements, the blogs
+// whose lease ran out by now and that were synced before, or are due at, since. Returns
+// the claimed blogs, none when every blog is leased or done
+func claimBlogs(query, owner string, now, since time.Time, lease time.Duration, batch int) ([]scheduledBlog, error) {
+	defer metrics.dbWriteSince(time.Now())
+	db, err := getDBConnection()
+	if err != nil {
+		return nil, err
+	}
+	rows, err := db.Query(query, owner, now.Add(lease).UnixMilli(), now.UnixMilli(), since.UnixMilli(), batch)
+	if err != nil {
+		return nil, err
+	}
+	defer rows.Close()
+	return scanScheduledBlogs(rows)
+}
+
+// extends the leases of owner to until
+func renewBlogLeases(owner string, until time.Time) error {
+	db, err := getDBConnection()
+	if err != nil {
+		return err
+	}
+	_, err = db.Exec(RENEW_BLOG_LEASES, until.UnixMilli(), owner)
+	return err
+}
+
+// keeps renewing the leases of owner every third of the lease, so that they do not run
+// out while a batch takes long to crawl, until the returned function is called
+func keepLeases(owner string, lease time.Duration) func() {
+	done := make(chan struct{})
+	stopped := make(chan struct{})
+	go func() {
+		defer close(stopped)
+		ticker := time.NewTicker(lease / 3)
+		defer ticker.Stop()
+		for {
+			select {
+			case <-done:
+				return
+			case <-ticker.C:
+				if err := renewBlogLeases(owner, time.Now().Add(lease)); err != nil {
+					fmt.Println("error renewing leases")
+					fmt.Println(err)
+				}
+			}
+		}
+	}()
+	return func() {
+		close(done)
+		<-stopped
+	}
+}
+
+// releases the leases of owner on the synced blogs in one transaction, recording when they
+// were synced
+func releaseBlogs(owner string, blogs []blogSite, now time.Time) error {
+	defer metrics.dbWriteSince(time.Now())
+	db, err := getDBConnection()
+	if err != nil {
+		return err
+	}
+	tx, err := db.Begin()
+	if err != nil {
+		return err
+	}
+	defer tx.Rollback()
+	stmt, err := tx.Prepare(RELEASE_BLOG)
+	if err != nil {
+		return err
+	}
+	defer stmt.Close()
+	for _, blog := range blogs {
+		if _, err = stmt.Exec(now.UnixMilli(), blog.site, owner); err != nil {
+			return err
+		}
+	}
+	return tx.Commit()
+}
+
+// gives up the leases of owner without recording a sync, the blogs are free to be claimed
+// by another process at once
+func dropBlogLeases(owner string) error {
+	db, err := getDBConnection()
+	if err != nil {
+		return err
+	}
+	_, err = db.Exec(DROP_BLOG_LEASES, owner)
+	return err
+}
+
+// runs a sync as one of several processes sharing the watchlist: claims batches of the
+// blogs not synced within the round until there are none left. A blog that cannot be
+// crawled is released as well, it is crawled again by the next round like in a full sync.
+// An interrupted or failed sync drops its leases, so another process resumes the crawls
+// of its blogs from their checkpoints without waiting for the leases to run out. Prints the metrics of the run at its end in the given format unless it is empty
+func syncSharded(configFile, metricsFormat string) error {
+	err := parseConfig(configFile)
+	if err != nil {
+		return err
+	}
+	owner := leaseOwner()
+	lease, batch, round := shardLimits()
+	since := time.Now().Add(-round)
+	ctx, stop := interruptContext()
+	defer stop()
+	synced := 0
+	for {
+		claimed, err := claimBlogs(CLAIM_SYNC_BLOGS, owner, time.Now(), since, lease, batch)
+		if err != nil {
+			fmt.Println("error claiming blogs")
+			return err
+		}
+		if len(claimed) == 0 {
+			break
+		}
+		blogs := make([]blogSite, 0, len(claimed))
+		for _, blog := range claimed {
+			blogs = append(blogs, blog.blogSite)
+		}
+		stopLeases := keepLeases(owner, lease)
+		_, _, err = runPipeline(ctx, blogs, true)
+		stopLeases()
+		if err != nil || ctx.Err() != nil {
+			// the blogs stay unsynced, another process resumes their crawls right away
+			if err := dropBlogLeases(owner); err != nil {
+				fmt.Println("error releasing leases")
+				fmt.Println(err)
+			}
+			if err != nil {
+				return err
+			}
+			return errCrawlStopped
+		}
+		if err = releaseBlogs(owner, blogs, time.Now()); err != nil {
+			return err
+		}
+		synced += len(blogs)
+	}
+	fmt.Printf("sync: %s synced %d sites\n", owner, synced)
+	return writeMetrics(metricsFormat)
+}
@@ -0,0 +1,272 @@
+package main
+
+import (
+	"bytes"
+	"encoding/json"
+	"errors"
+	"fmt"
+	"net/http"
+	"net/url"
+	"strconv"
+	"strings"
+	"sync"
+	"time"
+)
+
+// the Telegram backend, used with mode: telegram. A message holds at most
+// TELEGRAM_MAX_MESSAGE characters, the Bot API limit. The default rate of one message per
+// second to a chat with bursts of three stays below the limits Telegram sets for a chat.
+// Mails are claimed TELEGRAM_CLAIM_MESSAGES messages worth at a time, so that a long
+// backlog sent at that rate does not outlive its claim
+const (
+	MODE_TELEGRAM           = "telegram"
+	TELEGRAM_API_URL        = "https://api.telegram.org"
+	TELEGRAM_MAX_MESSAGE    = 4096
+	TELEGRAM_MAX_RETRIES    = 3
+	TELEGRAM_CLAIM_MESSAGES = 20
+	DEFAULT_TELEGRAM_POSTS  = 20
+	DEFAULT_TELEGRAM_RATE   = 1.0
+	DEFAULT_TELEGRAM_BURST  = 3
+)
+
+// a token bucket: holds up to burst tokens and gains rate tokens per second, every
+// message to the chat takes one
+type tokenBucket struct {
+	mu     sync.Mutex
+	rate   float64
+	burst  float64
+	tokens float64
+	last   time.Time
+}
+
+func newTokenBucket(rate float64, burst int) *tokenBucket {
+	return &tokenBucket{rate: rate, burst: float64(burst), tokens: float64(burst), last: time.Now()}
+}
+
+func (b *tokenBucket) refill(now time.Time) {
+	b.tokens = min(b.tokens+now.Sub(b.last).Seconds()*b.rate, b.burst)
+	b.last = now
+}
+
+// takes a token, waiting until there is one. A caller that has to wait takes the token
+// ahead of time, the bucket goes negative, so the callers are served in turn
+func (b *tokenBucket) take() {
+	b.mu.Lock()
+	b.refill(time.Now())
+	b.tokens--
+	wait := time.Duration(0)
+	if b.tokens < 0 {
+		wait = time.Duration(-b.tokens / b.rate * float64(time.Second))
+	}
+	b.mu.Unlock()
+	time.Sleep(wait)
+}
+
+// holds back the next token for d at least, after the chat told us to slow down
+func (b *tokenBucket) pause(d time.Duration) {
+	b.mu.Lock()
+	b.refill(time.Now())
+	b.tokens = min(b.tokens, 1) - d.Seconds()*b.rate
+	b.mu.Unlock()
+}
+
+var (
+	chatBuckets   = make(map[string]*tokenBucket)
+	chatBucketsMu sync.Mutex
+)
+
+// returns the token bucket of a chat, kept for the life of the process so that the rate
+// holds across the notify runs of a watch
+func chatBucket(chat string) *tokenBucket {
+	chatBucketsMu.Lock()
+	defer chatBucketsMu.Unlock()
+	b, ok := chatBuckets[chat]
+	if !ok {
+		rate := conf.Telegram.Rate
+		if rate <= 0 {
+			rate = DEFAULT_TELEGRAM_RATE
+		}
+		b = newTokenBucket(rate, orDefault(conf.Telegram.Burst, DEFAULT_TELEGRAM_BURST))
+		chatBuckets[chat] = b
+	}
+	return b
+}
+
+// the chat id of the configured channel, a channel name gets the @ the Bot API expects
+func telegramChat() string {
+	chat := conf.Telegram.Channel
+	if chat == "" || strings.HasPrefix(chat, "@") || strings.HasPrefix(chat, "-") || (chat[0] >= '0' && chat[0] <= '9') {
+		return chat
+	}
+	return "@" + chat
+}
+
+// packs the mails into messages of at most perMessage posts, one per line, and
+// TELEGRAM_MAX_MESSAGE characters. Returns the messages and the mails each one covers
+func packTelegram(mails []mailStruct, perMessage int) ([]string, [][]mailStruct) {
+	msgs := make([]string, 0, len(mails)/perMessage+1)
+	covers := make([][]mailStruct, 0, len(mails)/perMessage+1)
+	var text strings.Builder
+	start := 0
+	for i, mail := range mails {
+		if i > start && (i-start == perMessage || text.Len()+1+len(mail.msg) > TELEGRAM_MAX_MESSAGE) {
+			msgs, covers = append(msgs, text.String()), append(covers, mails[start:i])
+			text.Reset()
+			start = i
+		}
+		if i > start {
+			text.WriteByte('\n')
+		}
+		text.WriteString(mail.msg)
+	}
+	if start < len(mails) {
+		msgs, covers = append(msgs, text.String()), append(covers, mails[start:])
+	}
+	return msgs, covers
+}
+
+// the reply of the Bot API, parameters.retry_after comes with a 429
+type telegramResponse struct {
+	OK          bool   `json:"ok"`
+	ErrorCode   int    `json:"error_code"`
+	Description string `json:"description"`
+	Parameters  struct {
+		RetryAfter int `json:"retry_after"`
+	} `json:"parameters"`
+}
+
+// sends a message to chat through the sendMessage method of the Bot API. When the chat
+// is over its rate limit, retryAfter is how long the API asks to wait before trying again
+func sendTelegram(chat, text string) (retryAfter time.Duration, err error) {
+	body, err := json.Marshal(map[string]any{
+		"chat_id":                  chat,
+		"text":                     text,
+		"disable_web_page_preview": true,
+	})
+	if err != nil {
+		return 0, err
+	}
+	api := strings.TrimRight(conf.Telegram.APIURL, "/")
+	if api == "" {
+		api = TELEGRAM_API_URL
+	}
+	resp, err := getHTTPClient().Post(api+"/bot"+conf.Telegram.BotToken+"/sendMessage", "application/json", bytes.NewReader(body))
+	if err != nil {
+		return 0, redactToken(err)
+	}
+	defer resp.Body.Close()
+	reply := telegramResponse{}
+	decodeErr := json.NewDecoder(resp.Body).Decode(&reply)
+	if resp.StatusCode == http.StatusTooManyRequests {
+		// a proxy in front of the Bot API may answer without a json body, the header says when to retry
+		retry := reply.Parameters.RetryAfter
+		err = fmt.Errorf("telegram: %d %s", reply.ErrorCode, reply.Description)
+		if decodeErr != nil {
+			retry, _ = strconv.Atoi(resp.Header.Get("Retry-After"))
+			err = fmt.Errorf("telegram: %s", resp.Status)
+		}
+		return time.Duration(max(retry, 1)) * time.Second, err
+	}
+	if decodeErr != nil {
+		return 0, fmt.Errorf("telegram: %s: %w", resp.Status, decodeErr)
+	}
+	if reply.OK {
+		return 0, nil
+	}
+	err = fmt.Errorf("telegram: %d %s", reply.ErrorCode, reply.Description)
+	if reply.ErrorCode == http.StatusTooManyRequests {
+		return time.Duration(max(reply.Parameters.RetryAfter, 1)) * time.Second, err
+	}
+	return 0, err
+}
+
+// the error of a failed request to the Bot API without the url of the request, which
+// holds the bot token. The error is printed and stored in the outbox, the token must not be
+func redactToken(err error) error {
+	urlErr := &url.Error{}
+	if errors.As(err, &urlErr) {
+		err = urlErr.Err
+	}
+	msg := err.Error()
+	if token := conf.Telegram.BotToken; token != "" && strings.Contains(msg, token) {
+		msg = strings.ReplaceAll(msg, token, "<bot token>")
+	}
+	return fmt.Errorf("telegram: sendMessage: %s", msg)
+}
+
+// sends msgs to the chat one after another at the rate of its token bucket and calls
+// done(i, err) once for every message. A message the API turns away for going too fast
+// is sent again once the wait it asked for is over, up to TELEGRAM_MAX_RETRIES times,
+// after that it fails and is retried by the outbox
+func deliverTelegram(chat string, msgs []string, stats *mailerStats, done func(i int, err error)) {
+	bucket := chatBucket(chat)
+	for i, msg := range msgs {
+		var err error
+		for retries := 0; ; retries++ {
+			bucket.take()
+			var retryAfter time.Duration
+			retryAfter, err = sendTelegram(chat, msg)
+			if retryAfter == 0 {
+				break
+			}
+			stats.throttled.Add(1)
+			bucket.pause(retryAfter)
+			if retries == TELEGRAM_MAX_RETRIES {
+				break
+			}
+		}
+		if err != nil {
+			stats.failed.Add(1)
+			fmt.Println("error delivering telegram message")
+			fmt.Println(err)
+		} else {
+			stats.sent.Add(1)
+		}
+		done(i, err)
+	}
+}
+
+// the notify of mode: telegram. Claims the due mails of the outbox, packs the posts into
+// messages and sends them to the channel, recording the outcome of every mail like the
+// mail backend does, until no mail is due
+func notifyTelegram() error {
+	perMessage := orDefault(conf.Telegram.PostsPerMessage, DEFAULT_TELEGRAM_POSTS)
+	chat := telegramChat()
+	stats := &mailerStats{}
+	start := time.Now()
+	posts := 0
+	for {
+		mails, err := claimMails(time.Now(), perMessage*TELEGRAM_CLAIM_MESSAGES)
+		if err != nil {
+			return err
+		}
+		if len(mails) == 0 {
+			break
+		}
+		posts += len(mails)
+		msgs, covers := packTelegram(mails, perMessage)
+		sent := make([]mailStruct, 0, len(mails))
+		failed := make([]mailStruct, 0)
+		errs := make([]error, 0)
+		deliverTelegram(chat, msgs, stats, func(i int, err error) {
+			if err == nil {
+				sent = append(sent, covers[i]...)
+				return
+			}
+			for _, mail := range covers[i] {
+				failed = append(failed, mail)
+				errs = append(errs, err)
+			}
+		})
+		if err = markMails(sent, failed, errs); err != nil {
+			fmt.Println(err)
+		}
+	}
+	if posts == 0 {
+		return nil
+	}
+	fmt.Printf("notify: %d telegram messages sent for %d posts, %d failed, %d rate limited in %s\n",
+		stats.sent.Load(), posts, stats.failed.Load(), stats.throttled.Load(), time.Since(start))
+	metrics.observeMails(stats)
+	return nil
+}
@@ -0,0 +1,452 @@
+import gzip
+import hashlib
+import threading
+import time
+from collections import Counter
+from email.utils import formatdate, parsedate_to_datetime
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class BlogFarm:
+    """A deterministic, in-process farm of fake blogs served over HTTP.
+
+    Every site lives under its own path prefix (``/s<i>/``) and looks like a
+    typical paginated blog:
+
+    * ``/s<i>/``            home page, lists the newest ``per_page`` posts
+    * ``/s<i>/page/<p>``    older listing pages, each linking to the next one
+    * ``/s<i>/posts/<j>``   the post pages themselves
+
+    With ``cyclic=True`` every post page also carries a nav bar linking back to
+    the home page plus ``fanout`` links to sibling posts, the way real blog
+    themes do, and a ``#comments`` anchor pointing back at the post itself.
+    Links are absolute unless ``relative=True``, in which case they are
+    root-relative paths the crawler has to resolve against the page URL.
+
+    The sites are spread round-robin over ``hosts`` servers, each listening on
+    its own port, so a crawler sees them as distinct hosts.  Every response is
+    held back for ``latency`` seconds, which makes concurrent requests overlap
+    long enough to be observed.
+
+    With ``feed`` set to ``'rss'`` or ``'atom'`` every site also publishes a
+    feed of all its posts at ``/s<i>/feed.xml`` and announces it on its pages
+    with ``<link rel="alternate">``.  ``'sitemap'`` publishes an unannounced
+    ``/s<i>/sitemap.xml`` instead.
+
+    Arbitrary extra documents can be published with ``add_page``.  Misbehaving
+    endpoints, one that never answers, one that trickles its body, an oversized
+    page and redirects, are published with ``add_hanging_page``,
+    ``add_slow_page``, ``add_oversized_page`` and ``add_redirect``.  With
+    ``compress=True`` responses are gzip encoded for clients that accept it.
+
+    ``articles`` maps ``(site, post)`` to the text of an article shown on that
+    post page inside ``<article>`` and, html escaped, as the description or
+    content of the post in the feed.  The same text on several posts makes
+    them mirrors of each other.  With ``noise`` set every page carries a comment
+    that changes on every request while its links stay the same.
+
+    Pages carry the validators named by ``validator`` (``'etag'``,
+    ``'last-modified'``, ``'both'`` or ``None``) and conditional requests that
+    match them are answered with ``304 Not Modified``.  ``add_posts`` publishes
+    new posts between two crawls.
+
+    ``robots`` is served as ``/robots.txt`` on every host, which answers 404
+    when it is ``None``.  With ``traps=True`` every listing page also links to
+    ``/s<i>/calendar/1``, ``/s<i>/tag/1`` and ``/s<i>/archive/1``, endless
+    chains of pages each linking to the next one, the way calendars and tag
+    clouds trap crawlers.
+
+    The farm records how often each path was requested, the response status
+    codes and the peak number of requests in flight, per host and overall, so
+    the tests can make assertions about the crawl and compute throughput
+    numbers.  Requests for ``/robots.txt`` are only counted in
+    ``robots_hits``, so they never show up in the other stats.
+    """
+
+    TRAP_KINDS = ('calendar', 'tag', 'archive')
+
+    def __init__(self, sites=1, posts=10, per_page=5, fanout=2, cyclic=False, relative=False,
+                 hosts=1, latency=0.0, validator='etag', feed=None, compress=False,
+                 robots=None, traps=False):
+        self.sites = sites
+        self.posts = posts
+        self.per_page = per_page
+        self.fanout = fanout
+        self.cyclic = cyclic
+        self.relative = relative
+        self.hosts = hosts
+        self.latency = latency
+        self.validator = validator
+        self.feed = feed
+        self.compress = compress
+        self.robots = robots
+        self.traps = traps
+        self.modified = int(time.time())
+        self.articles = {}
+        self.noise = False
+
+        self.pages = {}
+        self.handlers = {}
+
+        self.hits = Counter()
+        self.last_hit = None
+        self.status = Counter()
+        self.encodings = Counter()
+        self.bytes_sent = 0
+        self.robots_hits = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.host_in_flight = [0] * hosts
+        self.peak_host_in_flight = [0] * hosts
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._servers = []
+
+    # -- lifecycle ---------------------------------------------------------
+
+    def start(self):
+        farm = self
+
+        for host in range(self.hosts):
+            class Handler(BaseHTTPRequestHandler):
+                protocol_version = 'HTTP/1.1'
+                host_index = host
+
+                def do_GET(self):
+                    farm.handle(self, self.host_index)
+
+                def log_message(self, *args):
+                    pass
+
+            server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self._servers.append(server)
+        return self
+
+    def stop(self):
+        # let the hanging handlers go, or the servers cannot shut down
+        self._stopped.set()
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def base_url(self, site):
+        host, port = self._servers[site % self.hosts].server_address[:2]
+        return f'http://{host}:{port}'
+
+    # -- urls --------------------------------------------------------------
+
+    def site_url(self, site):
+        return f'{self.base_url(site)}/s{site}/'
+
+    def site_urls(self):
+        return [self.site_url(i) for i in range(self.sites)]
+
+    def post_url(self, site, post):
+        return f'{self.base_url(site)}/s{site}/posts/{post}'
+
+    def page_url(self, site, page):
+        if page == 1:
+            return self.site_url(site)
+        return f'{self.base_url(site)}/s{site}/page/{page}'
+
+    def trap_url(self, site, kind, n):
+        return f'{self.base_url(site)}/s{site}/{kind}/{n}'
+
+    def feed_url(self, site):
+        if self.feed in ('rss', 'atom'):
+            return f'{self.base_url(site)}/s{site}/feed.xml'
+        if self.feed == 'sitemap':
+            return f'{self.base_url(site)}/s{site}/sitemap.xml'
+        return None
+
+    def page_count(self):
+        return max(1, -(-self.posts // self.per_page))
+
+    def unique_pages(self):
+        """Number of distinct pages a complete crawl of the farm has to fetch."""
+        return self.sites * (self.page_count() + self.posts)
+
+    def add_page(self, path, body, content_type='text/html; charset=utf-8'):
+        """Serves ``body`` at ``path`` on every host and returns its URL on the first one."""
+        if isinstance(body, str):
+            body = body.encode()
+        self.pages[path] = (content_type, body)
+        return self.base_url(0) + path
+
+    def add_hanging_page(self, path):
+        """Serves ``path`` by accepting the request and never answering it."""
+        self.handlers[path] = lambda request: self._stopped.wait()
+        return self.base_url(0) + path
+
+    def add_slow_page(self, path, size, chunk=1024, delay=0.2):
+        """Serves a ``size`` bytes page at ``path`` one ``chunk`` every ``delay`` seconds."""
+        def handler(request):
+            self.send_headers(request, 200, 'text/html; charset=utf-8', size)
+            filler = b'<p>' + b'x' * (chunk - 7) + b'</p>\n'
+            for _ in range(size // chunk):
+                if self._stopped.wait(delay) or not self.write(request, filler):
+                    return
+        self.handlers[path] = handler
+        return self.base_url(0) + path
+
+    def add_oversized_page(self, path, size, chunk=64 * 1024):
+        """Serves a ``size`` bytes page at ``path``, streamed without building it in memory."""
+        def handler(request):
+            self.send_headers(request, 200, 'text/html; charset=utf-8', size)
+            filler = b'<p>' + b'x' * (chunk - 8) + b'</p>\n'
+            for _ in range(size // chunk):
+                if self._stopped.is_set() or not self.write(request, filler):
+                    return
+        self.handlers[path] = handler
+        return self.base_url(0) + path
+
+    def add_redirect(self, path, target):
+        """Redirects ``path`` to ``target``, which may well lead back to ``path``."""
+        def handler(request):
+            self.send_headers(request, 302, 'text/plain', 0, {'Location': target})
+        self.handlers[path] = handler
+        return self.base_url(0) + path
+
+    def add_posts(self, count):
+        """Publishes ``count`` new posts on every site."""
+        with self._lock:
+            self.posts += count
+            # Last-Modified has a resolution of one second
+            self.modified = max(int(time.time()), self.modified + 1)
+
+    # -- stats -------------------------------------------------------------
+
+    @property
+    def total_hits(self):
+        with self._lock:
+            return sum(self.hits.values())
+
+    def site_hits(self, site):
+        prefix = f'/s{site}/'
+        with self._lock:
+            return sum(n for path, n in self.hits.items() if path.startswith(prefix))
+
+    def duplicate_hits(self):
+        with self._lock:
+            return {path: n for path, n in self.hits.items() if n > 1}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits.clear()
+            self.last_hit = None
+            self.status.clear()
+            self.encodings.clear()
+            self.bytes_sent = 0
+            self.robots_hits = 0
+            self.peak_in_flight = 0
+            self.peak_host_in_flight = [0] * self.hosts
+
+    # -- rendering ---------------------------------------------------------
+
+    def handle(self, request, host):
+        path = request.path.split('?', 1)[0]
+        if path == '/robots.txt':
+            self.handle_robots(request)
+            return
+        with self._lock:
+            self.hits[path] += 1
+            self.last_hit = time.perf_counter()
+            self.in_flight += 1
+            self.host_in_flight[host] += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self.peak_host_in_flight[host] = max(self.peak_host_in_flight[host], self.host_in_flight[host])
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if path in self.handlers:
+                self.handlers[path](request)
+                return
+            if path in self.pages:
+                content_type, body = self.pages[path]
+                self.send(request, 200, body, content_type)
+                return
+            feed = self.render_feed(path)
+            if feed is not None:
+                self.send_page(request, feed.encode(), 'application/xml')
+                return
+            body = self.render(path)
+            if body is None:
+                self.send(request, 404, b'not found', 'text/plain')
+            else:
+                self.send_page(request, body.encode())
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.host_in_flight[host] -= 1
+
+    def handle_robots(self, request):
+        with self._lock:
+            self.robots_hits += 1
+        if self.robots is None:
+            body, status = b'not found', 404
+        else:
+            body, status = self.robots.encode(), 200
+        request.send_response(status)
+        request.send_header('Content-Type', 'text/plain')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        self.write(request, body)
+
+    def send_page(self, request, body, content_type='text/html; charset=utf-8'):
+        headers = {}
+        if self.validator in ('etag', 'both'):
+            headers['ETag'] = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+        if self.validator in ('last-modified', 'both'):
+            headers['Last-Modified'] = formatdate(self.modified, usegmt=True)
+
+        if self.not_modified(request, headers):
+            self.send(request, 304, b'', None, headers)
+        else:
+            self.send(request, 200, body, content_type, headers)
+
+    def not_modified(self, request, headers):
+        # If-None-Match takes precedence over If-Modified-Since (RFC 9110, 13.2.2)
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return 'ETag' in headers and headers['ETag'] in [t.strip() for t in if_none_match.split(',')]
+        if_modified_since = request.headers.get('If-Modified-Since')
+        if if_modified_since is not None and 'Last-Modified' in headers:
+            try:
+                return self.modified <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send(self, request, status, body, content_type, headers=None):
+        headers = dict(headers or {})
+        if self.compress and body and 'gzip' in request.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_headers(request, status, content_type, len(body), headers)
+        # count before writing, the client may be done as soon as the body is out
+        with self._lock:
+            self.bytes_sent += len(body)
+        self.write(request, body)
+
+    def send_headers(self, request, status, content_type, length, headers=None):
+        request.send_response(status)
+        if content_type is not None:
+            request.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.send_header('Content-Length', str(length))
+        request.end_headers()
+        with self._lock:
+            self.status[status] += 1
+            self.encodings[(headers or {}).get('Content-Encoding', 'identity')] += 1
+
+    def write(self, request, data):
+        """Writes part of a body, returns False once the client has gone away."""
+        try:
+            request.wfile.write(data)
+            request.wfile.flush()
+            return True
+        except (BrokenPipeError, ConnectionResetError):
+            return False
+
+    def render(self, path):
+        parts = [p for p in path.split('/') if p]
+        if not parts or not parts[0].startswith('s') or not parts[0][1:].isdigit():
+            return None
+        site = int(parts[0][1:])
+        if site >= self.sites:
+            return None
+
+        if len(parts) == 1:
+            return self.render_listing(site, 1)
+        if len(parts) == 3 and parts[1] == 'page' and parts[2].isdigit():
+            page = int(parts[2])
+            if 2 <= page <= self.page_count():
+                return self.render_listing(site, page)
+        if len(parts) == 3 and parts[1] == 'posts' and parts[2].isdigit():
+            post = int(parts[2])
+            if post < self.posts:
+                return self.render_post(site, post)
+        if len(parts) == 3 and self.traps and parts[1] in self.TRAP_KINDS and parts[2].isdigit():
+            return self.render_trap(site, parts[1], int(parts[2]))
+        return None
+
+    def render_feed(self, path):
+        parts = [p for p in path.split('/') if p]
+        if len(parts) != 2 or not parts[0].startswith('s') or not parts[0][1:].isdigit():
+            return None
+        site = int(parts[0][1:])
+        if site >= self.sites or f'{self.base_url(site)}{path}' != self.feed_url(site):
+            return None
+
+        posts = [self.post_url(site, j) for j in range(self.posts - 1, -1, -1)]
+        content = {self.post_url(site, j): escape(f'<p>{self.articles[(site, j)]}</p>')
+                   for j in range(self.posts) if (site, j) in self.articles}
+        if self.feed == 'rss':
+            items = ''.join(f'<item><title>Post {link}</title><link>{link}</link>'
+                            + (f'<description>{content[link]}</description>' if link in content else '')
+                            + '</item>\n' for link in posts)
+            return (f'<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0"><channel>'
+                    f'<title>Blog {site}</title><link>{self.site_url(site)}</link>\n{items}</channel></rss>\n')
+        if self.feed == 'atom':
+            entries = ''.join(f'<entry><title>Post {link}</title><link rel="alternate" href="{link}"/>'
+                              f'<link rel="replies" href="{link}#comments"/>'
+                              + (f'<content type="html">{content[link]}</content>' if link in content else '')
+                              + '</entry>\n' for link in posts)
+            return (f'<?xml version="1.0" encoding="UTF-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">'
+                    f'<title>Blog {site}</title><link rel="self" href="{self.feed_url(site)}"/>\n'
+                    f'{entries}</feed>\n')
+        urls = ''.join(f'<url><loc>{link}</loc></url>\n' for link in posts)
+        return (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n{urls}</urlset>\n')
+
+    def posts_on_page(self, page):
+        # posts are numbered oldest first, listings show the newest first
+        newest = self.posts - 1 - (page - 1) * self.per_page
+        return [j for j in range(newest, newest - self.per_page, -1) if j >= 0]
+
+    def render_listing(self, site, page):
+        links = [self.post_url(site, j) for j in self.posts_on_page(page)]
+        if page < self.page_count():
+            links.append(self.page_url(site, page + 1))
+        if self.cyclic:
+            links.append(self.site_url(site))
+        if self.traps:
+            links.extend(self.trap_url(site, kind, 1) for kind in self.TRAP_KINDS)
+        return self.html(site, f'Blog {site} - page {page}', links)
+
+    def render_trap(self, site, kind, n):
+        return self.html(site, f'Blog {site} - {kind} {n}', [self.trap_url(site, kind, n + 1)])
+
+    def render_post(self, site, post):
+        links = []
+        if self.cyclic:
+            links.append(self.site_url(site))
+            links.append(self.post_url(site, post) + '#comments')
+            for k in range(1, self.fanout + 1):
+                links.append(self.post_url(site, (post + k) % self.posts))
+        article = self.articles.get((site, post))
+        return self.html(site, f'Blog {site} - post {post}', links,
+                         f'<article><p>{article}</p></article>\n' if article else '')
+
+    def html(self, site, title, links, content=''):
+        if self.relative:
+            links = [link[len(self.base_url(site)):] for link in links]
+        items = '\n'.join(f'<li><a href="{link}">{link}</a></li>' for link in links)
+        head = f'<title>{title}</title>'
+        if self.feed in ('rss', 'atom'):
+            head += f'<link rel="alternate" type="application/{self.feed}+xml" href="/s{site}/feed.xml">'
+        if self.noise:
+            content += f'<!-- rendered at {time.perf_counter_ns()} -->\n'
+        return (f'<!DOCTYPE html>\n<html><head>{head}</head>\n'
+                f'<body><h1>{title}</h1>\n{content}<ul>\n{items}\n</ul></body></html>\n')
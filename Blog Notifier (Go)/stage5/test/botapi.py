@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class BotAPI:
+    """A local HTTP stand-in for the Telegram Bot API.
+
+    ``sendMessage`` is accepted at ``rate`` messages per second per chat with
+    bursts of ``burst``, a message over that limit is answered with a 429 and
+    ``retry_after`` the way Telegram does and counted in ``throttled``.  The
+    accepted messages are kept along with their arrival time, which gives the
+    delivery throughput.
+    """
+
+    def __init__(self, token='abcd1234', rate=20.0, burst=5, retry_after=1):
+        self.token = token
+        self.rate = rate
+        self.burst = burst
+        self.retry_after = retry_after
+        self.messages = []
+        self.throttled = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path != f'/bot{api.token}/sendMessage':
+                    return self.reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                try:
+                    request = json.loads(body)
+                except ValueError:
+                    return self.reply(400, {'ok': False, 'error_code': 400, 'description': 'Bad Request'})
+                if not api.admit(request.get('chat_id')):
+                    return self.reply(429, {'ok': False, 'error_code': 429,
+                                            'description': f'Too Many Requests: retry after {api.retry_after}',
+                                            'parameters': {'retry_after': api.retry_after}})
+                with api._lock:
+                    api.messages.append({'chat': request.get('chat_id'), 'text': request.get('text', ''),
+                                         'time': time.perf_counter()})
+                    message_id = len(api.messages)
+                self.reply(200, {'ok': True, 'result': {'message_id': message_id}})
+
+            def reply(self, status, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def admit(self, chat):
+        """Takes a token from the bucket of ``chat``, False when it is empty."""
+        now = time.perf_counter()
+        with self._lock:
+            tokens, last = self._buckets.get(chat, (self.burst, now))
+            tokens = min(tokens + (now - last) * self.rate, self.burst)
+            if tokens < 1:
+                self._buckets[chat] = (tokens, now)
+                self.throttled += 1
+                return False
+            self._buckets[chat] = (tokens - 1, now)
+            return True
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def texts(self):
+        with self._lock:
+            return [message['text'] for message in self.messages]
+
+    def throughput(self):
+        """Messages per second between the first and the last accepted message."""
+        with self._lock:
+            if len(self.messages) < 2:
+                return 0.0
+            span = self.messages[-1]['time'] - self.messages[0]['time']
+            return round((len(self.messages) - 1) / span, 2) if span else 0.0
@@ -0,0 +1,95 @@
+"""Fixture pages for comparing the crawler's link extraction with BeautifulSoup.
+
+Every page exercises markup the crawler meets on real blogs.  Pages whose
+links both parsers must agree on are in ``HTML_PAGES``; ``NON_HTML_PAGES``
+contain anchors too but are served with a content type the crawler must not
+parse at all.
+"""
+
+import random
+
+from bs4 import BeautifulSoup
+
+HTML_PAGES = {
+    'plain.html': '''<!DOCTYPE html>
+<html><head><title>Plain</title></head>
+<body><a href="/posts/1">one</a> <a href="/posts/2">two</a> <a href="https://other.example.com/">out</a></body></html>
+''',
+    'case_and_quotes.html': '''<HTML><BODY>
+<A HREF="/upper">upper</A>
+<a href=/unquoted class=post>unquoted</a>
+<a href='/single'>single quotes</a>
+<a   data-x="1"   href = "/spaced" >spaced attribute</a>
+</BODY></HTML>
+''',
+    'entities.html': '''<html><body>
+<a href="/search?q=go&amp;page=2">amp</a>
+<a href="/caf&#233;">numeric</a>
+<a href="/a&quot;b">quote</a>
+<a href="">empty</a>
+<a name="top">no href</a>
+</body></html>
+''',
+    'scripts_and_comments.html': '''<html><head>
+<script>var s = '<a href="/in-script">x</a>';</script>
+<style>a[href="/in-style"] { color: red }</style>
+</head><body>
+<!-- <a href="/in-comment">hidden</a> -->
+<a href="/visible">visible</a>
+</body></html>
+''',
+    'nested_and_broken.html': '''<html><body>
+<div><p><a href="/unclosed">unclosed
+<p><a href="/in-paragraph"><span><a href="/nested">nested</a></span></a>
+<a href="/self-closing"/>
+<li><a href="/li-1">1</a><li><a href="/li-2">2</a>
+<table><tr><td><a href="/cell">cell</a></table>
+</body></html>
+''',
+    'fragments.html': '''<html><body>
+<a href="#comments">comments</a> <a href="/post#top">post</a> <a href="?page=3">page 3</a>
+<a href="mailto:someone@example.com">mail</a> <a href="javascript:void(0)">js</a>
+</body></html>
+''',
+}
+
+NON_HTML_PAGES = {
+    'feed.xml': ('application/rss+xml', '<rss><channel><item><link>/x</link>'
+                                        '<description>&lt;a href="/rss"&gt;</description>'
+                                        '<a href="/rss-anchor">x</a></item></channel></rss>'),
+    'data.json': ('application/json', '{"html": "<a href=\\"/json\\">x</a>"}'),
+    'image.png': ('image/png', '<a href="/png">x</a>'),
+}
+
+
+def archive_page(posts):
+    """A long archive page, the kind of page the crawler spends most of its time on."""
+    items = ''.join(f'<li class="post"><a href="/posts/{i}" title="Post {i}">Post {i}</a>'
+                    f'<p>A short summary of post {i}, with <em>some</em> markup.</p></li>\n'
+                    for i in range(posts))
+    return f'<!DOCTYPE html><html><head><title>Archive</title></head><body><ul>\n{items}</ul></body></html>'
+
+
+_WORDS = ('crawler feed post blog index query cache latency server client router packet schema commit branch '
+          'merge thread lock queue batch stream buffer socket parser token syntax vector matrix kernel driver '
+          'module package release version deploy cluster replica shard lease quorum leader follower snapshot '
+          'journal ledger').split()
+
+
+def article_text(seed, words=150):
+    """The text of an article, the same ``seed`` always gives the same text."""
+    rng = random.Random(seed)
+    return ' '.join(rng.choice(_WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def with_unclosed_anchor(text, word=10):
+    """``text`` with an ``<a>`` opened before its ``word``-th word and never closed, as careless markup has it."""
+    words = text.split(' ')
+    words[word] = f'<a href="#ref-{word}">{words[word]}'
+    return ' '.join(words)
+
+
+def reference_links(page):
+    """The hrefs of all <a> tags in document order, as extracted by BeautifulSoup."""
+    soup = BeautifulSoup(page, 'html.parser')
+    return [a['href'] for a in soup.find_all('a') if a.has_attr('href')]
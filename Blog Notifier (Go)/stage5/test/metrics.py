@@ -0,0 +1,152 @@
+import json
+import os
+import re
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+_SAMPLE = re.compile(r'^blognotifier_(\w+?)(?:\{(.*)\})? (\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+class MetricsError(ValueError):
+    pass
+
+
+def _unescape(value):
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+
+
+def parse_json_metrics(output):
+    """Reads the report printed by ``--metrics json``, the last line of JSON in ``output``."""
+    for line in reversed(output.splitlines()):
+        if line.startswith('{'):
+            try:
+                return json.loads(line)
+            except json.JSONDecodeError as err:
+                raise MetricsError(f'the metrics are not valid JSON: {err}') from err
+    raise MetricsError('no JSON metrics found in the output')
+
+
+def parse_prometheus_metrics(output):
+    """Reads the report printed by ``--metrics prometheus`` into the layout of the JSON report."""
+    report = {'phase_seconds': {}, 'mails': {}, 'sites': {}}
+    histograms = {}
+
+    def site(labels):
+        return report['sites'].setdefault(labels['site'], {})
+
+    for line in output.splitlines():
+        match = _SAMPLE.match(line)
+        if match is None:
+            continue
+        name, labels, value = match.groups()
+        labels = {key: _unescape(val) for key, val in _LABEL.findall(labels or '')}
+        value = float(value)
+        if name == 'wall_seconds':
+            report['wall_seconds'] = value
+        elif name == 'phase_seconds':
+            report['phase_seconds'][labels['phase']] = value
+        elif name == 'db_write_seconds_total':
+            report['db_write_seconds'] = value
+        elif name == 'db_writes_total':
+            report['db_writes'] = int(value)
+        elif name in ('mails_sent_total', 'mails_failed_total'):
+            report['mails'][name.split('_')[1]] = int(value)
+        elif name == 'smtp_connections_total':
+            report['mails']['connections'] = int(value)
+        elif name in ('fetches_total', 'not_modified_total', 'fetch_bytes_total', 'links_unchanged_total'):
+            key = {'fetches_total': 'fetches', 'not_modified_total': 'not_modified',
+                   'fetch_bytes_total': 'bytes', 'links_unchanged_total': 'links_unchanged'}[name]
+            site(labels)[key] = int(value)
+        elif name == 'fetch_errors_total':
+            site(labels)['errors'] = int(value)
+        elif name in ('read_seconds_total', 'parse_seconds_total'):
+            site(labels)[name[:-len('_total')]] = value
+        elif name.startswith('fetch_latency_seconds_'):
+            histogram = histograms.setdefault(labels['site'], {'buckets': [], 'counts': []})
+            if name.endswith('_bucket'):
+                if labels['le'] != '+Inf':
+                    histogram['buckets'].append(float(labels['le']))
+                histogram['counts'].append(int(value))
+            elif name.endswith('_sum'):
+                histogram['sum'] = value
+            elif name.endswith('_count'):
+                histogram['count'] = int(value)
+    if 'wall_seconds' not in report:
+        raise MetricsError('no Prometheus metrics found in the output')
+    for url, histogram in histograms.items():
+        report['sites'].setdefault(url, {})['latency_seconds'] = histogram
+    return report
+
+
+def parse_metrics(output, fmt):
+    if fmt == 'json':
+        return parse_json_metrics(output)
+    return parse_prometheus_metrics(output)
+
+
+def validate_metrics(report):
+    """Checks that a report is complete and consistent with itself, raises MetricsError if not."""
+    for key in ('wall_seconds', 'phase_seconds', 'db_write_seconds', 'db_writes', 'mails', 'sites'):
+        if key not in report:
+            raise MetricsError(f'the metrics have no {key}')
+    for phase in ('crawl', 'store', 'notify'):
+        if phase not in report['phase_seconds']:
+            raise MetricsError(f'the metrics have no timing of the {phase} phase')
+    # the phases run concurrently, only each of them on its own fits in the run
+    for phase, seconds in report['phase_seconds'].items():
+        if not 0 <= seconds <= report['wall_seconds']:
+            raise MetricsError(f'the {phase} phase took {seconds}s, longer than the whole run')
+    if not 0 <= report['db_write_seconds'] <= report['wall_seconds']:
+        raise MetricsError(f"db_write_seconds {report['db_write_seconds']} is not within the wall time of the run")
+    for url, site in report['sites'].items():
+        for key in ('fetches', 'not_modified', 'errors', 'bytes', 'read_seconds', 'parse_seconds',
+                    'latency_seconds'):
+            if key not in site:
+                raise MetricsError(f'the metrics of {url} have no {key}')
+        histogram = site['latency_seconds']
+        counts = histogram['counts']
+        if len(counts) != len(histogram['buckets']) + 1 or histogram['buckets'] != sorted(histogram['buckets']):
+            raise MetricsError(f'the latency histogram of {url} has inconsistent buckets')
+        if counts != sorted(counts) or counts[-1] != histogram['count']:
+            raise MetricsError(f'the latency bucket counts of {url} are not cumulative')
+        if histogram['count'] > site['fetches']:
+            raise MetricsError(f'{url} has more latency observations than fetches')
+
+
+def load_baseline(name):
+    with open(BASELINES_FILE) as file:
+        return json.load(file)[name]
+
+
+def save_baseline(name, baseline):
+    with open(BASELINES_FILE) as file:
+        baselines = json.load(file)
+    baselines[name] = baseline
+    with open(BASELINES_FILE, 'w') as file:
+        json.dump(baselines, file, indent=2, sort_keys=True)
+        file.write('\n')
+
+
+def compare_to_baseline(name, counts, seconds, tolerance=None):
+    """Compares a run against the stored baseline ``name`` and returns the regressions found.
+
+    Counts have to match exactly, timings may exceed the baseline by ``tolerance``
+    (a fraction, $BLOG_NOTIFIER_PERF_TOLERANCE or 1.0 by default).  With
+    $BLOG_NOTIFIER_RECORD_BASELINES set the run becomes the new baseline instead.
+    """
+    if os.environ.get('BLOG_NOTIFIER_RECORD_BASELINES'):
+        save_baseline(name, {'counts': counts, 'seconds': {k: round(v, 4) for k, v in seconds.items()}})
+        return []
+    if tolerance is None:
+        tolerance = float(os.environ.get('BLOG_NOTIFIER_PERF_TOLERANCE', '1.0'))
+    baseline = load_baseline(name)
+    regressions = []
+    for key, expected in baseline['counts'].items():
+        if counts.get(key) != expected:
+            regressions.append(f'{key} is {counts.get(key)}, the baseline is {expected}')
+    for key, expected in baseline['seconds'].items():
+        if seconds.get(key, 0) > expected * (1 + tolerance):
+            regressions.append(f'{key} took {seconds[key]:.3f}s, the baseline is {expected}s '
+                               f'(+{tolerance:.0%} allowed)')
+    return regressions
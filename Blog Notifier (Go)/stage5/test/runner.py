@@ -0,0 +1,234 @@
+import fcntl
+import functools
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+
+import hstest
+
+STAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def source_hash(stage_dir=STAGE_DIR):
+    """Hashes everything ``go build`` reads, the Go sources and the module files."""
+    digest = hashlib.sha256()
+    paths = sorted(glob.glob(os.path.join(stage_dir, '*.go')))
+    paths += [os.path.join(stage_dir, name) for name in ('go.mod', 'go.sum')]
+    for path in paths:
+        if path.endswith('_test.go') or not os.path.exists(path):
+            continue
+        digest.update(os.path.basename(path).encode() + b'\0')
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def build_binary(stage_dir=STAGE_DIR):
+    """Builds the blog notifier once per source hash and returns the path of the binary.
+
+    Binaries are kept in $BLOG_NOTIFIER_BUILD_CACHE, a directory under the
+    system temp dir by default, so every test and every parallel test process
+    of the same sources shares a single build.  They are built with the FTS5
+    extension of SQLite, which the full-text index of the posts needs.
+    """
+    cache = os.environ.get('BLOG_NOTIFIER_BUILD_CACHE') or os.path.join(tempfile.gettempdir(),
+                                                                        'blognotifier-builds')
+    key = source_hash(stage_dir)
+    binary = os.path.join(cache, key, 'blognotifier')
+    if os.path.exists(binary):
+        return binary
+    os.makedirs(os.path.dirname(binary), exist_ok=True)
+    with open(os.path.join(cache, key + '.lock'), 'w') as lock:
+        # the processes that wait here find the binary built by the first one
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(binary):
+            partial = binary + '.partial'
+            subprocess.run(['go', 'build', '-tags', 'sqlite_fts5', '-o', partial, '.'],
+                           cwd=stage_dir, check=True, capture_output=True)
+            os.replace(partial, binary)
+    return binary
+
+
+def dynamic_test(func=None, **kwargs):
+    """``hstest.dynamic_test`` with test selection and timings for run_stage_tests.py.
+
+    Only the tests named in $BLOG_NOTIFIER_TESTS (comma separated) are
+    registered with hstest, the others are left out of the run altogether,
+    which lets the parallel runner hand every test to a process of its own.
+    With $BLOG_NOTIFIER_TIMINGS_FILE set the duration and outcome of every test
+    are appended to it as JSON lines, a selected test missing there did not run.
+    """
+    if func is None:
+        return lambda method: _register(method, kwargs)
+    return _register(func, {})
+
+
+def _register(method, kwargs):
+    selected = os.environ.get('BLOG_NOTIFIER_TESTS')
+    if selected and method.__name__ not in selected.split(','):
+        return method
+    return hstest.dynamic_test(_timed(method), **kwargs)
+
+
+def _timed(method):
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        start = time.perf_counter()
+        passed = False
+        try:
+            result = method(self, *args)
+            passed = getattr(result, 'is_correct', True)
+            return result
+        finally:
+            _record_timing(method.__name__, args, time.perf_counter() - start, passed)
+    return wrapper
+
+
+def _record_timing(test, args, seconds, passed):
+    timings_file = os.environ.get('BLOG_NOTIFIER_TIMINGS_FILE')
+    if not timings_file:
+        return
+    timing = {'test': test, 'data': [str(arg) for arg in args], 'seconds': round(seconds, 4), 'passed': passed}
+    with open(timings_file, 'a') as file:
+        file.write(json.dumps(timing) + '\n')
+
+
+ARCHIVE_TOPICS = ['Rust', 'Python', 'Databases', 'Crawlers', 'Compilers', 'Networking', 'Testing']
+
+
+class RunResult:
+    def __init__(self, returncode, output, wall_time, max_rss_kb):
+        self.returncode = returncode
+        self.output = output
+        self.wall_time = wall_time
+        self.max_rss_kb = max_rss_kb
+
+
+class BlogNotifierCLI:
+    """Builds the blog notifier binary and runs it inside a scratch directory.
+
+    The stage tests drive the program through ``TestedProgram``, which gives no
+    access to the process itself.  The benchmarks need wall time and peak RSS
+    of a single invocation, so they run the compiled binary directly instead.
+    Every instance gets its own working directory, and with it its own
+    ``blogs.sqlite3``, the binary is shared through ``build_binary``.
+    """
+
+    def __init__(self):
+        self.binary = build_binary()
+        self.work_dir = tempfile.mkdtemp(prefix='blognotifier-work-')
+
+    def cleanup(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+    def write_file(self, name, content):
+        path = os.path.join(self.work_dir, name)
+        with open(path, 'w') as file:
+            file.write(content)
+        return path
+
+    def run(self, *args, timeout=120):
+        """Runs the binary to completion and returns its output and resource usage."""
+        with tempfile.TemporaryFile() as out:
+            start = time.perf_counter()
+            proc = subprocess.Popen([self.binary, *args], cwd=self.work_dir,
+                                    stdout=out, stderr=subprocess.STDOUT)
+            timer = threading.Timer(timeout, proc.kill)
+            timer.start()
+            try:
+                # wait4 reaps the child and hands back its own rusage, unlike
+                # RUSAGE_CHILDREN which is the maximum over all children so far
+                _, status, usage = os.wait4(proc.pid, 0)
+            finally:
+                timer.cancel()
+            wall_time = time.perf_counter() - start
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            out.seek(0)
+            output = out.read().decode(errors='replace')
+        return RunResult(proc.returncode, output, wall_time, usage.ru_maxrss)
+
+    def start(self, *args):
+        """Starts the binary without waiting for it, its output is read from ``stdout``."""
+        return subprocess.Popen([self.binary, *args], cwd=self.work_dir, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, text=True, errors='replace')
+
+    def seed_sites(self, urls):
+        self.run('--migrate')
+        for url in urls:
+            self.run('--explore', url)
+
+    @property
+    def db_path(self):
+        return os.path.join(self.work_dir, 'blogs.sqlite3')
+
+    def query(self, sql, *args):
+        with sqlite3.connect(self.db_path) as db:
+            return db.execute(sql, args).fetchall()
+
+    def seed_posts(self, site, links):
+        """Stores ``links`` as already known posts of ``site``."""
+        with sqlite3.connect(self.db_path) as db:
+            db.execute('INSERT OR IGNORE INTO blogs (site, last_link) VALUES (?, ?)', (site, site))
+            db.executemany('INSERT INTO posts (site, link) VALUES (?, ?)', ((site, link) for link in links))
+
+    def seed_archive(self, sites, per_site, newest):
+        """Fills the database with ``per_site`` posts for each of ``sites`` blogs in one statement.
+
+        Post ``i`` of blog ``s`` is ``http://blogSSSS.example/post/IIIII``, was
+        discovered ``i`` hours and ``s`` milliseconds before ``newest`` (unix
+        milliseconds) and is titled after one of ``ARCHIVE_TOPICS``, except for
+        every thousandth post, which is about zeppelins.  The rows are generated
+        by SQLite itself, Python would take minutes for millions of them.
+        """
+        params = {'sites': sites, 'per_site': per_site, 'newest': newest,
+                  'topics': json.dumps(ARCHIVE_TOPICS), 'n_topics': len(ARCHIVE_TOPICS)}
+        with sqlite3.connect(self.db_path) as db:
+            db.execute("""WITH RECURSIVE n(s) AS (SELECT 0 UNION ALL SELECT s + 1 FROM n WHERE s + 1 < :sites)
+                          INSERT INTO blogs (site, last_link) SELECT printf('http://blog%04d.example/', s), '' FROM n""",
+                       params)
+            db.execute("""WITH RECURSIVE n(k) AS (SELECT 0 UNION ALL SELECT k + 1 FROM n WHERE k + 1 < :sites * :per_site)
+                          INSERT INTO posts (site, link, title, discovered_at)
+                          SELECT printf('http://blog%04d.example/', k / :per_site),
+                                 printf('http://blog%04d.example/post/%05d', k / :per_site, k % :per_site),
+                                 CASE WHEN k % 1000 = 7 THEN printf('Zeppelin notes %d', k % :per_site)
+                                      ELSE printf('%s notes %d', json_extract(:topics, printf('$[%d]', k % :n_topics)),
+                                                  k % :per_site) END,
+                                 :newest - (k % :per_site) * 3600000 - k / :per_site
+                          FROM n""", params)
+
+    def seed_history(self, site, count):
+        """Fills the database with ``count`` already known posts of ``site``."""
+        self.seed_posts(site, (f'{site}archive/{i}' for i in range(count)))
+
+
+
+def record_benchmark(name, result, pages, **extra):
+    """Prints a benchmark summary and appends it to $BLOG_NOTIFIER_BENCH_FILE if set."""
+    stats = {
+        'benchmark': name,
+        'pages': pages,
+        'wall_time_s': round(result.wall_time, 4),
+        'pages_per_s': round(pages / result.wall_time, 2) if result.wall_time else 0.0,
+        'max_rss_kb': result.max_rss_kb,
+        **extra,
+    }
+    print(json.dumps(stats))
+    bench_file = os.environ.get('BLOG_NOTIFIER_BENCH_FILE')
+    if bench_file:
+        with open(bench_file, 'a') as file:
+            file.write(json.dumps(stats) + '\n')
+    return stats
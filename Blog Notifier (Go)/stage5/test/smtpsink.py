@@ -0,0 +1,73 @@
+import socket
+import threading
+import time
+
+from aiosmtpd.controller import Controller
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class SMTPSink:
+    """A local SMTP server standing in for the mail relay of the config file.
+
+    Every accepted message is kept along with its arrival time and the peer
+    address of the connection it came over, which is enough to count both the
+    messages and the SMTP connections used to deliver them.
+
+    The first ``reject`` messages are refused with a transient 451 error, the
+    way a flaky relay would, and kept in ``rejected`` instead.
+    """
+
+    def __init__(self, reject=0):
+        self.port = free_port()
+        self.messages = []
+        self.rejected = []
+        self.reject = reject
+        self._lock = threading.Lock()
+        self._controller = Controller(self, hostname='127.0.0.1', port=self.port)
+
+    def start(self):
+        self._controller.start()
+        return self
+
+    def stop(self):
+        self._controller.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    async def handle_DATA(self, server, session, envelope):
+        message = {
+            'peer': session.peer,
+            'time': time.perf_counter(),
+            'from': envelope.mail_from,
+            'to': list(envelope.rcpt_tos),
+            'content': envelope.content.decode('utf8', errors='replace'),
+        }
+        with self._lock:
+            if len(self.rejected) < self.reject:
+                self.rejected.append(message)
+                return '451 Requested action aborted: try again later'
+            self.messages.append(message)
+        return '250 Message accepted for delivery'
+
+    @property
+    def connections(self):
+        with self._lock:
+            return len({message['peer'] for message in self.messages})
+
+    def contents(self):
+        with self._lock:
+            return [message['content'] for message in self.messages]
+
+    def reset(self):
+        with self._lock:
+            self.messages.clear()
+            self.rejected.clear()
@@ -1,8 +1,54 @@
-# TODO -- WE NEED TO ADD THE CORRECT TESTS FOR STAGE 5
+"""Tests of the stage 5 blog notifier.
 
+The first tests check the config file and the command line through
+``TestedProgram``.  The others run the compiled binary through
+``BlogNotifierCLI`` against fixture servers, the blog farm, an SMTP sink and a
+fake Telegram Bot API, and check what it crawls, stores and delivers.  Those
+that measure throughput record their numbers with ``record_benchmark``.
+"""
+
+import json
 import os
+import re
+import sqlite3
+import statistics
+import subprocess
+import threading
+import time
+
+from hstest import StageTest, TestedProgram, CheckResult, WrongAnswer
+
+from test.blogfarm import BlogFarm
+from test.botapi import BotAPI
+from test.corpus import HTML_PAGES, NON_HTML_PAGES, archive_page, article_text, reference_links, with_unclosed_anchor
+from test.metrics import MetricsError, compare_to_baseline, parse_metrics, validate_metrics
+from test.runner import STAGE_DIR, BlogNotifierCLI, RunResult, dynamic_test, record_benchmark
+from test.smtpsink import SMTPSink
+
+SYNC_CONFIG = ("mode: {mode}\n"
+               "server:\n"
+               "  host: 127.0.0.1\n"
+               "  port: {smtp_port}\n"
+               "{server}"
+               "client:\n"
+               "  email: sender@example.com\n"
+               "  password: secret\n"
+               "  send_to: recipient@example.net\n"
+               "{client}"
+               "telegram:\n"
+               "  bot_token: abcd1234\n"
+               "  channel: mychannel\n"
+               "{telegram}")
 
-from hstest import StageTest, TestedProgram, CheckResult, dynamic_test
+
+def sync_config(smtp_port=1, server='', client='', sections='', mode='mail', telegram=''):
+    """Config for sync runs, nothing listens on the default SMTP port 1 so mail delivery fails fast.
+
+    ``server``, ``client`` and ``telegram`` are extra indented lines for those
+    sections, ``sections`` are extra top level sections such as ``crawler``.
+    """
+    return SYNC_CONFIG.format(mode=mode, smtp_port=smtp_port, server=server, client=client,
+                              telegram=telegram) + sections
 
 
 class TestBlogNotifierCLI(StageTest):
@@ -112,6 +158,1221 @@ class TestBlogNotifierCLI(StageTest):
                 f"\nExpected output: {expected_error}")
         return CheckResult.correct()
 
+    @dynamic_test(time_limit=180000)
+    def test5_crawl_benchmark(self):
+        with BlogFarm(sites=5, posts=40, per_page=10) as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            result = cli.run('--crawl')
+            if result.returncode != 0:
+                return CheckResult.wrong(f"--crawl failed against the fixture blog farm:\n{result.output}")
+            if farm.total_hits < farm.unique_pages():
+                return CheckResult.wrong(
+                    f"--crawl fetched {farm.total_hits} pages, "
+                    f"but the fixture blog farm has {farm.unique_pages()} pages.")
+            record_benchmark('crawl', result, farm.total_hits)
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test6_sync_benchmark(self):
+        with BlogFarm(sites=5, posts=40, per_page=10) as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            cli.write_file('credentials.yaml', sync_config())
+            result = cli.run('sync', '--conf', 'credentials.yaml')
+            if result.returncode != 0:
+                return CheckResult.wrong(f"sync --conf failed against the fixture blog farm:\n{result.output}")
+            record_benchmark('sync', result, farm.total_hits)
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test7_cyclic_links_fetched_once(self):
+        with BlogFarm(sites=3, posts=30, per_page=8, fanout=3, cyclic=True, relative=True) as farm, \
+                BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            result = cli.run('--crawl', timeout=60)
+            if result.returncode != 0:
+                return CheckResult.wrong(f"--crawl failed against a blog farm with cyclic links:\n{result.output}")
+            duplicates = farm.duplicate_hits()
+            if duplicates:
+                return CheckResult.wrong(f"Every page should be fetched exactly once, refetched pages: {duplicates}")
+            if farm.total_hits != farm.unique_pages():
+                return CheckResult.wrong(
+                    f"--crawl fetched {farm.total_hits} pages, "
+                    f"but the fixture blog farm has {farm.unique_pages()} reachable pages.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test8_crawl_max_pages(self):
+        with BlogFarm(sites=2, posts=50, per_page=10, cyclic=True) as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            cli.write_file('credentials.yaml', sync_config(sections=
+                           "crawler:\n"
+                           "  max_depth: 10\n"
+                           "  max_pages: 7\n"))
+            result = cli.run('sync', '--conf', 'credentials.yaml', timeout=60)
+            if result.returncode != 0:
+                return CheckResult.wrong(f"sync --conf failed against the fixture blog farm:\n{result.output}")
+            for site in range(farm.sites):
+                if farm.site_hits(site) > 7:
+                    return CheckResult.wrong(
+                        f"crawler.max_pages is 7, but {farm.site_hits(site)} pages of {farm.site_url(site)} were fetched.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test9_crawl_concurrency_caps(self):
+        with BlogFarm(sites=12, posts=6, per_page=3, hosts=4, latency=0.02) as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            cli.write_file('credentials.yaml', sync_config(sections=
+                           "crawler:\n"
+                           "  workers: 3\n"
+                           "  per_host: 1\n"
+                           "  delay: 5ms\n"))
+            result = cli.run('sync', '--conf', 'credentials.yaml', timeout=60)
+            if result.returncode != 0:
+                return CheckResult.wrong(f"sync --conf failed against the fixture blog farm:\n{result.output}")
+            if farm.peak_in_flight > 3:
+                return CheckResult.wrong(
+                    f"crawler.workers is 3, but {farm.peak_in_flight} requests were in flight at the same time.")
+            for host, peak in enumerate(farm.peak_host_in_flight):
+                if peak > 1:
+                    return CheckResult.wrong(
+                        f"crawler.per_host is 1, but host #{host} served {peak} requests at the same time.")
+            if farm.total_hits < farm.unique_pages():
+                return CheckResult.wrong(
+                    f"sync fetched {farm.total_hits} pages, "
+                    f"but the fixture blog farm has {farm.unique_pages()} pages.")
+            if 'crawl pool:' not in result.output:
+                return CheckResult.wrong("sync should report the crawl pool counters.")
+        return CheckResult.correct()
+
+    def sync_twice(self, farm, cli):
+        cli.seed_sites(farm.site_urls())
+        cli.write_file('credentials.yaml', sync_config())
+        runs = []
+        for _ in range(2):
+            farm.reset_stats()
+            result = cli.run('sync', '--conf', 'credentials.yaml', timeout=60)
+            if result.returncode != 0:
+                raise WrongAnswer(f"sync --conf failed against the fixture blog farm:\n{result.output}")
+            runs.append((farm.status[200], farm.status[304]))
+        return runs
+
+    @dynamic_test(time_limit=180000, data=['etag', 'last-modified', 'both', 'none'])
+    def test10_conditional_fetching(self, validator):
+        validator = None if validator == 'none' else validator
+        with BlogFarm(sites=3, posts=20, per_page=5, validator=validator) as farm, BlogNotifierCLI() as cli:
+            (first_200, _), (second_200, second_304) = self.sync_twice(farm, cli)
+            if first_200 != farm.unique_pages():
+                return CheckResult.wrong(
+                    f"The first sync should fetch all {farm.unique_pages()} pages, it got {first_200} responses.")
+            if validator is None:
+                # without validators the home pages come back in full, but their hash did not change
+                expected = (farm.sites, 0)
+            else:
+                expected = (0, farm.sites)
+            if (second_200, second_304) != expected:
+                return CheckResult.wrong(
+                    f"With validator {validator}, a sync of an unchanged farm should get {expected[0]} 200 and "
+                    f"{expected[1]} 304 responses, it got {second_200} and {second_304}.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=600000)
+    def test11_large_ingest_benchmark(self):
+        posts = 100000
+        with BlogFarm(sites=1, posts=posts, per_page=posts) as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            cli.seed_history('https://history.example.com/', posts)
+            # a single archive page links to every post, fetch only that one
+            cli.write_file('credentials.yaml', sync_config(sections=
+                           "crawler:\n"
+                           "  max_pages: 1\n"))
+            result = cli.run('sync', '--conf', 'credentials.yaml', timeout=540)
+            if result.returncode != 0:
+                return CheckResult.wrong(f"sync --conf failed to ingest a large blog:\n{result.output}")
+            (stored,), = cli.query('SELECT COUNT(*) FROM posts WHERE site = ?', farm.site_url(0))
+            (queued,), = cli.query('SELECT COUNT(*) FROM mails')
+            if stored != posts or queued != posts:
+                return CheckResult.wrong(
+                    f"sync should store {posts} posts and queue a mail for each, "
+                    f"it stored {stored} posts and {queued} mails.")
+            (journal,), = cli.query('PRAGMA journal_mode')
+            if journal.lower() != 'wal':
+                return CheckResult.wrong(f"blogs.sqlite3 should use the WAL journal, it uses {journal}.")
+            record_benchmark('large_ingest', result, posts)
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test12_migrate_dedups_posts(self):
+        with BlogNotifierCLI() as cli:
+            # the schema as created by --migrate before posts had a unique index
+            with sqlite3.connect(cli.db_path) as db:
+                db.execute('CREATE TABLE blogs (site VARCHAR(256) PRIMARY KEY, last_link VARCHAR(256))')
+                db.execute('CREATE TABLE posts (site VARCHAR(256), link VARCHAR(256), '
+                           'FOREIGN KEY (site) REFERENCES blogs(site) ON DELETE CASCADE)')
+                db.execute("INSERT INTO blogs VALUES ('https://a.example.com/', 'https://a.example.com/')")
+                db.executemany('INSERT INTO posts VALUES (?, ?)',
+                               [('https://a.example.com/', f'https://a.example.com/{i % 10}') for i in range(50)])
+            result = cli.run('--migrate')
+            if result.returncode != 0:
+                return CheckResult.wrong(f"--migrate failed on a database with duplicate posts:\n{result.output}")
+            (count,), = cli.query('SELECT COUNT(*) FROM posts')
+            if count != 10:
+                return CheckResult.wrong(f"--migrate should keep one copy of each of the 10 posts, {count} are left.")
+            indexes = cli.query("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'posts'")
+            if ('posts_site_link',) not in indexes:
+                return CheckResult.wrong("--migrate should create the unique index posts_site_link on posts.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=600000)
+    def test13_sync_time_independent_of_history(self):
+        timings = []
+        for history in (0, 500000):
+            with BlogFarm(sites=1, posts=20000, per_page=20000) as farm, BlogNotifierCLI() as cli:
+                cli.seed_sites(farm.site_urls())
+                cli.seed_history('https://history.example.com/', history)
+                # every post is already known, the sync is pure new-post detection
+                cli.seed_posts(farm.site_url(0), (farm.post_url(0, j) for j in range(farm.posts)))
+                cli.write_file('credentials.yaml', sync_config(sections=
+                               "crawler:\n"
+                               "  max_pages: 1\n"))
+                result = cli.run('sync', '--conf', 'credentials.yaml', timeout=240)
+                if result.returncode != 0:
+                    return CheckResult.wrong(f"sync --conf failed:\n{result.output}")
+                timings.append(record_benchmark(f'sync_history_{history}', result, farm.posts)['wall_time_s'])
+        if timings[1] > 5 * max(timings[0], 0.2):
+            return CheckResult.wrong(
+                f"Detecting new posts should not slow down with the size of the posts table: "
+                f"sync took {timings[0]}s with an empty history and {timings[1]}s with 500000 stored posts.")
+        return CheckResult.correct()
+
+    def sync_with_smtp(self, farm, cli, sink, server='', client=''):
+        cli.seed_sites(farm.site_urls())
+        cli.write_file('credentials.yaml', sync_config(sink.port, server=server, client=client))
+        start = time.perf_counter()
+        result = cli.run('sync', '--conf', 'credentials.yaml', timeout=60)
+        if result.returncode != 0:
+            raise WrongAnswer(f"sync --conf failed:\n{result.output}")
+        latencies = [message['time'] - start for message in sink.messages]
+        return result, latencies
+
+    @dynamic_test(time_limit=180000)
+    def test14_smtp_sessions_are_reused(self):
+        with BlogFarm(sites=2, posts=30, per_page=10) as farm, SMTPSink() as sink, BlogNotifierCLI() as cli:
+            result, latencies = self.sync_with_smtp(farm, cli, sink, server="  connections: 2\n"
+                                                                            "  messages_per_connection: 50\n")
+            new_posts = farm.unique_pages() - farm.sites
+            if len(sink.messages) != new_posts:
+                return CheckResult.wrong(f"sync should send one mail per each of the {new_posts} new posts, "
+                                         f"the SMTP server received {len(sink.messages)}.")
+            if sink.connections > 2:
+                return CheckResult.wrong(f"{new_posts} mails at 50 per connection need 2 SMTP connections, "
+                                         f"sync opened {sink.connections}.")
+            (unsent,), = cli.query('SELECT COUNT(*) FROM mails WHERE is_sent = 0')
+            if unsent:
+                return CheckResult.wrong(f"{unsent} delivered mails were not marked as sent.")
+            record_benchmark('smtp_delivery', result, farm.total_hits, mails=len(sink.messages),
+                             connections=sink.connections,
+                             first_mail_s=round(min(latencies), 4), last_mail_s=round(max(latencies), 4))
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test15_smtp_digest(self):
+        with BlogFarm(sites=2, posts=30, per_page=10) as farm, SMTPSink() as sink, BlogNotifierCLI() as cli:
+            self.sync_with_smtp(farm, cli, sink, client="  digest: true\n")
+            if len(sink.messages) != 1 or sink.connections != 1:
+                return CheckResult.wrong(f"With client.digest all new posts should go out in a single mail, "
+                                         f"sync sent {len(sink.messages)} mails over {sink.connections} connections.")
+            digest = sink.contents()[0]
+            missing = [farm.post_url(site, post) for site in range(farm.sites) for post in range(farm.posts)
+                       if farm.post_url(site, post) not in digest]
+            if missing:
+                return CheckResult.wrong(f"The digest mail does not mention {len(missing)} new posts, e.g. {missing[0]}")
+            (unsent,), = cli.query('SELECT COUNT(*) FROM mails WHERE is_sent = 0')
+            if unsent:
+                return CheckResult.wrong(f"{unsent} mails rolled into the digest were not marked as sent.")
+        return CheckResult.correct()
+
+    @staticmethod
+    def extracted_links(cli, url):
+        result = cli.run('--quiet', '--links', url)
+        if result.returncode != 0:
+            raise WrongAnswer(f"--links {url} failed:\n{result.output}")
+        return result.output.splitlines()
+
+    @dynamic_test(time_limit=180000)
+    def test16_link_extraction_matches_reference(self):
+        with BlogFarm() as farm, BlogNotifierCLI() as cli:
+            for name, page in HTML_PAGES.items():
+                links = self.extracted_links(cli, farm.add_page(f'/corpus/{name}', page))
+                expected = reference_links(page)
+                if links != expected:
+                    return CheckResult.wrong(f"Links extracted from {name} do not match BeautifulSoup."
+                                             f"\nYour program output: {links}\nExpected output: {expected}")
+            for name, (content_type, page) in NON_HTML_PAGES.items():
+                links = self.extracted_links(cli, farm.add_page(f'/corpus/{name}', page, content_type))
+                if links:
+                    return CheckResult.wrong(f"{name} is served as {content_type} and should not be parsed, "
+                                             f"but these links were extracted: {links}")
+            # links past the default 5 MiB read limit are never seen
+            page = archive_page(60000)
+            links = self.extracted_links(cli, farm.add_page('/corpus/huge.html', page))
+            expected = reference_links(page)
+            # the last link may have been cut in half by the limit
+            if not links or len(links) >= len(expected) or links[:-1] != expected[:len(links) - 1]:
+                return CheckResult.wrong(f"Only the links within the first 5 MiB of a {len(page)} bytes page "
+                                         f"should be extracted, got {len(links)} of {len(expected)}.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=300000)
+    def test17_link_extraction_benchmark(self):
+        bench = subprocess.run(['go', 'test', '-run', '^$', '-bench', 'BenchmarkExtractLinks', '-benchmem'],
+                               cwd=STAGE_DIR, capture_output=True, text=True)
+        match = re.search(r'BenchmarkExtractLinks\S*\s+(\d+)\s+([\d.]+) ns/op\s+([\d.]+) MB/s'
+                          r'\s+(\d+) B/op\s+(\d+) allocs/op', bench.stdout)
+        if bench.returncode != 0 or match is None:
+            return CheckResult.wrong(f"The link extraction benchmark failed:\n{bench.stdout}{bench.stderr}")
+        _, ns_per_page, mb_per_s, bytes_per_page, allocs_per_page = match.groups()
+        print(json.dumps({
+            'benchmark': 'extract_links',
+            'ns_per_page': float(ns_per_page),
+            'mb_per_s': float(mb_per_s),
+            'bytes_per_page': int(bytes_per_page),
+            'allocs_per_page': int(allocs_per_page),
+        }))
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000, data=['rss', 'atom', 'sitemap', 'none'])
+    def test18_feed_first_discovery(self, feed):
+        feed = None if feed == 'none' else feed
+        with BlogFarm(sites=3, posts=25, per_page=5, feed=feed) as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            for site in range(farm.sites):
+                (stored,), = cli.query('SELECT feed FROM blogs WHERE site = ?', farm.site_url(site))
+                if stored != (farm.feed_url(site) or ''):
+                    return CheckResult.wrong(f"--explore should store the feed {farm.feed_url(site)} "
+                                             f"of {farm.site_url(site)}, it stored '{stored}'.")
+            farm.reset_stats()
+            cli.write_file('credentials.yaml', sync_config())
+            result = cli.run('sync', '--conf', 'credentials.yaml', timeout=60)
+            if result.returncode != 0:
+                return CheckResult.wrong(f"sync --conf failed:\n{result.output}")
+            for site in range(farm.sites):
+                posts = {link for link, in cli.query('SELECT link FROM posts WHERE site = ?', farm.site_url(site))}
+                missing = {farm.post_url(site, j) for j in range(farm.posts)} - posts
+                if missing:
+                    return CheckResult.wrong(f"sync did not find {len(missing)} posts of {farm.site_url(site)}.")
+                expected = 1 if feed else farm.page_count() + farm.posts
+                if farm.site_hits(site) != expected:
+                    return CheckResult.wrong(f"With feed {feed}, sync should fetch {expected} documents of "
+                                             f"{farm.site_url(site)}, it fetched {farm.site_hits(site)}.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test19_watch_adapts_polling(self):
+        watch = ("watch:\n"
+                 "  interval: 200ms\n"
+                 "  min_interval: 100ms\n"
+                 "  max_interval: 1600ms\n")
+        with BlogFarm(sites=2, posts=10, per_page=5, feed='rss') as farm, BlogNotifierCLI() as cli:
+            dead = farm.base_url(0) + '/gone/'
+            cli.seed_sites(farm.site_urls() + [dead])
+            cli.write_file('credentials.yaml', sync_config(sections=watch))
+            farm.reset_stats()
+            publish = threading.Timer(1.5, farm.add_posts, args=(3,))
+            publish.start()
+            try:
+                result = cli.run('watch', '--conf', 'credentials.yaml', '--for', '4s', timeout=60)
+            finally:
+                publish.cancel()
+            if result.returncode != 0 or 'watch: stopped' not in result.output:
+                return CheckResult.wrong(f"watch --conf --for 4s should poll for 4 seconds and stop:\n{result.output}")
+            # polling every site at the 100ms min interval would fetch about 40 documents per site
+            for site in range(farm.sites):
+                polls = farm.site_hits(site)
+                if not 3 <= polls <= 20:
+                    return CheckResult.wrong(f"Over 4 seconds watch should poll {farm.site_url(site)} repeatedly "
+                                             f"but less often while it does not post, it fetched {polls} documents.")
+                posts = {link for link, in cli.query('SELECT link FROM posts WHERE site = ?', farm.site_url(site))}
+                missing = {farm.post_url(site, j) for j in range(farm.posts)} - posts
+                if missing:
+                    return CheckResult.wrong(f"watch did not pick up {len(missing)} posts published on "
+                                             f"{farm.site_url(site)} while it was running.")
+            failures = farm.hits['/gone/']
+            (errors, interval), = cli.query('SELECT poll_errors, poll_interval FROM blogs WHERE site = ?', dead)
+            if errors != failures or not 2 <= failures <= 8:
+                return CheckResult.wrong(f"A failing site should be retried with an exponential backoff, "
+                                         f"{dead} was fetched {failures} times and {errors} errors were recorded.")
+            for site in range(farm.sites):
+                (errors, interval), = cli.query('SELECT poll_errors, poll_interval FROM blogs WHERE site = ?',
+                                                farm.site_url(site))
+                if errors or not 100 <= interval <= 1600:
+                    return CheckResult.wrong(f"The poll interval of {farm.site_url(site)} should stay within "
+                                             f"min_interval and max_interval, it is {interval}ms.")
+        return CheckResult.correct()
+
+    def sync_with_metrics(self, farm, cli, sink, fmt):
+        cli.seed_sites(farm.site_urls())
+        cli.write_file('credentials.yaml', sync_config(sink.port))
+        farm.reset_stats()
+        result = cli.run('sync', '--conf', 'credentials.yaml', '--metrics', fmt, timeout=60)
+        if result.returncode != 0:
+            raise WrongAnswer(f"sync --conf --metrics {fmt} failed:\n{result.output}")
+        try:
+            report = parse_metrics(result.output, fmt)
+            validate_metrics(report)
+        except MetricsError as err:
+            raise WrongAnswer(f"The {fmt} metrics of sync are invalid: {err}\n{result.output}")
+        return result, report
+
+    @dynamic_test(time_limit=180000, data=['json', 'prometheus'])
+    def test20_sync_metrics(self, fmt):
+        with BlogFarm(sites=3, posts=25, per_page=5) as farm, SMTPSink() as sink, BlogNotifierCLI() as cli:
+            result, report = self.sync_with_metrics(farm, cli, sink, fmt)
+            if sorted(report['sites']) != sorted(farm.site_urls()):
+                return CheckResult.wrong(f"The metrics should cover the sites {farm.site_urls()}, "
+                                         f"they cover {sorted(report['sites'])}.")
+            for site in range(farm.sites):
+                fetches = report['sites'][farm.site_url(site)]['fetches']
+                if fetches != farm.site_hits(site):
+                    return CheckResult.wrong(f"The metrics count {fetches} fetches of {farm.site_url(site)}, "
+                                             f"the site served {farm.site_hits(site)} requests.")
+            fetched_bytes = sum(site['bytes'] for site in report['sites'].values())
+            if fetched_bytes != farm.bytes_sent:
+                return CheckResult.wrong(f"The metrics count {fetched_bytes} bytes fetched, "
+                                         f"the sites sent {farm.bytes_sent}.")
+            if report['mails']['sent'] != len(sink.messages) or report['mails']['failed']:
+                return CheckResult.wrong(f"The metrics count {report['mails']['sent']} mails sent and "
+                                         f"{report['mails']['failed']} failed, the SMTP server received "
+                                         f"{len(sink.messages)}.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test21_sync_perf_regression(self):
+        with BlogFarm(sites=3, posts=25, per_page=5) as farm, SMTPSink() as sink, BlogNotifierCLI() as cli:
+            result, report = self.sync_with_metrics(farm, cli, sink, 'json')
+            sites = report['sites'].values()
+            counts = {
+                'fetches': sum(site['fetches'] for site in sites),
+                'not_modified': sum(site['not_modified'] for site in sites),
+                'fetch_errors': sum(site['errors'] for site in sites),
+                'mails_sent': report['mails']['sent'],
+                'mails_failed': report['mails']['failed'],
+            }
+            seconds = {'wall': report['wall_seconds'], 'db_write': report['db_write_seconds'],
+                       **report['phase_seconds']}
+            record_benchmark('sync_metrics', result, counts['fetches'], **{f'{k}_s': round(v, 4)
+                                                                            for k, v in seconds.items()})
+            regressions = compare_to_baseline('sync_3_sites_25_posts', counts, seconds)
+            if regressions:
+                return CheckResult.wrong("sync regressed against test/baselines.json:\n" + "\n".join(regressions))
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test22_outbox_retries_failed_mails(self):
+        with BlogFarm(sites=1, posts=6, per_page=10) as farm, SMTPSink(reject=4) as sink, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            cli.write_file('credentials.yaml', sync_config(sink.port, server="  connections: 1\n"
+                                                                          "  retry_delay: 2s\n"))
+
+            def sync():
+                start = time.time()
+                result = cli.run('sync', '--conf', 'credentials.yaml', timeout=60)
+                if result.returncode != 0:
+                    raise WrongAnswer(f"sync --conf failed:\n{result.output}")
+                return start, time.time()
+
+            start, end = sync()
+            if len(sink.rejected) != 4 or len(sink.messages) != 2:
+                return CheckResult.wrong(f"The SMTP server rejects the first 4 mails, the other 2 should still go "
+                                         f"out, it received {len(sink.messages)} after {len(sink.rejected)} rejections.")
+            failed = cli.query('SELECT attempts, next_attempt, last_error FROM mails WHERE is_sent = 0')
+            if len(failed) != 4:
+                return CheckResult.wrong(f"The 4 rejected mails should stay in the outbox, {len(failed)} did.")
+            for attempts, next_attempt, last_error in failed:
+                if attempts != 1 or '451' not in last_error:
+                    return CheckResult.wrong(f"A rejected mail should record its attempt and the SMTP error, "
+                                             f"got attempts {attempts} and error '{last_error}'.")
+                if not (start + 2) * 1000 - 1 <= next_attempt <= (end + 2) * 1000 + 1:
+                    return CheckResult.wrong(f"With retry_delay 2s a rejected mail should be retried 2 seconds "
+                                             f"after it failed, next_attempt is {next_attempt / 1000 - end:.2f}s "
+                                             f"after the end of sync.")
+
+            # not due yet, a second sync leaves the failed mails alone
+            sync()
+            if len(sink.messages) != 2 or len(sink.rejected) != 4:
+                return CheckResult.wrong("Failed mails should not be retried before their retry delay has passed.")
+
+            time.sleep(max(0.0, end + 2.2 - time.time()))
+            sync()
+            (unsent,), = cli.query('SELECT COUNT(*) FROM mails WHERE is_sent = 0')
+            if unsent or len(sink.messages) != 6:
+                return CheckResult.wrong(f"Once due, the failed mails should be delivered, {unsent} are still unsent "
+                                         f"and the SMTP server received {len(sink.messages)} of 6 mails.")
+            contents = sink.contents()
+            for post in range(farm.posts):
+                url = farm.post_url(0, post)
+                copies = sum(url in content for content in contents)
+                if copies != 1:
+                    return CheckResult.wrong(f"Every new post should be mailed exactly once, {url} was mailed "
+                                             f"{copies} times.")
+            attempts = sorted(n for n, in cli.query('SELECT attempts FROM mails'))
+            if attempts != [1, 1, 2, 2, 2, 2]:
+                return CheckResult.wrong(f"The mails should record 1 attempt when delivered at once and 2 when "
+                                         f"retried, they record {attempts}.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test23_incremental_crawl(self):
+        with BlogFarm(sites=2, posts=40, per_page=5) as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            cli.write_file('credentials.yaml', sync_config(sections="crawler:\n"
+                                                                    "  incremental: true\n"))
+            # published between syncs, and the listing pages every sync has to read to find them:
+            # 3 new posts fit on the home page, 12 spill over onto pages 2 and 3
+            for new_posts, listings in ((0, farm.page_count()), (3, 1), (12, 3)):
+                farm.add_posts(new_posts)
+                farm.reset_stats()
+                result = cli.run('sync', '--conf', 'credentials.yaml', timeout=60)
+                if result.returncode != 0:
+                    return CheckResult.wrong(f"sync --conf failed:\n{result.output}")
+                expected = listings + (new_posts or farm.posts)
+                for site in range(farm.sites):
+                    if farm.site_hits(site) != expected:
+                        return CheckResult.wrong(
+                            f"After {new_posts or farm.posts} new posts an incremental sync should fetch "
+                            f"{listings} listing pages and the new posts of {farm.site_url(site)}, "
+                            f"{expected} pages in all, it fetched {farm.site_hits(site)}.")
+                    posts = {link for link, in cli.query('SELECT link FROM posts WHERE site = ?',
+                                                         farm.site_url(site))}
+                    missing = {farm.post_url(site, j) for j in range(farm.posts)} - posts
+                    if missing:
+                        return CheckResult.wrong(f"The incremental sync missed {len(missing)} new posts "
+                                                 f"of {farm.site_url(site)}.")
+                    (last_link,), = cli.query('SELECT last_link FROM blogs WHERE site = ?', farm.site_url(site))
+                    if last_link != farm.post_url(site, farm.posts - 1):
+                        return CheckResult.wrong(f"last_link of {farm.site_url(site)} should be its newest post "
+                                                 f"{farm.post_url(site, farm.posts - 1)}, it is {last_link}.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=300000)
+    def test24_streaming_sync_benchmark(self):
+        with BlogFarm(sites=24, posts=400, per_page=100, hosts=4) as farm, SMTPSink() as sink, \
+                BlogNotifierCLI() as cli:
+            result, latencies = self.sync_with_smtp(farm, cli, sink)
+            new_posts = farm.unique_pages() - farm.sites
+            if len(sink.messages) != new_posts:
+                return CheckResult.wrong(f"sync should mail each of the {new_posts} new posts, "
+                                         f"the SMTP server received {len(sink.messages)}.")
+            # 24 sites on 8 crawl workers, the first sites are stored and mailed while the
+            # last ones are still being crawled
+            first_mail = min(message['time'] for message in sink.messages)
+            if first_mail >= farm.last_hit:
+                return CheckResult.wrong("The first mails should go out while the crawl is still running, "
+                                         "sync only started mailing after the last page was fetched.")
+            start = first_mail - min(latencies)
+            record_benchmark('streaming_sync', result, farm.total_hits, mails=len(sink.messages),
+                             first_mail_s=round(min(latencies), 4),
+                             crawl_done_s=round(farm.last_hit - start, 4),
+                             last_mail_s=round(max(latencies), 4))
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test25_sync_bounds_misbehaving_sites(self):
+        with BlogFarm(sites=2, posts=10, per_page=5) as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            hanging = farm.add_hanging_page('/hanging/')
+            slow = farm.add_slow_page('/slow/', size=1 << 20)
+            oversized = farm.add_oversized_page('/oversized/', size=64 << 20)
+            loop = farm.add_redirect('/loop/', '/loop/')
+            # added behind the back of explore, which would get stuck on them as well
+            for url in (hanging, slow, oversized, loop):
+                cli.query('INSERT INTO blogs (site, last_link) VALUES (?, ?)', url, url)
+            cli.write_file('credentials.yaml', sync_config(sections="http:\n"
+                                                                    "  connect_timeout: 1s\n"
+                                                                    "  read_timeout: 1s\n"
+                                                                    "  timeout: 3s\n"
+                                                                    "  max_redirects: 3\n"
+                                                                    "crawler:\n"
+                                                                    "  max_page_bytes: 1048576\n"))
+            farm.reset_stats()
+            start = time.perf_counter()
+            result = cli.run('sync', '--conf', 'credentials.yaml', '--metrics', 'json', timeout=60)
+            elapsed = time.perf_counter() - start
+            if result.returncode != 0:
+                return CheckResult.wrong(f"sync --conf failed:\n{result.output}")
+            if elapsed > 10:
+                return CheckResult.wrong(f"With a 1s read timeout and a 3s deadline per request sync should not "
+                                         f"wait on misbehaving sites, it took {elapsed:.1f}s.")
+            posts = {link for link, in cli.query('SELECT link FROM posts')}
+            missing = {farm.post_url(site, post) for site in range(farm.sites) for post in range(farm.posts)} - posts
+            if missing:
+                return CheckResult.wrong(f"The misbehaving sites should not keep sync from storing the posts of "
+                                         f"the others, {len(missing)} posts are missing.")
+            if farm.hits['/loop/'] != 4:
+                return CheckResult.wrong(f"With max_redirects 3 a redirect loop should be requested 4 times, "
+                                         f"it was requested {farm.hits['/loop/']} times.")
+            try:
+                report = parse_metrics(result.output, 'json')
+            except MetricsError as err:
+                return CheckResult.wrong(f"The metrics of sync are invalid: {err}\n{result.output}")
+            for url in (hanging, slow, loop):
+                if report['sites'].get(url, {}).get('errors') != 1:
+                    return CheckResult.wrong(f"The fetch of {url} should fail and be counted as an error.")
+            read = report['sites'].get(oversized, {}).get('bytes')
+            if read != 1 << 20:
+                return CheckResult.wrong(f"With max_page_bytes 1048576 sync should read 1048576 bytes of a "
+                                         f"64 MiB page, it read {read}.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000, data=['gzip', 'identity'])
+    def test26_compressed_transfers(self, encoding):
+        with BlogFarm(sites=2, posts=20, per_page=5, compress=True) as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            disable = 'true' if encoding == 'identity' else 'false'
+            cli.write_file('credentials.yaml', sync_config(sections=f"http:\n"
+                                                                    f"  disable_compression: {disable}\n"))
+            farm.reset_stats()
+            result = cli.run('sync', '--conf', 'credentials.yaml', timeout=60)
+            if result.returncode != 0:
+                return CheckResult.wrong(f"sync --conf failed:\n{result.output}")
+            posts = {link for link, in cli.query('SELECT link FROM posts')}
+            missing = {farm.post_url(site, post) for site in range(farm.sites) for post in range(farm.posts)} - posts
+            if missing:
+                return CheckResult.wrong(f"sync missed {len(missing)} posts with {encoding} transfers.")
+            pages = sum(farm.status.values())
+            if farm.encodings[encoding] != pages:
+                return CheckResult.wrong(f"With disable_compression: {disable} all {pages} responses should be "
+                                         f"transferred as {encoding}, {farm.encodings[encoding]} were.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=300000)
+    def test27_import_benchmark(self):
+        with BlogNotifierCLI() as cli:
+            cli.run('--migrate')
+            sites = 100000
+            lines = ['# our watchlist']
+            for i in range(sites):
+                lines.append(f'https://blog{i}.example.com/')
+                if i % 10 == 0:
+                    # the same sites again, written differently
+                    lines.append(f'HTTPS://Blog{i}.Example.com#about')
+                    lines.append(f'blog{i}.example.com')
+            lines.append('ftp://files.example.com/')
+            cli.write_file('watchlist.txt', '\n'.join(lines) + '\n')
+
+            result = cli.run('import', 'watchlist.txt', timeout=120)
+            if result.returncode != 0:
+                return CheckResult.wrong(f"import failed:\n{result.output}")
+            # blog{i}.example.com is http, a different site than its https counterpart
+            expected = sites + sites // 10
+            (count,), = cli.query('SELECT COUNT(*) FROM blogs')
+            if count != expected:
+                return CheckResult.wrong(f"The watchlist lists {expected} distinct sites once normalized, "
+                                         f"import stored {count}.")
+            if f'imported {expected} sites, {sites // 10} duplicates, 1 invalid' not in result.output:
+                return CheckResult.wrong(f"import should report the sites added, the duplicates and the invalid "
+                                         f"urls it skipped:\n{result.output}")
+            record_benchmark('import_100k_sites', result, count)
+
+            listed = cli.run('--quiet', '--list', timeout=120)
+            rows = [line.split(' ')[0] for line in listed.output.splitlines()]
+            if listed.returncode != 0 or len(rows) != expected or rows != sorted(rows):
+                return CheckResult.wrong(f"--list should print all {expected} sites ordered by site, "
+                                         f"it printed {len(rows)}.")
+            record_benchmark('list_100k_sites', listed, len(rows))
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000, data=['opml', 'csv', 'lines'])
+    def test28_watchlist_round_trip(self, fmt):
+        with BlogNotifierCLI() as source, BlogNotifierCLI() as target:
+            for cli in (source, target):
+                cli.run('--migrate')
+            source.write_file('watchlist.opml', (
+                '<?xml version="1.0"?>\n<opml version="2.0"><head><title>blogs</title></head><body>\n'
+                '<outline text="Go">\n'
+                '  <outline text="a" htmlUrl="https://a.example.com/" xmlUrl="https://a.example.com/feed"/>\n'
+                '  <outline text="b" xmlUrl="https://b.example.com/rss.xml"/>\n'
+                '</outline>\n'
+                '<outline text="c &amp; d" htmlUrl="https://c.example.com/?q=1&amp;r=2"/>\n'
+                '<outline text="again" htmlUrl="HTTPS://A.EXAMPLE.COM/"/>\n'
+                '</body></opml>\n'))
+            result = source.run('import', 'watchlist.opml')
+            if result.returncode != 0:
+                return CheckResult.wrong(f"import of an OPML file failed:\n{result.output}")
+            expected = [('https://a.example.com/', 'https://a.example.com/feed'),
+                        ('https://b.example.com/rss.xml', 'https://b.example.com/rss.xml'),
+                        ('https://c.example.com/?q=1&r=2', '')]
+            imported = source.query('SELECT site, feed FROM blogs ORDER BY site')
+            if imported != expected:
+                return CheckResult.wrong(f"The OPML import should store {expected}, it stored {imported}.")
+
+            result = source.run('export', '--format', fmt, 'exported')
+            if result.returncode != 0:
+                return CheckResult.wrong(f"export --format {fmt} failed:\n{result.output}")
+            with open(os.path.join(source.work_dir, 'exported')) as file:
+                target.write_file('exported', file.read())
+            result = target.run('import', '--format', fmt, 'exported')
+            if result.returncode != 0:
+                return CheckResult.wrong(f"import --format {fmt} of an exported watchlist failed:\n{result.output}")
+            # a list of urls has no room for the feeds
+            if fmt == 'lines':
+                expected = [(site, '') for site, _ in expected]
+            round_trip = target.query('SELECT site, feed FROM blogs ORDER BY site')
+            if round_trip != expected:
+                return CheckResult.wrong(f"Importing what export --format {fmt} wrote should restore {expected}, "
+                                         f"it restored {round_trip}.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test29_mirrored_posts_are_mailed_once(self):
+        with BlogFarm(sites=3, posts=8, per_page=10) as farm, SMTPSink() as sink, BlogNotifierCLI() as cli:
+            mirrored = article_text('mirrored')
+            edited = mirrored.split(' ')
+            edited[70] = 'edited'
+            farm.articles = {
+                (0, 2): mirrored,
+                (1, 5): mirrored,
+                (2, 7): ' '.join(edited),
+                (2, 3): with_unclosed_anchor(mirrored),
+                (0, 4): article_text('only on blog 0'),
+                (1, 1): article_text('only on blog 1'),
+            }
+            self.sync_with_smtp(farm, cli, sink)
+            new_posts = farm.unique_pages() - farm.sites
+            if len(sink.messages) != new_posts - 3:
+                return CheckResult.wrong(f"{new_posts} new posts of which 4 are the same article should make "
+                                         f"{new_posts - 3} mails, the SMTP server received {len(sink.messages)}.")
+            contents = sink.contents()
+            mirrors = [farm.post_url(0, 2), farm.post_url(1, 5), farm.post_url(2, 7), farm.post_url(2, 3)]
+            mailed = [url for url in mirrors if any(url in content for content in contents)]
+            if len(mailed) != 1:
+                return CheckResult.wrong(f"A mirrored article should be mailed once, {mailed} were mailed.")
+            for url in (farm.post_url(0, 4), farm.post_url(1, 1)):
+                if not any(url in content for content in contents):
+                    return CheckResult.wrong(f"{url} is not mirrored anywhere, it should have been mailed.")
+            (stored,), = cli.query('SELECT COUNT(*) FROM posts')
+            if stored != new_posts:
+                return CheckResult.wrong(f"Mirrors are still posts of their blogs, {new_posts} posts should be "
+                                         f"stored, {stored} were.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test30_pages_with_the_same_links_are_not_expanded(self):
+        with BlogFarm(sites=2, posts=20, per_page=5) as farm, SMTPSink() as sink, BlogNotifierCLI() as cli:
+            self.sync_with_metrics(farm, cli, sink, 'json')
+            (stored,), = cli.query('SELECT COUNT(*) FROM posts')
+            # every page changes on every request, the links on it do not
+            farm.noise = True
+            farm.reset_stats()
+            result = cli.run('sync', '--conf', 'credentials.yaml', '--metrics', 'json', timeout=60)
+            if result.returncode != 0:
+                return CheckResult.wrong(f"sync --conf --metrics json failed:\n{result.output}")
+            report = parse_metrics(result.output, 'json')
+            for site in range(farm.sites):
+                metrics = report['sites'][farm.site_url(site)]
+                if farm.site_hits(site) != 1 or metrics['links_unchanged'] != 1:
+                    return CheckResult.wrong(f"The home page of {farm.site_url(site)} changed but still links to the "
+                                             f"same pages, sync should fetch it alone and count it in "
+                                             f"links_unchanged, it fetched {farm.site_hits(site)} pages and counted "
+                                             f"{metrics['links_unchanged']}.")
+            (after,), = cli.query('SELECT COUNT(*) FROM posts')
+            if after != stored or report['mails']['sent']:
+                return CheckResult.wrong("A page whose links did not change has no new posts to store or mail.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test31_sharded_syncs_split_the_watchlist(self):
+        shard = ("shard:\n"
+                 "  lease: 30s\n"
+                 "  batch: 3\n"
+                 "  round: 1m\n")
+        with BlogFarm(sites=30, posts=4, per_page=5, latency=0.01) as farm, SMTPSink() as sink, \
+                BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            cli.write_file('credentials.yaml', sync_config(sink.port, sections=shard))
+            farm.reset_stats()
+            workers = [cli.start('sync', '--conf', 'credentials.yaml', '--shard') for _ in range(3)]
+            outputs = []
+            for worker in workers:
+                try:
+                    output, _ = worker.communicate(timeout=90)
+                except subprocess.TimeoutExpired:
+                    worker.kill()
+                    output, _ = worker.communicate()
+                if worker.returncode != 0:
+                    return CheckResult.wrong(f"sync --conf --shard failed:\n{output}")
+                outputs.append(output)
+            synced = [re.search(r'^sync: \S+ synced (\d+) sites$', output, re.M) for output in outputs]
+            if not all(synced):
+                return CheckResult.wrong("Every sharded sync should end with "
+                                         "'sync: OWNER synced N sites', got:\n" + '\n'.join(outputs))
+            total = sum(int(match.group(1)) for match in synced)
+            if total != farm.sites:
+                return CheckResult.wrong(f"The sharded syncs together should sync each of the {farm.sites} "
+                                         f"sites once, they synced {total}.")
+            if farm.duplicate_hits():
+                return CheckResult.wrong(f"No page should be fetched by two sharded syncs, these were fetched "
+                                         f"more than once: {sorted(farm.duplicate_hits())[:5]}")
+            new_posts = farm.unique_pages() - farm.sites
+            if len(sink.messages) != new_posts:
+                return CheckResult.wrong(f"{new_posts} new posts should make as many mails, the SMTP server "
+                                         f"received {len(sink.messages)}.")
+            (leased,), = cli.query("SELECT COUNT(*) FROM blogs WHERE lease_owner != '' OR lease_until != 0")
+            if leased:
+                return CheckResult.wrong(f"{leased} blogs are still leased after the sharded syncs ended.")
+            # a second round started right away finds nothing left to sync
+            result = cli.run('sync', '--conf', 'credentials.yaml', '--shard', timeout=60)
+            if not re.search(r'^sync: \S+ synced 0 sites$', result.output, re.M):
+                return CheckResult.wrong(f"Sites synced within the round should not be synced again:\n"
+                                         f"{result.output}")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test32_expired_leases_are_taken_over(self):
+        with BlogFarm(sites=2, posts=4, per_page=5) as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            cli.write_file('credentials.yaml', sync_config(sections="shard:\n  lease: 30s\n"))
+            now = int(time.time() * 1000)
+            with sqlite3.connect(cli.db_path) as db:
+                # the owner of the first site died, the second one is still held
+                db.execute('UPDATE blogs SET lease_owner = ?, lease_until = ? WHERE site = ?',
+                           ('dead:1:0', now - 1000, farm.site_url(0)))
+                db.execute('UPDATE blogs SET lease_owner = ?, lease_until = ? WHERE site = ?',
+                           ('busy:1:0', now + 600000, farm.site_url(1)))
+            farm.reset_stats()
+            result = cli.run('sync', '--conf', 'credentials.yaml', '--shard', timeout=60)
+            if result.returncode != 0:
+                return CheckResult.wrong(f"sync --conf --shard failed:\n{result.output}")
+            if farm.site_hits(0) == 0:
+                return CheckResult.wrong("A site whose lease ran out should be synced by the next sharded sync.")
+            if farm.site_hits(1) != 0:
+                return CheckResult.wrong("A site leased by another sync should not be crawled.")
+            (owner,), = cli.query('SELECT lease_owner FROM blogs WHERE site = ?', farm.site_url(1))
+            if owner != 'busy:1:0':
+                return CheckResult.wrong("A sharded sync should leave the leases of other syncs alone.")
+        return CheckResult.correct()
+
+    def sync_with_telegram(self, farm, cli, api, telegram):
+        cli.seed_sites(farm.site_urls())
+        cli.write_file('credentials.yaml', sync_config(mode='telegram', telegram=f"  api_url: {api.url}\n" + telegram))
+        result = cli.run('sync', '--conf', 'credentials.yaml', timeout=120)
+        if result.returncode != 0:
+            raise WrongAnswer(f"sync --conf with mode: telegram failed:\n{result.output}")
+        posts = [farm.post_url(site, post) for site in range(farm.sites) for post in range(farm.posts)]
+        texts = api.texts()
+        for url in posts:
+            sent = sum(line.split(' ')[3] == url for text in texts for line in text.splitlines())
+            if sent != 1:
+                raise WrongAnswer(f"Every new post should be sent to the channel once, {url} was sent {sent} times.")
+        (unsent,), = cli.query('SELECT COUNT(*) FROM mails WHERE is_sent = 0')
+        if unsent:
+            raise WrongAnswer(f"{unsent} posts sent to Telegram were not marked as sent.")
+        return result, posts
+
+    @dynamic_test(time_limit=180000)
+    def test33_telegram_messages_pack_posts_within_the_rate(self):
+        with BlogFarm(sites=2, posts=40, per_page=10) as farm, BotAPI(rate=10, burst=3) as api, \
+                BlogNotifierCLI() as cli:
+            result, posts = self.sync_with_telegram(farm, cli, api, "  posts_per_message: 5\n"
+                                                                    "  rate: 8\n"
+                                                                    "  burst: 3\n")
+            if any(chat != '@mychannel' for chat in (m['chat'] for m in api.messages)):
+                return CheckResult.wrong("Messages should go to the configured channel, @mychannel.")
+            longest = max(len(text.splitlines()) for text in api.texts())
+            if longest > 5:
+                return CheckResult.wrong(f"A message should pack at most posts_per_message: 5 posts, one had {longest}.")
+            if len(api.messages) > len(posts) // 2:
+                return CheckResult.wrong(f"{len(posts)} posts should be packed into few messages, "
+                                         f"{len(api.messages)} were sent.")
+            if api.throttled:
+                return CheckResult.wrong(f"At rate: 8 the Bot API allowing 10 messages a second should never "
+                                         f"answer 429, it did {api.throttled} times.")
+            record_benchmark('telegram_delivery', result, farm.total_hits, messages=len(api.messages),
+                             posts=len(posts), messages_per_s=api.throughput())
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test34_telegram_backs_off_when_rate_limited(self):
+        with BlogFarm(sites=2, posts=10, per_page=5) as farm, BotAPI(rate=2, burst=1) as api, \
+                BlogNotifierCLI() as cli:
+            result, _ = self.sync_with_telegram(farm, cli, api, "  posts_per_message: 4\n"
+                                                                "  rate: 50\n"
+                                                                "  burst: 10\n")
+            if not api.throttled:
+                return CheckResult.wrong("Sending at rate: 50 to a chat allowing 2 messages a second should "
+                                         "have been rate limited.")
+            match = re.search(r'^notify: (\d+) telegram messages sent for \d+ posts, 0 failed, (\d+) rate limited',
+                              result.output, re.M)
+            if not match or int(match.group(2)) == 0:
+                return CheckResult.wrong("sync should report the messages that were rate limited and retried:\n"
+                                         + result.output)
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=900000)
+    def test35_post_queries_use_the_indexes(self):
+        sites, per_site = 1000, 2000
+        with BlogNotifierCLI() as cli:
+            cli.run('--migrate')
+            now = int(time.time() * 1000)
+            cli.seed_archive(sites, per_site, now)
+            counts, seconds = {}, {}
+
+            def list_posts(name, *args):
+                result = cli.run('--quiet', 'listPosts', *args, timeout=60)
+                if result.returncode != 0:
+                    raise WrongAnswer(f"listPosts {' '.join(args)} failed:\n{result.output}")
+                posts = [line.split(' ') for line in result.output.splitlines()]
+                record_benchmark(name, result, len(posts), rows=sites * per_site)
+                counts[name], seconds[name] = len(posts), result.wall_time
+                return posts
+
+            recent = list_posts('query_recent_posts', '--since', '7d', '--limit', '100')
+            expected = [f'http://blog{site:04d}.example/post/00000' for site in range(100)]
+            if [post[1] for post in recent] != expected:
+                return CheckResult.wrong("listPosts --since 7d --limit 100 should list the 100 newest posts "
+                                         f"across all blogs, newest first, got {[post[1] for post in recent[:5]]}...")
+            if recent[0][2:] != ['Rust', 'notes', '0']:
+                return CheckResult.wrong(f"listPosts should print the title of every post, got {' '.join(recent[0])}")
+
+            week = list_posts('query_site_week', '--site', 'http://blog0042.example/', '--since', '7d')
+            if len(week) != 7 * 24:
+                return CheckResult.wrong(f"A post per hour makes {7 * 24} posts in the last 7 days of a blog, "
+                                         f"listPosts --site --since 7d listed {len(week)}.")
+
+            found = list_posts('query_search', '--search', 'zeppelin', '--limit', '50')
+            if len(found) != 50 or any(post[2] != 'Zeppelin' for post in found):
+                return CheckResult.wrong("listPosts --search zeppelin --limit 50 should list 50 posts "
+                                         "about zeppelins.")
+            found = list_posts('query_site_search', '--site', 'http://blog0007.example/', '--search', 'Zeppelin notes')
+            if sorted(post[1] for post in found) != ['http://blog0007.example/post/00007',
+                                                     'http://blog0007.example/post/01007']:
+                return CheckResult.wrong(f"listPosts --site --search should find the 2 zeppelin posts of the blog, "
+                                         f"got {[post[1] for post in found]}")
+
+            # a scan of the posts instead of an indexed query is many times slower than the baseline
+            regressions = compare_to_baseline('list_posts_2000000_posts', counts, seconds)
+            if regressions:
+                return CheckResult.wrong(f"listPosts over {sites * per_site} posts regressed against the "
+                                         "baseline, its queries should use the indexes:\n" + '\n'.join(regressions))
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test36_cold_start_benchmark(self):
+        with BlogNotifierCLI() as cli:
+            cli.write_file('credentials.yaml', sync_config())
+            result = cli.run('--quiet', '--config', 'credentials.yaml')
+            if result.returncode != 0 or not result.output.startswith('mode: mail\n'):
+                return CheckResult.wrong(f"--quiet --config should print only the settings:\n{result.output}")
+            if os.path.exists(cli.db_path):
+                return CheckResult.wrong("--config reads the config file only, it should not create the database.")
+            with BlogFarm() as farm:
+                page = farm.add_page('/corpus/plain.html', HTML_PAGES['plain.html'])
+                result = cli.run('--quiet', '--links', page)
+            if result.returncode != 0 or result.output.splitlines() != reference_links(HTML_PAGES['plain.html']):
+                return CheckResult.wrong(f"--quiet --links should print the links of the page and nothing else:\n"
+                                         f"{result.output}")
+            if os.path.exists(cli.db_path):
+                return CheckResult.wrong("--links fetches a page only, it should not create the database.")
+            result = cli.run('--quiet', '--migrate')
+            if result.returncode != 0 or result.output:
+                return CheckResult.wrong(f"--quiet --migrate should print nothing:\n{result.output}")
+            result = cli.run('sync', '--conf', 'credentials.yaml')
+            if result.returncode != 0 or 'secret' in result.output:
+                return CheckResult.wrong(f"sync should not print the credentials of the config file:\n{result.output}")
+
+            commands = {
+                'config': ('--config', 'credentials.yaml'),
+                'list': ('--list',),
+                'list_posts': ('listPosts', '--site', 'http://blog.example/'),
+                'export': ('export', '--format', 'lines'),
+                'sync': ('sync', '--conf', 'credentials.yaml'),
+                'invalid': ('nosuchcommand',),
+            }
+            medians = {}
+            for name, args in commands.items():
+                runs = [cli.run('--quiet', *args) for _ in range(15)]
+                if name != 'invalid' and any(run.returncode != 0 for run in runs):
+                    return CheckResult.wrong(f"{' '.join(args)} failed:\n{runs[0].output}")
+                if name in ('list', 'list_posts', 'export') and runs[0].output:
+                    return CheckResult.wrong(f"--quiet {' '.join(args)} on an empty watchlist should print nothing, "
+                                             f"got:\n{runs[0].output}")
+                times = sorted(run.wall_time for run in runs)
+                medians[name] = statistics.median(times)
+                record_benchmark(f'cold_start_{name}', RunResult(runs[0].returncode, '', medians[name],
+                                                                 max(run.max_rss_kb for run in runs)),
+                                 0, p90_s=round(times[int(len(times) * 0.9)], 4))
+            regressions = compare_to_baseline('cold_start', {}, medians)
+            if regressions:
+                return CheckResult.wrong("Starting the program with nothing to do regressed against the baseline:\n"
+                                         + '\n'.join(regressions))
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test37_interrupted_sync_resumes_from_its_checkpoint(self):
+        crawler = ("crawler:\n"
+                   "  max_depth: 20\n"
+                   "  workers: 2\n"
+                   "  per_host: 1\n")
+        with BlogFarm(sites=4, posts=40, per_page=5, latency=0.05) as farm, SMTPSink() as sink, \
+                BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            cli.write_file('credentials.yaml', sync_config(sink.port, sections=crawler))
+            farm.reset_stats()
+            new_posts = farm.unique_pages() - farm.sites
+
+            proc = cli.start('sync', '--conf', 'credentials.yaml')
+            deadline = time.monotonic() + 60
+            while farm.total_hits < farm.unique_pages() // 3 and time.monotonic() < deadline:
+                time.sleep(0.02)
+            proc.terminate()
+            try:
+                output, _ = proc.communicate(timeout=60)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                output, _ = proc.communicate()
+                return CheckResult.wrong(f"sync should stop soon after SIGTERM:\n{output}")
+            (stored,), = cli.query('SELECT COUNT(*) FROM posts')
+            if stored >= new_posts:
+                return CheckResult.wrong("sync finished before it was interrupted, the test needs a slower farm.")
+            if proc.returncode == 0:
+                return CheckResult.wrong(f"An interrupted sync should exit with an error:\n{output}")
+            (checkpointed,), = cli.query('SELECT COUNT(*) FROM crawl_frontier WHERE fetched = 1')
+            if not checkpointed:
+                return CheckResult.wrong("An interrupted sync should leave a checkpoint of the pages it fetched.")
+
+            result = cli.run('sync', '--conf', 'credentials.yaml', timeout=120)
+            if result.returncode != 0:
+                return CheckResult.wrong(f"sync after an interrupted one failed:\n{result.output}")
+            if 'resuming the crawl' not in result.output:
+                return CheckResult.wrong(f"sync should resume the interrupted crawls:\n{result.output}")
+            if farm.duplicate_hits():
+                return CheckResult.wrong(f"The resumed sync should not fetch the pages fetched before the interruption "
+                                         f"again, these were fetched twice: {sorted(farm.duplicate_hits())[:5]}")
+            if len(farm.hits) != farm.unique_pages():
+                return CheckResult.wrong(f"Together the two syncs should fetch all the {farm.unique_pages()} pages, "
+                                         f"they fetched {len(farm.hits)}.")
+            (stored,), = cli.query('SELECT COUNT(*) FROM posts')
+            if stored != new_posts:
+                return CheckResult.wrong(f"Together the two syncs should store the {new_posts} posts, "
+                                         f"they stored {stored}.")
+            mailed = [link for content in sink.contents() for link in re.findall(r'New blog post (\S+) on blog', content)]
+            if len(mailed) != new_posts or len(set(mailed)) != len(mailed):
+                return CheckResult.wrong(f"Every one of the {new_posts} posts should be mailed once, the SMTP server "
+                                         f"received {len(mailed)} mails for {len(set(mailed))} posts.")
+            (left,), = cli.query('SELECT (SELECT COUNT(*) FROM crawl_sites) + (SELECT COUNT(*) FROM crawl_frontier)')
+            if left:
+                return CheckResult.wrong("The checkpoints should be dropped once the crawls completed.")
+            for site in range(farm.sites):
+                (last_link,), = cli.query('SELECT last_link FROM blogs WHERE site = ?', farm.site_url(site))
+                if last_link != farm.post_url(site, farm.posts - 1):
+                    return CheckResult.wrong(f"The last link of {farm.site_url(site)} should be its newest post "
+                                             f"{farm.post_url(site, farm.posts - 1)}, not {last_link}.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test38_robots_txt_and_site_policies(self):
+        robots = ("User-agent: *\n"
+                  "Disallow: /\n"
+                  "\n"
+                  "User-agent: BlogNotifier\n"
+                  "Disallow: /*/calendar/\n"
+                  "Allow: /\n"
+                  "Crawl-delay: 0.1\n")
+        crawler = ("crawler:\n"
+                   "  exclude:\n"
+                   "    - /*/tag/\n")
+        with BlogFarm(sites=4, posts=10, per_page=5, traps=True, robots=robots) as farm, SMTPSink() as sink, \
+                BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            cli.write_file('credentials.yaml', sync_config(sink.port, sections=crawler))
+            for site in range(farm.sites):
+                args = ['policy', '--site', farm.site_url(site), '--exclude', '/*/archive/']
+                args += {2: ['--max-pages', '4'], 3: ['--max-bytes', '1']}.get(site, [])
+                result = cli.run(*args)
+                if result.returncode != 0:
+                    return CheckResult.wrong(f"{' '.join(args)} failed:\n{result.output}")
+            farm.reset_stats()
+
+            result = cli.run('sync', '--conf', 'credentials.yaml', timeout=120)
+            if result.returncode != 0:
+                return CheckResult.wrong(f"sync with robots.txt and site policies failed:\n{result.output}")
+            trapped = [path for path in farm.hits if any(f'/{kind}/' in path for kind in BlogFarm.TRAP_KINDS)]
+            if trapped:
+                return CheckResult.wrong(f"sync fetched {sorted(trapped)[:5]}, which robots.txt, the exclude "
+                                         f"patterns of the config file or of the sites rule out.")
+            if farm.robots_hits != 1:
+                return CheckResult.wrong(f"The sites share a host, its robots.txt should be fetched once, "
+                                         f"it was fetched {farm.robots_hits} times.")
+            stored = {link for link, in cli.query('SELECT link FROM posts')}
+            for site in (0, 1):
+                missing = [farm.post_url(site, j) for j in range(farm.posts) if farm.post_url(site, j) not in stored]
+                if missing or farm.site_hits(site) != farm.page_count() + farm.posts:
+                    return CheckResult.wrong(f"{farm.site_url(site)} has no budget of its own, sync should fetch "
+                                             f"its {farm.page_count() + farm.posts} pages and store all its posts, "
+                                             f"it fetched {farm.site_hits(site)} and missed {missing[:3]}.")
+            if any(f'/{kind}/' in link for link in stored for kind in BlogFarm.TRAP_KINDS):
+                return CheckResult.wrong("Links ruled out by robots.txt or the patterns should not be stored as posts.")
+            if farm.site_hits(2) > 4:
+                return CheckResult.wrong(f"policy --max-pages 4 should stop the crawl of {farm.site_url(2)} "
+                                         f"after 4 pages, it fetched {farm.site_hits(2)}.")
+            if farm.site_hits(3) != 1:
+                return CheckResult.wrong(f"policy --max-bytes 1 should stop the crawl of {farm.site_url(3)} "
+                                         f"after its first page, it fetched {farm.site_hits(3)}.")
+            spacing = 0.1 * (farm.total_hits - 1)
+            if result.wall_time < 0.9 * spacing:
+                return CheckResult.wrong(f"Crawl-delay: 0.1 should space the {farm.total_hits} requests to the host, "
+                                         f"they took {result.wall_time:.2f}s instead of at least {spacing:.2f}s.")
+
+            result = cli.run('sync', '--conf', 'credentials.yaml', timeout=120)
+            if result.returncode != 0:
+                return CheckResult.wrong(f"A second sync failed:\n{result.output}")
+            if farm.robots_hits != 1:
+                return CheckResult.wrong("robots.txt should be kept in the database for a day, the second sync "
+                                         "fetched it again.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test39_sitemap_index_entries_are_filtered(self):
+        with BlogFarm(sites=1, posts=10, hosts=2, feed='sitemap',
+                      robots="User-agent: *\nDisallow: /private/\n") as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            stray = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                     '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"><url><loc>{}</loc></url></urlset>\n')
+            # add_page serves on every host, the sitemap of the second one is off-site
+            farm.add_page('/offsite.xml', stray.format(farm.base_url(1) + '/offsite-post'))
+            offsite = farm.base_url(1) + '/offsite.xml'
+            private = farm.add_page('/private/sitemap.xml', stray.format(farm.base_url(0) + '/private/post'))
+            index = farm.add_page('/s0/index.xml', (
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+                + ''.join(f'<sitemap><loc>{loc}</loc></sitemap>\n' for loc in (farm.feed_url(0), offsite, private))
+                + '</sitemapindex>\n'), 'application/xml')
+            cli.query('UPDATE blogs SET feed = ? WHERE site = ?', index, farm.site_url(0))
+            farm.reset_stats()
+            cli.write_file('credentials.yaml', sync_config())
+            result = cli.run('sync', '--conf', 'credentials.yaml', timeout=60)
+            if result.returncode != 0:
+                return CheckResult.wrong(f"sync --conf failed:\n{result.output}")
+            if farm.hits['/offsite.xml'] or farm.hits['/private/sitemap.xml']:
+                return CheckResult.wrong("A sitemap index should only lead to sitemaps on the host of the site "
+                                         "that robots.txt allows, sync fetched an off-site or disallowed one.")
+            posts = {link for link, in cli.query('SELECT link FROM posts')}
+            expected = {farm.post_url(0, j) for j in range(farm.posts)}
+            if posts != expected:
+                return CheckResult.wrong(f"sync should store the {len(expected)} posts of the sitemap of the site "
+                                         f"and nothing else, it stored {sorted(posts - expected)[:3]} and missed "
+                                         f"{sorted(expected - posts)[:3]}.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test40_telegram_errors_leave_out_the_bot_token(self):
+        with BlogFarm(sites=1, posts=4, per_page=5) as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            # nothing listens on port 1, every request to the Bot API is refused
+            cli.write_file('credentials.yaml', sync_config(mode='telegram', telegram="  api_url: http://127.0.0.1:1\n"))
+            result = cli.run('sync', '--conf', 'credentials.yaml', timeout=60)
+            if 'error delivering telegram message' not in result.output:
+                return CheckResult.wrong(f"sync should report that the Bot API could not be reached:\n{result.output}")
+            errors = [last_error for last_error, in cli.query('SELECT last_error FROM mails WHERE is_sent = 0')]
+            if not errors:
+                return CheckResult.wrong("The posts that could not be sent should stay in the outbox.")
+            if 'abcd1234' in result.output or any('abcd1234' in (error or '') for error in errors):
+                return CheckResult.wrong("The bot token is a secret, it should not show up in the output or in "
+                                         "the errors stored in the outbox.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test41_interrupted_watch_fails_and_releases_its_leases(self):
+        crawler = ("crawler:\n"
+                   "  max_depth: 20\n"
+                   "  per_host: 1\n")
+        with BlogFarm(sites=4, posts=40, per_page=5, hosts=4, latency=0.05) as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            cli.write_file('credentials.yaml', sync_config(sections=crawler))
+            farm.reset_stats()
+
+            proc = cli.start('watch', '--conf', 'credentials.yaml', '--shard')
+            deadline = time.monotonic() + 60
+            while farm.total_hits < farm.unique_pages() // 3 and time.monotonic() < deadline:
+                time.sleep(0.02)
+            proc.terminate()
+            try:
+                output, _ = proc.communicate(timeout=60)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                output, _ = proc.communicate()
+                return CheckResult.wrong(f"watch should stop soon after SIGTERM:\n{output}")
+            if proc.returncode == 0 or 'watch: stopped' in output:
+                return CheckResult.wrong(f"An interrupted watch should exit with an error, only the end of --for "
+                                         f"is a clean stop:\n{output}")
+            (leased,), = cli.query('SELECT COUNT(*) FROM blogs WHERE lease_until > 0')
+            if leased:
+                return CheckResult.wrong(f"An interrupted watch --shard should release its leases, "
+                                         f"{leased} blogs are still leased.")
+
+            result = cli.run('watch', '--conf', 'credentials.yaml', '--shard', '--for', '10s', timeout=60)
+            if result.returncode != 0 or 'watch: stopped' not in result.output:
+                return CheckResult.wrong(f"watch --for 10s should stop cleanly:\n{result.output}")
+            posts = {link for link, in cli.query('SELECT link FROM posts')}
+            missing = {farm.post_url(site, j) for site in range(farm.sites) for j in range(farm.posts)} - posts
+            if missing:
+                return CheckResult.wrong(f"The watch after an interrupted one should resume its crawls, "
+                                         f"{len(missing)} posts are missing.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test42_crawls_out_of_budget_go_on_next_sync(self):
+        with BlogFarm(sites=2, posts=20, per_page=5) as farm, BlogNotifierCLI() as cli:
+            cli.seed_sites(farm.site_urls())
+            cli.write_file('credentials.yaml', sync_config(sections="crawler:\n"
+                                                                    "  max_pages: 14\n"))
+            farm.reset_stats()
+            for run in range(2):
+                result = cli.run('sync', '--conf', 'credentials.yaml', timeout=60)
+                if result.returncode != 0:
+                    return CheckResult.wrong(f"sync --conf failed:\n{result.output}")
+                if run == 0 and any(farm.site_hits(site) > 14 for site in range(farm.sites)):
+                    return CheckResult.wrong("crawler.max_pages is 14, a sync fetched more pages of a site.")
+            for site in range(farm.sites):
+                pages = [farm.page_url(site, page) for page in range(1, farm.page_count() + 1)]
+                pages += [farm.post_url(site, post) for post in range(farm.posts)]
+                unfetched = [url for url in pages if not farm.hits[url[len(farm.base_url(site)):]]]
+                if unfetched:
+                    return CheckResult.wrong(f"{len(pages)} pages of {farm.site_url(site)} fit in two syncs with "
+                                             f"max_pages 14, the second should go on where the first ran out of "
+                                             f"budget, {unfetched[:3]} were never fetched.")
+            (left,), = cli.query('SELECT COUNT(*) FROM crawl_frontier')
+            if left:
+                return CheckResult.wrong(f"The second sync covered the rest of the sites, {left} pages are still "
+                                         f"left in the checkpoints.")
+        return CheckResult.correct()
+
+    @dynamic_test(time_limit=180000)
+    def test43_mirrored_feed_entries_are_mailed_once(self):
+        with BlogFarm(sites=3, posts=8, per_page=10, feed='rss') as farm, SMTPSink() as sink, \
+                BlogNotifierCLI() as cli:
+            mirrored = article_text('mirrored')
+            farm.articles = {
+                (0, 2): mirrored,
+                (1, 5): mirrored,
+                (2, 7): mirrored.replace('.', ' again.'),
+                (0, 4): article_text('only on blog 0'),
+            }
+            self.sync_with_smtp(farm, cli, sink)
+            new_posts = farm.sites * farm.posts
+            if len(sink.messages) != new_posts - 2:
+                return CheckResult.wrong(f"{new_posts} new posts read from feeds, of which 3 are the same article, "
+                                         f"should make {new_posts - 2} mails, the SMTP server received "
+                                         f"{len(sink.messages)}.")
+            contents = sink.contents()
+            mirrors = [farm.post_url(0, 2), farm.post_url(1, 5), farm.post_url(2, 7)]
+            mailed = [url for url in mirrors if any(url in content for content in contents)]
+            if len(mailed) != 1:
+                return CheckResult.wrong(f"An article syndicated to several feeds should be mailed once, "
+                                         f"{mailed} were mailed.")
+            if not any(farm.post_url(0, 4) in content for content in contents):
+                return CheckResult.wrong(f"{farm.post_url(0, 4)} is not mirrored anywhere, it should have been mailed.")
+        return CheckResult.correct()
+
     # Additional edge case tests can be added here ...
 
 
@@ -0,0 +1,390 @@
+package main
+
+import (
+	"bufio"
+	"database/sql"
+	"encoding/csv"
+	"encoding/xml"
+	"fmt"
+	"io"
+	"net/url"
+	"os"
+	"path/filepath"
+	"strings"
+)
+
+// formats of the watchlist files read by import and written by export
+const (
+	WATCHLIST_OPML  = "opml"
+	WATCHLIST_CSV   = "csv"
+	WATCHLIST_LINES = "lines"
+)
+
+// a site of a watchlist file along with its feed, which may be empty
+type watchlistEntry struct {
+	site string
+	feed string
+}
+
+// returns the format of a watchlist file: the given one, or else the one its extension
+// suggests, one url per line for anything that is not .opml, .xml or .csv
+func watchlistFormat(format, path string) (string, error) {
+	switch strings.ToLower(format) {
+	case WATCHLIST_OPML, WATCHLIST_CSV, WATCHLIST_LINES:
+		return strings.ToLower(format), nil
+	case "":
+	default:
+		return "", fmt.Errorf("unknown watchlist format %s, use opml, csv or lines", format)
+	}
+	switch strings.ToLower(filepath.Ext(path)) {
+	case ".opml", ".xml":
+		return WATCHLIST_OPML, nil
+	case ".csv":
+		return WATCHLIST_CSV, nil
+	}
+	return WATCHLIST_LINES, nil
+}
+
+// brings a site url into the form it is stored in, so that the same site is never
+// watched twice: the scheme defaults to http, scheme and host are lower case, the
+// fragment is dropped and an empty path becomes /
+func normalizeSite(raw string) (string, bool) {
+	raw = strings.TrimSpace(raw)
+	if raw == "" {
+		return "", false
+	}
+	if !strings.Contains(raw, "://") {
+		raw = "http://" + raw
+	}
+	u, err := url.Parse(raw)
+	if err != nil {
+		return "", false
+	}
+	u.Scheme = strings.ToLower(u.Scheme)
+	if (u.Scheme != "http" && u.Scheme != "https") || u.Host == "" {
+		return "", false
+	}
+	u.Host = strings.ToLower(u.Host)
+	u.Fragment = ""
+	u.RawFragment = ""
+	if u.Path == "" {
+		u.Path = "/"
+	}
+	return u.String(), true
+}
+
+// reads the entries of a watchlist file one at a time and hands every one to each,
+// nothing is kept in memory once each returns
+func readWatchlist(r io.Reader, format string, each func(entry watchlistEntry) error) error {
+	switch format {
+	case WATCHLIST_OPML:
+		return readOPML(r, each)
+	case WATCHLIST_CSV:
+		return readCSV(r, each)
+	}
+	return readLines(r, each)
+}
+
+// every <outline> with an htmlUrl or xmlUrl is a site, nested outlines are categories
+// and are read as well. The htmlUrl is the site and the xmlUrl its feed, an outline
+// with only an xmlUrl is watched through its feed
+func readOPML(r io.Reader, each func(entry watchlistEntry) error) error {
+	d := xml.NewDecoder(r)
+	for {
+		tok, err := d.Token()
+		if err == io.EOF {
+			return nil
+		}
+		if err != nil {
+			return err
+		}
+		start, ok := tok.(xml.StartElement)
+		if !ok || start.Name.Local != "outline" {
+			continue
+		}
+		entry := watchlistEntry{}
+		for _, attr := range start.Attr {
+			switch attr.Name.Local {
+			case "htmlUrl":
+				entry.site = attr.Value
+			case "xmlUrl":
+				entry.feed = attr.Value
+			}
+		}
+		if entry.site == "" {
+			entry.site = entry.feed
+		}
+		if entry.site == "" {
+			continue
+		}
+		if err := each(entry); err != nil {
+			return err
+		}
+	}
+}
+
+// the site is the first column and the feed the second, unless a header row names
+// the site (or url) and feed columns
+func readCSV(r io.Reader, each func(entry watchlistEntry) error) error {
+	c := csv.NewReader(r)
+	c.FieldsPerRecord = -1
+	c.ReuseRecord = true
+	siteCol, feedCol, first := 0, 1, true
+	for {
+		record, err := c.Read()
+		if err == io.EOF {
+			return nil
+		}
+		if err != nil {
+			return err
+		}
+		if first {
+			first = false
+			header := false
+			for i, name := range record {
+				switch strings.ToLower(strings.TrimSpace(name)) {
+				case "site", "url":
+					siteCol, header = i, true
+				case "feed":
+					feedCol, header = i, true
+				}
+			}
+			if header {
+				continue
+			}
+		}
+		entry := watchlistEntry{}
+		if siteCol < len(record) {
+			entry.site = record[siteCol]
+		}
+		if feedCol < len(record) && feedCol != siteCol {
+			entry.feed = strings.TrimSpace(record[feedCol])
+		}
+		if err := each(entry); err != nil {
+			return err
+		}
+	}
+}
+
+// one site per line, blank lines and lines starting with # are skipped
+func readLines(r io.Reader, each func(entry watchlistEntry) error) error {
+	s := bufio.NewScanner(r)
+	for s.Scan() {
+		line := strings.TrimSpace(s.Text())
+		if line == "" || strings.HasPrefix(line, "#") {
+			continue
+		}
+		if err := each(watchlistEntry{site: line}); err != nil {
+			return err
+		}
+	}
+	return s.Err()
+}
+
+// adds the sites of a watchlist file, or of standard input when path is -, to the
+// blogs table in a single transaction. Sites are normalized first, a site that is
+// already watched or listed twice is added once. The feeds of the sites are not looked
+// for, a site imported without one is crawled page by page
+func importSites(path, format string) error {
+	format, err := watchlistFormat(format, path)
+	if err != nil {
+		return err
+	}
+	var r io.Reader = os.Stdin
+	if path != "-" {
+		file, err := os.Open(path)
+		if err != nil {
+			return err
+		}
+		defer file.Close()
+		r = file
+	}
+
+	db, err := getDBConnection()
+	if err != nil {
+		return err
+	}
+	tx, err := db.Begin()
+	if err != nil {
+		return err
+	}
+	defer tx.Rollback()
+	stmt, err := tx.Prepare(IMPORT_BLOG)
+	if err != nil {
+		return err
+	}
+	defer stmt.Close()
+
+	added, duplicates, invalid := 0, 0, 0
+	err = readWatchlist(bufio.NewReaderSize(r, 64<<10), format, func(entry watchlistEntry) error {
+		site, ok := normalizeSite(entry.site)
+		if !ok {
+			invalid++
+			fmt.Printf("skipping %q, not a http or https url\n", entry.site)
+			return nil
+		}
+		res, err := stmt.Exec(site, site, entry.feed)
+		if err != nil {
+			return err
+		}
+		if n, _ := res.RowsAffected(); n == 0 {
+			duplicates++
+			return nil
+		}
+		added++
+		return nil
+	})
+	if err != nil {
+		return fmt.Errorf("reading %s: %w", path, err)
+	}
+	if err = tx.Commit(); err != nil {
+		return err
+	}
+	fmt.Printf("imported %d sites, %d duplicates, %d invalid\n", added, duplicates, invalid)
+	return nil
+}
+
+// writes the watched sites, ordered by site, to path or to standard output when path is
+// empty or -. The rows are written as they are read from the database
+func exportSites(path, format string) error {
+	format, err := watchlistFormat(format, path)
+	if err != nil {
+		return err
+	}
+	var out io.Writer = os.Stdout
+	if path != "" && path != "-" {
+		file, err := os.Create(path)
+		if err != nil {
+			return err
+		}
+		defer file.Close()
+		out = file
+	}
+	w := bufio.NewWriterSize(out, 64<<10)
+
+	db, err := getDBConnection()
+	if err != nil {
+		return err
+	}
+	rows, err := db.Query(EXPORT_BLOGS)
+	if err != nil {
+		return err
+	}
+	defer rows.Close()
+
+	var c *csv.Writer
+	switch format {
+	case WATCHLIST_OPML:
+		fmt.Fprint(w, xml.Header+"<opml version=\"2.0\">\n<head><title>Blog Notifier watchlist</title></head>\n<body>\n")
+	case WATCHLIST_CSV:
+		c = csv.NewWriter(w)
+		c.Write([]string{"site", "feed", "last_link"})
+	}
+	for rows.Next() {
+		site, feed, lastLink := "", sql.NullString{}, sql.NullString{}
+		if err := rows.Scan(&site, &feed, &lastLink); err != nil {
+			return err
+		}
+		switch format {
+		case WATCHLIST_OPML:
+			w.WriteString(`  <outline type="rss" text="`)
+			xml.EscapeText(w, []byte(site))
+			w.WriteString(`" htmlUrl="`)
+			xml.EscapeText(w, []byte(site))
+			if feed.String != "" {
+				w.WriteString(`" xmlUrl="`)
+				xml.EscapeText(w, []byte(feed.String))
+			}
+			w.WriteString("\"/>\n")
+		case WATCHLIST_CSV:
+			c.Write([]string{site, feed.String, lastLink.String})
+		default:
+			fmt.Fprintln(w, site)
+		}
+	}
+	if err = rows.Err(); err != nil {
+		return err
+	}
+	switch format {
+	case WATCHLIST_OPML:
+		w.WriteString("</body>\n</opml>\n")
+	case WATCHLIST_CSV:
+		c.Flush()
+		if err = c.Error(); err != nil {
+			return err
+		}
+	}
+	return w.Flush()
+}
+
+// hands the watched sites to each, ordered by site. They are read LIST_PAGE_SIZE at a
+// time, every page continuing after the last site of the previous one, so neither the
+// memory nor a read transaction grow with the size of the watchlist
+func listSites(each func(site, lastLink string) error) error {
+	db, err := getDBConnection()
+	if err != nil {
+		return err
+	}
+	after := ""
+	for {
+		rows, err := db.Query(FETCH_BLOGS_PAGE, after, LIST_PAGE_SIZE)
+		if err != nil {
+			return err
+		}
+		n := 0
+		for rows.Next() {
+			lastLink := sql.NullString{}
+			if err := rows.Scan(&after, &lastLink); err != nil {
+				rows.Close()
+				return err
+			}
+			n++
+			if err := each(after, lastLink.String); err != nil {
+				rows.Close()
+				return err
+			}
+		}
+		rows.Close()
+		if err = rows.Err(); err != nil {
+			return err
+		}
+		if n < LIST_PAGE_SIZE {
+			return nil
+		}
+	}
+}
+
+// hands the posts of site to each, ordered by link and read a page at a time like
+// listSites
+func listPostsForSite(site string, each func(link string) error) error {
+	db, err := getDBConnection()
+	if err != nil {
+		return err
+	}
+	after := ""
+	for {
+		rows, err := db.Query(FETCH_POSTS_PAGE, site, after, LIST_PAGE_SIZE)
+		if err != nil {
+			return err
+		}
+		n := 0
+		for rows.Next() {
+			if err := rows.Scan(&after); err != nil {
+				rows.Close()
+				return err
+			}
+			n++
+			if err := each(after); err != nil {
+				rows.Close()
+				return err
+			}
+		}
+		rows.Close()
+		if err = rows.Err(); err != nil {
+			return err
+		}
+		if n < LIST_PAGE_SIZE {
+			return nil
+		}
+	}
+}
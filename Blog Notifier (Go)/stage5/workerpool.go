@@ -0,0 +1,151 @@
+package main
+
+import (
+	"fmt"
+	"sync"
+	"sync/atomic"
+	"time"
+)
+
+// a fixed size pool of goroutines, keeps counters about the queue and the workers
+// so that a run can report how well the pool was used
+type workerPool struct {
+	name      string
+	size      int
+	queued    atomic.Int64
+	active    atomic.Int64
+	peakQueue atomic.Int64
+	peakBusy  atomic.Int64
+	done      atomic.Int64
+	busy      atomic.Int64 // nanoseconds spent inside jobs, summed over all workers
+	wall      time.Duration
+}
+
+func newWorkerPool(name string, size int) *workerPool {
+	if size <= 0 {
+		size = 1
+	}
+	return &workerPool{name: name, size: size}
+}
+
+func storeMax(v *atomic.Int64, n int64) {
+	for {
+		cur := v.Load()
+		if n <= cur || v.CompareAndSwap(cur, n) {
+			return
+		}
+	}
+}
+
+// runs job(i) for every i in [0, n) on the pool and waits for all of them to finish
+func (p *workerPool) run(n int, job func(i int)) {
+	start := time.Now()
+	jobs := make(chan int)
+	wg := &sync.WaitGroup{}
+	for w := 0; w < p.size && w < n; w++ {
+		wg.Add(1)
+		go func() {
+			defer wg.Done()
+			for i := range jobs {
+				p.queued.Add(-1)
+				storeMax(&p.peakBusy, p.active.Add(1))
+				t := time.Now()
+				job(i)
+				p.busy.Add(int64(time.Since(t)))
+				p.active.Add(-1)
+				p.done.Add(1)
+			}
+		}()
+	}
+	p.queued.Store(int64(n))
+	storeMax(&p.peakQueue, int64(n))
+	for i := 0; i < n; i++ {
+		jobs <- i
+	}
+	close(jobs)
+	wg.Wait()
+	p.wall += time.Since(start)
+}
+
+// share of the pool capacity that was spent running jobs
+func (p *workerPool) utilization() float64 {
+	capacity := float64(p.wall) * float64(p.size)
+	if capacity == 0 {
+		return 0
+	}
+	return float64(p.busy.Load()) / capacity
+}
+
+func (p *workerPool) String() string {
+	return fmt.Sprintf("%s pool: workers %d, jobs %d, queue depth %d (peak %d), active %d (peak %d), utilization %.1f%%",
+		p.name, p.size, p.done.Load(), p.queued.Load(), p.peakQueue.Load(),
+		p.active.Load(), p.peakBusy.Load(), 100*p.utilization())
+}
+
+// limits the number of concurrent requests per host and spaces requests to the same
+// host at least delay apart, or the delay set for the host when it is longer
+type hostLimiter struct {
+	mu     sync.Mutex
+	limit  int
+	delay  time.Duration
+	delays map[string]time.Duration // the Crawl-delay of the robots.txt of a host
+	slots  map[string]chan struct{}
+	next   map[string]time.Time
+}
+
+func newHostLimiter(limit int, delay time.Duration) *hostLimiter {
+	if limit <= 0 {
+		limit = 1
+	}
+	return &hostLimiter{
+		limit:  limit,
+		delay:  delay,
+		delays: make(map[string]time.Duration),
+		slots:  make(map[string]chan struct{}),
+		next:   make(map[string]time.Time),
+	}
+}
+
+// sets the delay between two requests to host, the configured delay still applies when
+// it is longer
+func (h *hostLimiter) setDelay(host string, delay time.Duration) {
+	h.mu.Lock()
+	h.delays[host] = delay
+	h.mu.Unlock()
+}
+
+// blocks until a request to host may be sent, every acquire must be paired with a release
+func (h *hostLimiter) acquire(host string) {
+	h.mu.Lock()
+	slot, ok := h.slots[host]
+	if !ok {
+		slot = make(chan struct{}, h.limit)
+		h.slots[host] = slot
+	}
+	h.mu.Unlock()
+
+	slot <- struct{}{}
+
+	// reserve the next free send time for this host, then wait for it
+	h.mu.Lock()
+	delay := max(h.delay, h.delays[host])
+	if delay <= 0 {
+		h.mu.Unlock()
+		return
+	}
+	now := time.Now()
+	at := h.next[host]
+	if at.Before(now) {
+		at = now
+	}
+	h.next[host] = at.Add(delay)
+	h.mu.Unlock()
+	time.Sleep(time.Until(at))
+}
+
+func (h *hostLimiter) release(host string) {
+	h.mu.Lock()
+	slot := h.slots[host]
+	h.mu.Unlock()
+	<-slot
+}